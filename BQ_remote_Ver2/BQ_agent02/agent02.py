@@ -1,6 +1,16 @@
+import time
+
+_IMPORT_STARTED = time.perf_counter()
+
 from google.adk.agents import Agent
 from google.adk.tools import ApiRegistry, FunctionTool
+from .budget_guard import guard_query_budget
 from .excel_tool import export_to_excel, list_saved_files
+from .lazy_init import LazyToolset, report_import_time, schedule_warmup
+from .metadata_cache import answer_metadata_locally
+from .query_cache import QueryCachingToolset
+from .result_store import capture_execute_sql, fetch_result_page
+from .tool_cache import CachedToolset
 
 # プロジェクトID
 PROJECT_ID = "agent-vi-473112"
@@ -13,23 +23,29 @@ header_provider = lambda context: {
     "x-goog-user-project": PROJECT_ID,
 }
 
-# ApiRegistry初期化
-bq_api_registry = ApiRegistry(PROJECT_ID, header_provider=header_provider)
 
-# BigQuery MCP serverのtoolsetを取得
-registry_tools = bq_api_registry.get_toolset(
-    mcp_server_name=MCP_SERVER_NAME
-)
+def _load_registry_toolset():
+    """ApiRegistryからBigQuery MCP serverのtoolsetを取得（ネットワークアクセスあり）"""
+    bq_api_registry = ApiRegistry(PROJECT_ID, header_provider=header_provider)
+    return bq_api_registry.get_toolset(mcp_server_name=MCP_SERVER_NAME)
+
+
+# toolsetの取得は初回のツール呼び出し時（またはウォームアップ時）まで遅らせ、
+# ツール一覧はディスクにキャッシュしてセッション開始ごとの取得を省略する
+# execute_sql は結果キャッシュ（query_cache）を経由して実行する
+_registry_toolset = LazyToolset("api_registry_toolset", _load_registry_toolset)
+registry_tools = QueryCachingToolset(CachedToolset(MCP_SERVER_NAME, _registry_toolset))
 
 # Excel出力ツール
 excel_export_tool = FunctionTool(func=export_to_excel)
 list_files_tool = FunctionTool(func=list_saved_files)
+result_page_tool = FunctionTool(func=fetch_result_page)
 
 # エージェント定義
 root_agent = Agent(
     name="bigquery_mcp_agent",
     model="gemini-2.5-flash",
-    tools=[registry_tools, excel_export_tool, list_files_tool],
+    tools=[registry_tools, result_page_tool, excel_export_tool, list_files_tool],
     instruction=f"""あなたはBigQueryの専門家です。
 プロジェクトID '{PROJECT_ID}' をデフォルトとして使用し、
 積極的にBigQueryのツールを使って回答してください。
@@ -41,12 +57,13 @@ root_agent = Agent(
 - list_table_ids: テーブルを一覧表示
 - get_dataset_info: データセットのメタデータを取得
 - get_table_info: テーブルのメタデータを取得
-- execute_sql: SQLステートメントを実行
+- execute_sql: SQLステートメントを実行（応答は result_handle・行数・スキーマ・先頭行のプレビュー）
+- fetch_result_page: execute_sqlの結果の続きの行を取得（result_handle, offset, limit）
 - search_catalog: 自然言語を使用してテーブルを検索
 
 ### Excel出力
 - export_to_excel: クエリ結果をExcelファイルとして保存
-  - data: execute_sqlの結果データ
+  - result_handle: execute_sqlの応答に含まれる result_handle
   - filename: ファイル名（例: "report.xlsx"）
   - sheet_name: シート名（オプション、デフォルト: "Sheet1"）
 - list_saved_files: 保存済みファイル一覧を表示
@@ -55,12 +72,20 @@ root_agent = Agent(
 1. ユーザーの質問に答えるために必要なツールは、説明なしに即座に実行してください
 2. 「〜を取得します」「〜を実行します」と言う前に、まずツールを呼び出してください
 3. ツールの結果を待ってから、結果をユーザーに説明してください
+4. SELECT * は避けて必要な列だけを選び、パーティション列があれば期間で絞ってください。execute_sql がスキャン量の上限で実行されなかった場合は、suggested_query や notes を参考にSQLを絞り込んで再実行してください
 
 ## Excel出力のワークフロー
-1. execute_sql でデータを取得
-2. 取得した結果を export_to_excel に渡して保存
+1. execute_sql でデータを取得（応答には result_handle とプレビュー行が含まれる）
+2. result_handle を export_to_excel に渡して保存（結果の行を書き写さないこと）
 3. 保存完了を報告
 
 日本語で分かりやすく回答してください。
 """,
+    before_tool_callback=[answer_metadata_locally, guard_query_budget],
+    after_tool_callback=capture_execute_sql,
 )
+
+
+# 起動後にバックグラウンドでtoolsetを取得しておく
+schedule_warmup(_registry_toolset.resource.get)
+report_import_time(__name__, _IMPORT_STARTED)
@@ -2,16 +2,56 @@
 Excel出力ツール (Artifacts機能使用)
 """
 import json
-from io import BytesIO
-from typing import Any
-import google.genai.types as types
+from typing import Any, BinaryIO
+import pyarrow as pa
 from google.adk.tools import ToolContext
 
+from .artifact_store import run_to_file, save_file_artifact
+from .bq_result import normalize_bq_result, iter_table_rows
+from .export_executor import ExportQueueFullError, export_executor
+from .export_index import content_key, find_export, list_exports, record_export, reuse_export, reused_response
+from .result_store import resolve_result_handle, result_handle_sql
+
+
+def _normalize_with_key(data: Any, sheet_name: str) -> tuple[pa.Table, str]:
+    """データを正規化し、出力内容のキーとあわせて返す（同期処理）"""
+    table = normalize_bq_result(data)
+    return table, content_key(table, format="xlsx", sheet_name=sheet_name)
+
+
+def _build_workbook_file(data: Any, sheet_name: str, fileobj: BinaryIO) -> int | None:
+    """
+    データを正規化してExcelファイルを fileobj に書き込む（同期処理）
+    
+    Returns:
+        行数。データが空の場合は None
+    """
+    from openpyxl import Workbook
+    
+    # 型付きの列配列に正規化（schema + rows の場合は列名と型を復元）
+    table = normalize_bq_result(data)
+    if table.num_rows == 0 or table.num_columns == 0:
+        return None
+    
+    # Excelワークブック作成
+    wb = Workbook()
+    ws = wb.active
+    ws.title = sheet_name
+    
+    # ヘッダー行・データ行を書き込み（列配列から直接行を組み立てる）
+    ws.append(table.column_names)
+    for values in iter_table_rows(table):
+        ws.append(values)
+    
+    wb.save(fileobj)
+    return table.num_rows
+
 
 async def export_to_excel(
     tool_context: ToolContext,
-    data: list[dict[str, Any]] | str,
     filename: str,
+    result_handle: str = "",
+    data: list[dict[str, Any]] | dict[str, Any] | str | None = None,
     sheet_name: str = "Sheet1",
 ) -> dict[str, Any]:
     """
@@ -19,21 +59,31 @@ async def export_to_excel(
     
     Args:
         tool_context: ADKのToolContext（自動注入）
-        data: 保存するデータ（辞書のリスト or JSON文字列）
         filename: ファイル名（例: "report.xlsx"）
+        result_handle: execute_sqlの応答に含まれる結果ハンドル（例: "qr_1a2b3c4d5e6f"）
+        data: 保存するデータ（辞書のリスト、schema + rows 形式、またはJSON文字列）。result_handleがない場合のみ使用
         sheet_name: シート名
     
     Returns:
         dict: 保存結果
     """
     try:
-        from openpyxl import Workbook
+        import openpyxl  # noqa: F401
     except ImportError:
         return {
             "success": False,
             "error": "openpyxlがインストールされていません。pip install openpyxl を実行してください。"
         }
     
+    # ハンドル指定時はサーバー側に保存済みの結果を使う
+    if result_handle:
+        data = resolve_result_handle(tool_context, result_handle)
+        if data is None:
+            return {
+                "success": False,
+                "error": f"結果ハンドル '{result_handle}' が見つかりません。execute_sqlを再実行してください。"
+            }
+    
     # JSON文字列の場合はパース
     if isinstance(data, str):
         try:
@@ -44,78 +94,68 @@ async def export_to_excel(
                 "error": "JSONの解析に失敗しました。"
             }
     
-    # データがリストでない場合の処理
-    if not isinstance(data, list):
-        if isinstance(data, dict):
-            if "rows" in data:
-                data = data["rows"]
-            elif "result" in data:
-                data = data["result"]
-            else:
-                data = [data]
-    
-    if not data:
-        return {
-            "success": False,
-            "error": "保存するデータがありません。"
-        }
-    
-    # Excelワークブック作成
-    wb = Workbook()
-    ws = wb.active
-    ws.title = sheet_name
-    
-    # ヘッダー行を書き込み
-    if isinstance(data[0], dict):
-        headers = list(data[0].keys())
-        ws.append(headers)
-        
-        # データ行を書き込み
-        for row in data:
-            ws.append([row.get(h, "") for h in headers])
-    else:
-        # リストのリストの場合
-        for row in data:
-            if isinstance(row, list):
-                ws.append(row)
-            else:
-                ws.append([row])
-    
-    # BytesIOに保存
-    excel_buffer = BytesIO()
-    wb.save(excel_buffer)
-    excel_bytes = excel_buffer.getvalue()
-    
     # ファイル名に.xlsxがなければ追加
     if not filename.endswith(".xlsx"):
         filename = f"{filename}.xlsx"
     
-    # Artifactとして保存
+    # ワークブック生成はイベントループの外（export_executor）で一時領域に書き出す
+    # 同じ結果・同じシート名の出力が保存済みの場合は生成を省略して再利用する
     try:
-        artifact = types.Part.from_bytes(
-            data=excel_bytes,
-            mime_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
-        version = await tool_context.save_artifact(filename=filename, artifact=artifact)
+        (table, key), _ = await export_executor.run(_normalize_with_key, data, sheet_name)
+        cached = find_export(tool_context, key)
+        if cached is not None:
+            reused = await reuse_export(tool_context, cached, filename)
+            if reused:
+                return reused_response(reused)
+        rows, fileobj, queue_wait = await run_to_file(_build_workbook_file, table, sheet_name)
+    except ExportQueueFullError as e:
+        return {"success": False, "error": str(e)}
+    
+    with fileobj:
+        if rows is None:
+            return {
+                "success": False,
+                "error": "保存するデータがありません。"
+            }
         
-        return {
-            "success": True,
-            "filename": filename,
-            "version": version,
-            "rows": len(data),
-            "message": f"Excelファイル '{filename}' を保存しました（バージョン: {version}、{len(data)}行）"
-        }
-    except Exception as e:
-        return {
-            "success": False,
-            "error": f"Artifactの保存に失敗しました: {str(e)}"
-        }
+        # Artifactとして保存（大きいファイルはGCSへアップロードして参照を保存）
+        try:
+            saved = await save_file_artifact(
+                tool_context,
+                filename,
+                fileobj,
+                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+            version = saved["version"]
+            record_export(
+                tool_context, filename, key,
+                format="xlsx", rows=rows, columns=table.num_columns,
+                source_query=result_handle_sql(tool_context, result_handle) if result_handle else None,
+                **saved
+            )
+            
+            return {
+                "success": True,
+                "filename": filename,
+                "rows": rows,
+                **saved,
+                "queue_wait_ms": round(queue_wait * 1000, 1),
+                "message": f"Excelファイル '{filename}' を保存しました（バージョン: {version}、{rows}行）"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": f"Artifactの保存に失敗しました: {str(e)}"
+            }
 
 
 async def list_saved_files(tool_context: ToolContext) -> dict[str, Any]:
     """
     保存済みのArtifact一覧を取得する
     
+    出力時に記録した索引から、サイズ・行数・列数・形式・作成日時・元のSQLを返す
+    （Artifact本体は読まない）。索引にないファイルは名前のみ
+    
     Args:
         tool_context: ADKのToolContext（自動注入）
     
@@ -123,11 +163,14 @@ async def list_saved_files(tool_context: ToolContext) -> dict[str, Any]:
         dict: ファイル一覧
     """
     try:
-        files = await tool_context.list_artifacts()
+        files = list_exports(tool_context)
+        indexed = {f["filename"] for f in files}
+        names = await tool_context.list_artifacts()
+        files += [{"filename": name} for name in names or [] if name not in indexed]
         return {
             "success": True,
-            "files": files if files else [],
-            "count": len(files) if files else 0
+            "files": files,
+            "count": len(files)
         }
     except Exception as e:
         return {
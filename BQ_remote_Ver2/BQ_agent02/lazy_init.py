@@ -0,0 +1,148 @@
+"""
+遅延初期化とバックグラウンドウォームアップ
+
+Agent Engine のコールドスタートを短くするため、ネットワークを伴う初期化
+（ApiRegistry からのツールセット取得、認証情報の取得）と重いライブラリの読み込みを
+モジュールのインポート時ではなく初回のツール呼び出し時まで遅らせる。
+
+- LazyResource: 初回アクセス時に1回だけ初期化する値
+- LazyToolset: 初回の get_tools() で実体のツールセットを作るラッパー
+- schedule_warmup(): インポートから BQ_WARMUP_DELAY_SECONDS 秒後（既定 2秒）に
+  バックグラウンドスレッドで初期化を済ませておく（負の値で無効）
+- report_import_time() / startup_metrics(): インポート時間と初期化時間の記録
+"""
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from typing import Any, Callable
+
+from google.adk.tools.base_toolset import BaseToolset
+
+logger = logging.getLogger(__name__)
+
+WARMUP_DELAY_SECONDS = float(os.getenv("BQ_WARMUP_DELAY_SECONDS", "2"))
+
+_metrics: dict[str, float] = {}
+_metrics_lock = threading.Lock()
+
+
+def _record(name: str, seconds: float) -> None:
+    with _metrics_lock:
+        _metrics[name] = round(seconds * 1000, 1)
+
+
+def startup_metrics() -> dict[str, float]:
+    """インポート時間・初期化時間（ミリ秒）の一覧"""
+    with _metrics_lock:
+        return dict(_metrics)
+
+
+def report_import_time(module_name: str, started: float) -> float:
+    """モジュールのインポートにかかった時間を記録してログに出す"""
+    elapsed = time.perf_counter() - started
+    _record(f"import:{module_name}", elapsed)
+    logger.info(f"Imported {module_name} in {elapsed * 1000:.1f}ms")
+    return elapsed
+
+
+class LazyResource:
+    """初回アクセス時に factory を1回だけ実行し、結果を保持する"""
+
+    def __init__(self, name: str, factory: Callable[[], Any]):
+        self.name = name
+        self._factory = factory
+        self._value: Any = None
+        self._ready = False
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready
+
+    def get(self) -> Any:
+        """値を返す（未初期化ならこのスレッドで初期化する）"""
+        if self._ready:
+            return self._value
+        with self._lock:
+            if not self._ready:
+                started = time.perf_counter()
+                self._value = self._factory()
+                self._ready = True
+                elapsed = time.perf_counter() - started
+                _record(f"init:{self.name}", elapsed)
+                logger.info(f"Initialized {self.name} in {elapsed * 1000:.1f}ms")
+        return self._value
+
+    async def aget(self) -> Any:
+        """値を返す（未初期化の場合、初期化はイベントループの外で行う）"""
+        if self._ready:
+            return self._value
+        return await asyncio.to_thread(self.get)
+
+
+class LazyToolset(BaseToolset):
+    """
+    初回の get_tools() で実体のツールセットを作るラッパー
+
+    ApiRegistry(...).get_toolset(...) のようにネットワークを伴う取得を
+    インポート時に行わないために使う
+    """
+
+    def __init__(self, name: str, factory: Callable[[], BaseToolset]):
+        super().__init__()
+        self.resource = LazyResource(name, factory)
+
+    async def get_tools(self, readonly_context: Any = None) -> list[Any]:
+        toolset = await self.resource.aget()
+        return await toolset.get_tools(readonly_context)
+
+    async def close(self) -> None:
+        if self.resource.ready:
+            await self.resource.get().close()
+
+
+def warm_imports(*module_names: str) -> Callable[[], None]:
+    """指定したモジュールを読み込むウォームアップ処理を返す"""
+
+    def load() -> None:
+        for module_name in module_names:
+            importlib.import_module(module_name)
+
+    load.__name__ = f"imports({', '.join(module_names)})"
+    return load
+
+
+def _run_warmup(tasks: tuple[Callable[[], Any], ...]) -> None:
+    for task in tasks:
+        name = getattr(task, "__name__", repr(task))
+        started = time.perf_counter()
+        try:
+            task()
+        except Exception as e:
+            # ウォームアップの失敗は初回のツール呼び出し時に再試行される
+            logger.warning(f"Warmup {name} failed: {e}")
+            continue
+        _record(f"warmup:{name}", time.perf_counter() - started)
+
+
+def schedule_warmup(
+    *tasks: Callable[[], Any],
+    delay: float = WARMUP_DELAY_SECONDS
+) -> threading.Timer | None:
+    """
+    delay 秒後にバックグラウンドスレッドで初期化処理を順に実行する
+
+    インポートはすぐに戻るため、サーバーはその間にリクエストの受け付けを始められる。
+    export_executor のワーカープロセス（spawn でパッケージを読み込み直す）では行わない
+    """
+    if delay < 0 or multiprocessing.parent_process() is not None:
+        return None
+    timer = threading.Timer(delay, _run_warmup, args=(tasks,))
+    timer.name = "bq-agent-warmup"
+    timer.daemon = True
+    timer.start()
+    return timer
@@ -0,0 +1,204 @@
+"""
+MCPツール一覧のキャッシュ
+
+MCPサーバーのツール一覧（名前・説明・関数宣言）をサーバーURL/名前ごとにローカルディスクへ保存し、
+新しいセッションやインスタンス再起動後も最初のLLM呼び出し前の tools/list を省略する。
+
+- TTL（BQ_TOOL_CACHE_TTL_SECONDS、既定 3600秒）内はキャッシュをそのまま使う
+- TTL切れ後も BQ_TOOL_CACHE_MAX_STALE_SECONDS（既定 7日）まではキャッシュを返しつつ、
+  バックグラウンドで一覧を取り直す
+- 保存先: BQ_TOOL_CACHE_DIR（既定 <一時ディレクトリ>/bq_agent_tool_cache）
+
+キャッシュから返すツールは宣言だけを持つ代理ツールで、実際に呼び出された時点で
+元のツールセットのツールを解決して実行を委ねる。
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any
+
+import google.genai.types as types
+from google.adk.tools.base_tool import BaseTool
+from google.adk.tools.base_toolset import BaseToolset
+
+logger = logging.getLogger(__name__)
+
+TOOL_CACHE_DIR = os.getenv(
+    "BQ_TOOL_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "bq_agent_tool_cache")
+)
+TOOL_CACHE_TTL_SECONDS = float(os.getenv("BQ_TOOL_CACHE_TTL_SECONDS", "3600"))
+TOOL_CACHE_MAX_STALE_SECONDS = float(os.getenv("BQ_TOOL_CACHE_MAX_STALE_SECONDS", str(7 * 24 * 3600)))
+
+# キャッシュファイルの形式が変わったら上げる
+MANIFEST_VERSION = 1
+
+
+class ToolManifestCache:
+    """ツール一覧（マニフェスト）のメモリ + ディスクキャッシュ"""
+
+    def __init__(self, cache_dir: str = TOOL_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._memory: dict[str, dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:24]
+        return os.path.join(self.cache_dir, f"tools_{digest}.json")
+
+    def load(self, key: str) -> dict[str, Any] | None:
+        """キャッシュ済みのマニフェスト（{"key", "fetched_at", "tools"}）を返す"""
+        with self._lock:
+            manifest = self._memory.get(key)
+        if manifest is not None:
+            return manifest
+
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Tool cache read failed for {key}: {e}")
+            return None
+
+        if manifest.get("version") != MANIFEST_VERSION or manifest.get("key") != key:
+            return None
+        with self._lock:
+            self._memory[key] = manifest
+        return manifest
+
+    def store(self, key: str, tools: list[dict[str, Any]]) -> dict[str, Any]:
+        """マニフェストを保存する（ディスクへは一時ファイル経由で置き換える）"""
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "key": key,
+            "fetched_at": time.time(),
+            "tools": tools,
+        }
+        with self._lock:
+            self._memory[key] = manifest
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning(f"Tool cache write failed for {key}: {e}")
+        return manifest
+
+
+# プロセス全体で共有するキャッシュ
+tool_manifest_cache = ToolManifestCache()
+
+
+def _tool_entry(tool: BaseTool) -> dict[str, Any] | None:
+    """ツールをマニフェストの1エントリ（名前・説明・関数宣言）にする"""
+    declaration = tool._get_declaration()
+    if declaration is None:
+        return None
+    return {
+        "name": tool.name,
+        "description": tool.description,
+        "declaration": declaration.model_dump(mode="json", exclude_none=True),
+    }
+
+
+class CachedManifestTool(BaseTool):
+    """キャッシュ済みの宣言を返し、呼び出し時に元のツールへ委譲する代理ツール"""
+
+    def __init__(self, toolset: "CachedToolset", entry: dict[str, Any]):
+        super().__init__(name=entry["name"], description=entry.get("description") or "")
+        self._toolset = toolset
+        self._declaration = types.FunctionDeclaration.model_validate(entry["declaration"])
+
+    def _get_declaration(self) -> types.FunctionDeclaration:
+        return self._declaration
+
+    async def run_async(self, *, args: dict[str, Any], tool_context: Any) -> Any:
+        tool = await self._toolset.resolve_tool(self.name, tool_context)
+        return await tool.run_async(args=args, tool_context=tool_context)
+
+
+class CachedToolset(BaseToolset):
+    """
+    ツール一覧をキャッシュするツールセットのラッパー
+
+    Args:
+        cache_key: キャッシュのキー（MCPサーバーのURLまたはサーバー名）
+        toolset: 元のツールセット（MCPToolset / LazyToolset など）
+    """
+
+    def __init__(
+        self,
+        cache_key: str,
+        toolset: BaseToolset,
+        cache: ToolManifestCache = tool_manifest_cache,
+        ttl_seconds: float = TOOL_CACHE_TTL_SECONDS,
+        max_stale_seconds: float = TOOL_CACHE_MAX_STALE_SECONDS
+    ):
+        super().__init__()
+        self.cache_key = cache_key
+        self._toolset = toolset
+        self._cache = cache
+        self._ttl_seconds = ttl_seconds
+        self._max_stale_seconds = max_stale_seconds
+        self._live_tools: dict[str, BaseTool] = {}
+        self._revalidation: asyncio.Task | None = None
+
+    async def _fetch(self, readonly_context: Any = None) -> dict[str, Any]:
+        """元のツールセットから一覧を取得してキャッシュを更新する"""
+        started = time.perf_counter()
+        tools = await self._toolset.get_tools(readonly_context)
+        self._live_tools = {tool.name: tool for tool in tools}
+        entries = [entry for entry in map(_tool_entry, tools) if entry is not None]
+        manifest = self._cache.store(self.cache_key, entries)
+        logger.info(
+            f"Fetched {len(entries)} tools for {self.cache_key} "
+            f"in {(time.perf_counter() - started) * 1000:.1f}ms"
+        )
+        return manifest
+
+    async def _revalidate(self) -> None:
+        try:
+            await self._fetch()
+        except Exception as e:
+            # 取り直しに失敗しても、期限切れのキャッシュで動作を続ける
+            logger.warning(f"Tool list revalidation failed for {self.cache_key}: {e}")
+
+    def _schedule_revalidation(self) -> None:
+        if self._revalidation is None or self._revalidation.done():
+            self._revalidation = asyncio.create_task(self._revalidate())
+
+    async def get_tools(self, readonly_context: Any = None) -> list[BaseTool]:
+        manifest = self._cache.load(self.cache_key)
+        age = time.time() - manifest["fetched_at"] if manifest else None
+
+        if manifest is None or age > self._max_stale_seconds:
+            manifest = await self._fetch(readonly_context)
+        elif age > self._ttl_seconds:
+            self._schedule_revalidation()
+
+        return [CachedManifestTool(self, entry) for entry in manifest["tools"]]
+
+    async def resolve_tool(self, name: str, tool_context: Any = None) -> BaseTool:
+        """実行用に元のツールセットのツールを返す（未取得なら一覧を取得する）"""
+        tool = self._live_tools.get(name)
+        if tool is None:
+            await self._fetch(tool_context)
+            tool = self._live_tools.get(name)
+        if tool is None:
+            raise ValueError(f"Tool '{name}' is no longer provided by {self.cache_key}")
+        return tool
+
+    async def close(self) -> None:
+        if self._revalidation is not None and not self._revalidation.done():
+            self._revalidation.cancel()
+        await self._toolset.close()
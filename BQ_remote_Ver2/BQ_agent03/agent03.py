@@ -1,8 +1,23 @@
+import time
+
+_IMPORT_STARTED = time.perf_counter()
+
 from google.adk.agents import Agent
 from google.adk.tools import ApiRegistry, FunctionTool, ToolContext
-from io import StringIO
-from typing import Any
-import google.genai.types as types
+from typing import Any, BinaryIO
+import pyarrow as pa
+
+from .artifact_store import run_to_file, save_file_artifact
+from .budget_guard import guard_query_budget
+from .bq_result import normalize_bq_result
+from .csv_writer import CSV_ENCODINGS, resolve_encoding, write_csv
+from .export_executor import ExportQueueFullError, export_executor
+from .export_index import content_key, find_export, record_export, reuse_export, reused_response
+from .lazy_init import LazyToolset, report_import_time, schedule_warmup
+from .metadata_cache import answer_metadata_locally
+from .query_cache import QueryCachingToolset
+from .result_store import capture_execute_sql, fetch_result_page, resolve_result_handle, result_handle_sql
+from .tool_cache import CachedToolset
 
 # プロジェクトID
 PROJECT_ID = "agent-vi-473112"
@@ -15,24 +30,68 @@ header_provider = lambda context: {
     "x-goog-user-project": PROJECT_ID,
 }
 
-# ApiRegistry初期化
-bq_api_registry = ApiRegistry(PROJECT_ID, header_provider=header_provider)
 
-# BigQuery MCP serverのtoolsetを取得
-registry_tools = bq_api_registry.get_toolset(
-    mcp_server_name=MCP_SERVER_NAME
-)
+def _load_registry_toolset():
+    """ApiRegistryからBigQuery MCP serverのtoolsetを取得（ネットワークアクセスあり）"""
+    bq_api_registry = ApiRegistry(PROJECT_ID, header_provider=header_provider)
+    return bq_api_registry.get_toolset(mcp_server_name=MCP_SERVER_NAME)
+
+
+# toolsetの取得は初回のツール呼び出し時（またはウォームアップ時）まで遅らせ、
+# ツール一覧はディスクにキャッシュしてセッション開始ごとの取得を省略する
+# execute_sql は結果キャッシュ（query_cache）を経由して実行する
+_registry_toolset = LazyToolset("api_registry_toolset", _load_registry_toolset)
+registry_tools = QueryCachingToolset(CachedToolset(MCP_SERVER_NAME, _registry_toolset))
+
+
+def _normalize_with_key(data: Any, encoding: str, compress: bool) -> tuple[pa.Table, str]:
+    """データを正規化し、出力内容のキーとあわせて返す（同期処理）"""
+    table = normalize_bq_result(data)
+    return table, content_key(table, format="csv", encoding=encoding, compress=compress)
+
+
+def _build_csv_file(data: Any, encoding: str, compress: bool, fileobj: BinaryIO) -> int | None:
+    """データを正規化してCSVを fileobj に書き込み、行数を返す（同期処理）。データが空の場合は None"""
+    # 型付きの列配列に正規化（schema + rows の場合は列名と型を復元）
+    table = normalize_bq_result(data)
+    if table.num_rows == 0 or table.num_columns == 0:
+        return None
+    
+    # バッチ単位でクォート・エンコード（・圧縮）しながら書き出す
+    return write_csv(table, fileobj, encoding, compress)
 
 
 # CSV出力ツール
 async def export_to_csv(
     tool_context: ToolContext,
-    data: list[dict[str, Any]] | str,
     filename: str,
+    result_handle: str = "",
+    data: list[dict[str, Any]] | dict[str, Any] | str | None = None,
+    encoding: str = "utf-8-sig",
+    compress: bool = False,
 ) -> dict[str, Any]:
-    """データをCSVファイルとしてArtifactに保存する"""
+    """
+    データをCSVファイルとしてArtifactに保存する（execute_sqlのresult_handleを指定可能）
+
+    encoding は "utf-8-sig"（BOM付き、Excel向け）/ "utf-8" / "cp932"（Shift_JIS）。
+    compress=True の場合は gzip 圧縮した .csv.gz として保存する。
+    同じ結果・同じ文字コード・圧縮指定の出力が保存済みの場合は生成を省略して再利用する
+    """
     import json
     
+    codec = resolve_encoding(encoding)
+    if codec is None:
+        return {
+            "success": False,
+            "error": f"未対応の文字コードです: {encoding}（{', '.join(CSV_ENCODINGS)} のいずれか）"
+        }
+    
+    # ハンドル指定時はサーバー側に保存済みの結果を使う
+    if result_handle:
+        data = resolve_result_handle(tool_context, result_handle)
+        if data is None:
+            return {"success": False, "error": f"結果ハンドル '{result_handle}' が見つかりません。"}
+    
     # JSON文字列の場合はパース
     if isinstance(data, str):
         try:
@@ -40,63 +99,81 @@ async def export_to_csv(
         except json.JSONDecodeError:
             return {"success": False, "error": "JSONの解析に失敗しました。"}
     
-    # データがリストでない場合の処理
-    if not isinstance(data, list):
-        if isinstance(data, dict):
-            if "rows" in data:
-                data = data["rows"]
-            elif "result" in data:
-                data = data["result"]
-            else:
-                data = [data]
+    # ファイル名に拡張子がなければ追加
+    extension = ".csv.gz" if compress else ".csv"
+    if filename.endswith(".csv") and compress:
+        filename = f"{filename}.gz"
+    elif not filename.endswith(extension):
+        filename = f"{filename}{extension}"
     
-    if not data:
-        return {"success": False, "error": "保存するデータがありません。"}
-    
-    # CSV作成
-    if isinstance(data[0], dict):
-        headers = list(data[0].keys())
-        lines = [",".join(headers)]
-        for row in data:
-            lines.append(",".join(str(row.get(h, "")) for h in headers))
-        csv_content = "\n".join(lines)
-    else:
-        return {"success": False, "error": "データ形式がサポートされていません。"}
-    
-    # ファイル名に.csvがなければ追加
-    if not filename.endswith(".csv"):
-        filename = f"{filename}.csv"
-    
-    # Artifactとして保存
+    # CSV生成はイベントループの外（export_executor）で一時領域に書き出す
     try:
-        artifact = types.Part.from_bytes(
-            data=csv_content.encode("utf-8"),
-            mime_type="text/csv"
-        )
-        version = await tool_context.save_artifact(filename=filename, artifact=artifact)
-        
-        return {
-            "success": True,
-            "filename": filename,
-            "version": version,
-            "rows": len(data),
-            "message": f"CSVファイル '{filename}' を保存しました"
-        }
-    except Exception as e:
+        (table, key), _ = await export_executor.run(_normalize_with_key, data, codec, compress)
+        cached = find_export(tool_context, key)
+        if cached is not None:
+            reused = await reuse_export(tool_context, cached, filename)
+            if reused:
+                return reused_response(reused)
+        rows, fileobj, queue_wait = await run_to_file(_build_csv_file, table, codec, compress)
+    except ExportQueueFullError as e:
         return {"success": False, "error": str(e)}
-
+    except Exception as e:
+        return {"success": False, "error": f"CSV作成エラー: {str(e)}"}
+    
+    with fileobj:
+        if rows is None:
+            return {"success": False, "error": "保存するデータがありません。"}
+        
+        # Artifactとして保存（大きいファイルはGCSへアップロードして参照を保存）
+        try:
+            saved = await save_file_artifact(
+                tool_context,
+                filename,
+                fileobj,
+                "application/gzip" if compress else "text/csv"
+            )
+            record_export(
+                tool_context, filename, key,
+                format="csv", rows=rows, columns=table.num_columns, encoding=codec,
+                source_query=result_handle_sql(tool_context, result_handle) if result_handle else None,
+                **saved
+            )
+            
+            return {
+                "success": True,
+                "filename": filename,
+                "rows": rows,
+                "encoding": codec,
+                **saved,
+                "queue_wait_ms": round(queue_wait * 1000, 1),
+                "message": f"CSVファイル '{filename}' を保存しました"
+            }
+        except Exception as e:
+            return {"success": False, "error": str(e)}
 
 csv_export_tool = FunctionTool(func=export_to_csv)
+result_page_tool = FunctionTool(func=fetch_result_page)
 
 
 # エージェント定義
 root_agent = Agent(
     name="bigquery_mcp_agent",
     model="gemini-2.5-flash",
-    tools=[registry_tools, csv_export_tool],
+    tools=[registry_tools, result_page_tool, csv_export_tool],
     instruction=f"""あなたはBigQueryの専門家です。
 プロジェクトID '{PROJECT_ID}' をデフォルトとして使用してください。
 
 CSVに出力してと依頼されたら、export_to_csv ツールを使ってください。
+文字コードの指定がなければ encoding は既定（BOM付きUTF-8）のままにし、Shift_JISを求められたら "cp932" を指定してください。圧縮を求められたら compress=true にしてください。
+execute_sqlの応答に含まれる result_handle を export_to_csv に渡してください（結果の行を書き写さないこと）。
+execute_sqlの応答は先頭行のプレビューのみです。続きの行が必要な場合は fetch_result_page を使ってください。
+SELECT * は避けて必要な列だけを選び、パーティション列があれば期間で絞ってください。execute_sql がスキャン量の上限で実行されなかった場合は、suggested_query や notes を参考にSQLを絞り込んで再実行してください。
 """,
-)
\ No newline at end of file
+    before_tool_callback=[answer_metadata_locally, guard_query_budget],
+    after_tool_callback=capture_execute_sql,
+)
+
+
+# 起動後にバックグラウンドでtoolsetを取得しておく
+schedule_warmup(_registry_toolset.resource.get)
+report_import_time(__name__, _IMPORT_STARTED)
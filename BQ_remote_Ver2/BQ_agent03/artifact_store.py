@@ -0,0 +1,179 @@
+"""
+出力ファイルのArtifact保存
+
+ファイル生成は SpooledTemporaryFile（一定サイズまではメモリ、超えたら一時ファイル）に書き出し、
+保存時にサイズで経路を分ける。
+
+- 小さいファイル: これまでどおりバイト列を save_artifact に渡す
+- 大きいファイル: BlobStore（GCS）へ分割（resumable）アップロードし、Artifactには
+  file_data（gs:// の参照）だけを保存する。ファイル全体をメモリ上でコピーしない
+
+- 参照保存に切り替えるサイズ: BQ_LARGE_ARTIFACT_BYTES（既定 8MiB）
+- アップロード先: BQ_ARTIFACT_BUCKET（"gs://bucket/prefix"）。未設定の場合は常にバイト列で保存する
+- アップロードの分割サイズ: BQ_ARTIFACT_CHUNK_BYTES（既定 8MiB。GCSの制約で256KiBの倍数）
+- BQ_ARTIFACT_LOCAL_DIR を指定すると、GCSの代わりにローカルディレクトリへ書き出す（オフラインでの動作確認用）
+
+BlobStore は set_blob_store() で差し替えられる。
+"""
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Protocol
+import google.genai.types as types
+
+from .export_executor import export_executor
+
+logger = logging.getLogger(__name__)
+
+LARGE_ARTIFACT_BYTES = int(os.getenv("BQ_LARGE_ARTIFACT_BYTES", str(8 * 1024 * 1024)))
+ARTIFACT_BUCKET = os.getenv("BQ_ARTIFACT_BUCKET", "")
+ARTIFACT_LOCAL_DIR = os.getenv("BQ_ARTIFACT_LOCAL_DIR", "")
+
+# GCSのresumableアップロードの分割単位は256KiBの倍数にする
+_GCS_CHUNK_UNIT = 256 * 1024
+UPLOAD_CHUNK_BYTES = max(
+    int(os.getenv("BQ_ARTIFACT_CHUNK_BYTES", str(8 * 1024 * 1024))) // _GCS_CHUNK_UNIT, 1
+) * _GCS_CHUNK_UNIT
+
+# 生成中のファイルをメモリ上に保持するサイズの上限（超えると一時ファイルへ書き出す）
+SPOOL_MAX_BYTES = int(os.getenv("BQ_EXPORT_SPOOL_BYTES", str(16 * 1024 * 1024)))
+
+
+class BlobStore(Protocol):
+    """ファイルオブジェクトをアップロードし、参照URIを返すストレージ"""
+
+    def upload(self, fileobj: BinaryIO, object_name: str, content_type: str, size: int) -> str:
+        ...
+
+
+class GcsBlobStore:
+    """GCSへresumableアップロードする BlobStore（UPLOAD_CHUNK_BYTES ずつ送信する）"""
+
+    def __init__(self, bucket_uri: str, chunk_size: int = UPLOAD_CHUNK_BYTES):
+        bucket, _, prefix = bucket_uri.removeprefix("gs://").partition("/")
+        self.bucket_name = bucket
+        self.prefix = f"{prefix.strip('/')}/" if prefix.strip("/") else ""
+        self.chunk_size = chunk_size
+        self._bucket = None
+
+    def _get_bucket(self):
+        if self._bucket is None:
+            from google.cloud import storage
+            self._bucket = storage.Client().bucket(self.bucket_name)
+        return self._bucket
+
+    def upload(self, fileobj: BinaryIO, object_name: str, content_type: str, size: int) -> str:
+        name = f"{self.prefix}{object_name}"
+        blob = self._get_bucket().blob(name, chunk_size=self.chunk_size)
+        blob.upload_from_file(fileobj, size=size, content_type=content_type, rewind=True)
+        return f"gs://{self.bucket_name}/{name}"
+
+
+class LocalBlobStore:
+    """ローカルディレクトリへ書き出す BlobStore（GCSの代わりの動作確認用）"""
+
+    def __init__(self, root: str | Path, chunk_size: int = UPLOAD_CHUNK_BYTES):
+        self.root = Path(root)
+        self.chunk_size = chunk_size
+
+    def upload(self, fileobj: BinaryIO, object_name: str, content_type: str, size: int) -> str:
+        path = self.root / object_name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fileobj.seek(0)
+        with open(path, "wb") as out:
+            shutil.copyfileobj(fileobj, out, self.chunk_size)
+        return path.resolve().as_uri()
+
+
+_blob_store: BlobStore | None = None
+_blob_store_configured = False
+
+
+def get_blob_store() -> BlobStore | None:
+    """環境変数に応じた BlobStore（未設定の場合は None）"""
+    global _blob_store, _blob_store_configured
+    if not _blob_store_configured:
+        if ARTIFACT_LOCAL_DIR:
+            _blob_store = LocalBlobStore(ARTIFACT_LOCAL_DIR)
+        elif ARTIFACT_BUCKET:
+            _blob_store = GcsBlobStore(ARTIFACT_BUCKET)
+        _blob_store_configured = True
+    return _blob_store
+
+
+def set_blob_store(store: BlobStore | None) -> None:
+    """BlobStore を差し替える（None で参照保存を無効にする）"""
+    global _blob_store, _blob_store_configured
+    _blob_store = store
+    _blob_store_configured = True
+
+
+def spooled_file() -> tempfile.SpooledTemporaryFile:
+    """出力ファイルの書き込み先"""
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+
+
+def _write_to_path(func: Callable[..., Any], path: str, args: tuple) -> Any:
+    """process モード用: ワーカー側でパスを開いて func(*args, fileobj) を実行する"""
+    with open(path, "wb") as fileobj:
+        return func(*args, fileobj)
+
+
+async def run_to_file(func: Callable[..., Any], *args: Any, process: bool = False) -> tuple[Any, BinaryIO, float]:
+    """
+    func(*args, fileobj) を export_executor で実行し、(戻り値, 書き込んだファイル, キュー待ち時間) を返す
+
+    process モード（または process=True）ではファイルオブジェクトを渡せないため、一時ファイルのパスを渡す。
+    呼び出し側は返されたファイルを close すること
+    """
+    if not process and export_executor.kind != "process":
+        fileobj = spooled_file()
+        try:
+            result, queue_wait = await export_executor.run(func, *args, fileobj)
+        except BaseException:
+            fileobj.close()
+            raise
+        return result, fileobj, queue_wait
+
+    fd, path = tempfile.mkstemp(prefix="bq-export-")
+    os.close(fd)
+    try:
+        result, queue_wait = await export_executor.run(_write_to_path, func, path, args, process=True)
+        fileobj = open(path, "rb")
+    finally:
+        # 開いたファイルは unlink 後も読める（close 時に領域が解放される）
+        os.unlink(path)
+    return result, fileobj, queue_wait
+
+
+async def save_file_artifact(
+    tool_context: Any,
+    filename: str,
+    fileobj: BinaryIO,
+    mime_type: str
+) -> dict[str, Any]:
+    """
+    ファイルをArtifactとして保存し、{"version", "size_bytes", "storage"[, "uri"]} を返す
+
+    LARGE_ARTIFACT_BYTES 以上で BlobStore がある場合は BlobStore へアップロードし、
+    Artifactには参照（file_data）を保存する（storage="reference"）。それ以外はバイト列で保存する（storage="inline"）
+    """
+    size = fileobj.seek(0, os.SEEK_END)
+    fileobj.seek(0)
+    store = get_blob_store()
+
+    if store is None or size < LARGE_ARTIFACT_BYTES:
+        artifact = types.Part.from_bytes(data=fileobj.read(), mime_type=mime_type)
+        version = await tool_context.save_artifact(filename=filename, artifact=artifact)
+        return {"version": version, "size_bytes": size, "storage": "inline"}
+
+    object_name = f"exports/{uuid.uuid4().hex}/{filename}"
+    uri = await asyncio.to_thread(store.upload, fileobj, object_name, mime_type, size)
+    logger.info(f"Uploaded artifact {filename} ({size} bytes) to {uri}")
+    artifact = types.Part(file_data=types.FileData(file_uri=uri, mime_type=mime_type))
+    version = await tool_context.save_artifact(filename=filename, artifact=artifact)
+    return {"version": version, "size_bytes": size, "storage": "reference", "uri": uri}
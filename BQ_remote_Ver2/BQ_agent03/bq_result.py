@@ -0,0 +1,310 @@
+"""
+BigQuery結果の列指向正規化
+
+execute_sql の結果（schema + rows / {"f": [{"v": ...}]} 行 / 辞書リスト）を
+行ごとの辞書を作らずに型付きの列配列（pyarrow.Table）へ変換する。
+
+- INT64 / FLOAT64 / BOOL / DATE / DATETIME / TIME / TIMESTAMP は列単位で一括変換する
+- NUMERIC / BIGNUMERIC は浮動小数点数を経由せず10進数型（decimal128 / decimal256）にする
+- STRUCT(RECORD) はスキーマに従って "親.子" 列へ展開する
+- ARRAY(REPEATED) は要素型を保ったリスト列にする
+"""
+import json
+from decimal import Decimal
+from typing import Any, Iterator
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+# BigQueryのスカラー型 → Arrow型
+_BQ_SCALAR_TYPES = {
+    "INTEGER": pa.int64(),
+    "INT64": pa.int64(),
+    "FLOAT": pa.float64(),
+    "FLOAT64": pa.float64(),
+    "NUMERIC": pa.decimal128(38, 9),
+    "BIGNUMERIC": pa.decimal256(76, 38),
+    "BOOLEAN": pa.bool_(),
+    "BOOL": pa.bool_(),
+    "DATE": pa.date32(),
+    "DATETIME": pa.timestamp("us"),
+    "TIME": pa.time64("us"),
+    "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+}
+
+_RECORD_TYPES = ("RECORD", "STRUCT")
+
+# Excelの数値（倍精度浮動小数点数）で表せる有効桁数
+EXCEL_SIGNIFICANT_DIGITS = 15
+
+# 行イテレーション時のバッチサイズ
+ROW_BATCH_SIZE = 10_000
+
+
+def _unwrap(val: Any) -> Any:
+    """{'v': value} 形式のラッパーを外す"""
+    while isinstance(val, dict) and len(val) == 1 and "v" in val:
+        val = val["v"]
+    return val
+
+
+def _to_text(val: Any) -> str | None:
+    """変換できない値をテキスト化する（入れ子はJSONとして保持）"""
+    if val is None:
+        return None
+    if isinstance(val, (dict, list)):
+        return json.dumps(val, ensure_ascii=False, default=str)
+    return str(val)
+
+
+def _timestamp_array(arr: pa.Array) -> pa.Array:
+    """
+    TIMESTAMP列を変換する
+
+    BigQuery REST形式のエポック秒（"1.7052E9" など）とISO 8601文字列の両方を受け付ける。
+    エポック秒の文字列は10進数として読み、浮動小数点数を経由せずにマイクロ秒の整数にする
+    """
+    target = _BQ_SCALAR_TYPES["TIMESTAMP"]
+    if pa.types.is_integer(arr.type):
+        return pc.multiply(arr.cast(pa.int64()), 1_000_000).cast(target)
+    if pa.types.is_floating(arr.type):
+        # JSONの数値として受け取った値はすでに浮動小数点数のため、丸めて変換する
+        micros = pc.round(pc.multiply(arr, 1_000_000))
+        return micros.cast(pa.int64()).cast(target)
+    text = arr.cast(pa.string())
+    try:
+        # 精度18桁（約1兆秒まで）にしておくと、10^6 を掛けても decimal128 の範囲に収まる
+        seconds = text.cast(pa.decimal128(18, 6))
+        micros = pc.multiply(seconds, pa.scalar(Decimal(1_000_000), pa.decimal128(7, 0)))
+        return micros.cast(pa.int64()).cast(target)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        pass
+    # "2024-01-01 00:00:00 UTC" 形式はタイムゾーン表記をZに揃えてから変換する
+    text = pc.replace_substring_regex(text, r"\s*UTC$", "Z")
+    return text.cast(target)
+
+
+def _time_array(arr: pa.Array) -> pa.Array:
+    """TIME列（"HH:MM:SS[.ffffff]"）を日付を補ってから時刻型に変換する"""
+    stamped = pc.binary_join_element_wise("1970-01-01T", arr.cast(pa.string()), "")
+    return stamped.cast(pa.timestamp("us")).cast(_BQ_SCALAR_TYPES["TIME"])
+
+
+def _scalar_array(values: list[Any], bq_type: str) -> pa.Array:
+    """スカラー列を一括で型変換する。変換できない場合は文字列列にする"""
+    target = _BQ_SCALAR_TYPES.get(bq_type)
+    values = [_unwrap(v) for v in values]
+    try:
+        arr = pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        arr = pa.array([_to_text(v) for v in values], pa.string())
+
+    if target is None:
+        # STRING / BYTES / GEOGRAPHY / JSON など
+        if pa.types.is_null(arr.type) or pa.types.is_string(arr.type):
+            return arr.cast(pa.string())
+        return pa.array([_to_text(v) for v in values], pa.string())
+
+    if arr.type == target:
+        return arr
+    try:
+        if bq_type == "TIMESTAMP" and not pa.types.is_timestamp(arr.type):
+            return _timestamp_array(arr)
+        if bq_type == "TIME" and pa.types.is_string(arr.type):
+            return _time_array(arr)
+        return arr.cast(target)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        return pa.array([_to_text(v) for v in values], pa.string())
+
+
+def _field_array(values: list[Any], field: dict[str, Any]) -> pa.Array:
+    """スキーマの1フィールド分の値をArrow配列に変換する（STRUCT/ARRAYは再帰）"""
+    bq_type = str(field.get("type", "STRING")).upper()
+    mode = str(field.get("mode", "NULLABLE")).upper()
+
+    if mode == "REPEATED":
+        offsets = [0]
+        flat: list[Any] = []
+        for val in values:
+            val = _unwrap(val)
+            if val:
+                flat.extend(_unwrap(item) for item in val)
+            offsets.append(len(flat))
+        element_field = {**field, "mode": "NULLABLE"}
+        return pa.ListArray.from_arrays(
+            pa.array(offsets, pa.int32()),
+            _field_array(flat, element_field)
+        )
+
+    if bq_type in _RECORD_TYPES:
+        subfields = field.get("fields", [])
+        names = [f.get("name", f"column_{i}") for i, f in enumerate(subfields)]
+        children: list[list[Any]] = [[] for _ in subfields]
+        mask = []
+        for val in values:
+            val = _unwrap(val)
+            if val is None:
+                mask.append(True)
+                for child in children:
+                    child.append(None)
+                continue
+            mask.append(False)
+            if isinstance(val, dict) and "f" in val:
+                val = val["f"]
+            for i, child in enumerate(children):
+                if isinstance(val, dict):
+                    child.append(val.get(names[i]))
+                else:
+                    child.append(val[i] if i < len(val) else None)
+        if not subfields:
+            return pa.array([_to_text(_unwrap(v)) for v in values], pa.string())
+        arrays = [_field_array(child, sub) for child, sub in zip(children, subfields)]
+        return pa.StructArray.from_arrays(arrays, names=names, mask=pa.array(mask, pa.bool_()))
+
+    return _scalar_array(values, bq_type)
+
+
+def _inferred_array(values: list[Any]) -> pa.Array:
+    """スキーマがない列をArrowの型推論で変換する。混在型は文字列列にする"""
+    values = [_unwrap(v) for v in values]
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([_to_text(v) for v in values], pa.string())
+
+
+def _flatten_structs(table: pa.Table) -> pa.Table:
+    """STRUCT列を "親.子" 列へ展開する（入れ子がなくなるまで繰り返す）"""
+    while any(pa.types.is_struct(col.type) for col in table.columns):
+        table = table.flatten()
+    return table
+
+
+def _row_cells(row: Any) -> list[Any]:
+    """f/v 行またはリスト行からセル値のリストを取り出す"""
+    if isinstance(row, dict) and "f" in row:
+        return row["f"]
+    if isinstance(row, (list, tuple)):
+        return list(row)
+    return [row]
+
+
+def _columns_from_rows(rows: list[Any], names: list[str]) -> list[list[Any]]:
+    """行の並びを列ごとの値リストへ転置する"""
+    columns: list[list[Any]] = [[] for _ in names]
+    for row in rows:
+        if isinstance(row, dict) and "f" not in row:
+            for name, column in zip(names, columns):
+                column.append(row.get(name))
+        else:
+            cells = _row_cells(row)
+            for i, column in enumerate(columns):
+                column.append(cells[i] if i < len(cells) else None)
+    return columns
+
+
+def _dict_row_names(rows: list[dict[str, Any]]) -> list[str]:
+    """辞書リストの列名を出現順に集める"""
+    names = dict.fromkeys(rows[0].keys())
+    for row in rows[1:]:
+        if row.keys() != names.keys():
+            names.update(dict.fromkeys(row.keys()))
+    return [str(name) for name in names]
+
+
+def rows_to_table(rows: list[Any], fields: list[dict[str, Any]] | None = None) -> pa.Table:
+    """
+    行リストと（あれば）schema.fields から pyarrow.Table を作る
+
+    Args:
+        rows: f/v 行、リスト行、または辞書行のリスト
+        fields: BigQueryの schema.fields（省略時は型推論）
+    """
+    if fields:
+        names = [f.get("name", f"column_{i}") for i, f in enumerate(fields)]
+        columns = _columns_from_rows(rows, names)
+        arrays = [_field_array(col, field) for col, field in zip(columns, fields)]
+        return _flatten_structs(pa.Table.from_arrays(arrays, names=names))
+
+    if not rows:
+        return pa.table({})
+
+    first_row = rows[0]
+    if isinstance(first_row, dict) and "f" not in first_row and "v" not in first_row:
+        names = _dict_row_names(rows)
+    else:
+        width = max(len(_row_cells(row)) for row in rows)
+        names = [f"column_{i}" for i in range(width)]
+
+    columns = _columns_from_rows(rows, names)
+    arrays = [_inferred_array(col) for col in columns]
+    return _flatten_structs(pa.Table.from_arrays(arrays, names=names))
+
+
+def normalize_bq_result(data: Any) -> pa.Table:
+    """
+    BigQueryの様々な結果形式を列指向の pyarrow.Table に変換する
+    """
+    if not data:
+        return pa.table({})
+
+    if isinstance(data, pa.Table):
+        return data
+
+    if isinstance(data, dict):
+        if "rows" in data or "schema" in data:
+            schema = data.get("schema") or {}
+            return rows_to_table(data.get("rows") or [], schema.get("fields") or None)
+        if isinstance(data.get("result"), (list, dict)):
+            return normalize_bq_result(data["result"])
+        return rows_to_table([data])
+
+    if isinstance(data, list):
+        return rows_to_table(data)
+
+    return pa.table({})
+
+
+def _decimal_cell(value: Decimal | None) -> float | str | None:
+    """
+    10進数の値をセルの値にする
+
+    Excelの数値で正確に表せる桁数なら数値、それを超える場合は桁を落とさないよう文字列にする
+    """
+    if value is None:
+        return None
+    text = format(value, "f")
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    if len(text.lstrip("-").replace(".", "").lstrip("0")) <= EXCEL_SIGNIFICANT_DIGITS:
+        return float(text)
+    return text
+
+
+def _cell_values(column: pa.Array | pa.ChunkedArray) -> list[Any]:
+    """列をセルに書ける Python 値のリストに変換する"""
+    col_type = column.type
+    if pa.types.is_timestamp(col_type) and col_type.tz is not None:
+        # Excelはタイムゾーン付き日時を扱えないためUTCのnaive日時にする
+        column = column.cast(pa.timestamp(col_type.unit))
+    elif pa.types.is_decimal(col_type):
+        return [_decimal_cell(v) for v in column.to_pylist()]
+    elif pa.types.is_nested(col_type):
+        return [_to_text(v) for v in column.to_pylist()]
+    return column.to_pylist()
+
+
+def iter_batch_rows(batch: pa.RecordBatch) -> Iterator[tuple[Any, ...]]:
+    """RecordBatch の列を行タプルへ変換しながら返す"""
+    columns = [_cell_values(col) for col in batch.columns]
+    return zip(*columns)
+
+
+def iter_table_rows(table: pa.Table, batch_size: int = ROW_BATCH_SIZE) -> Iterator[tuple[Any, ...]]:
+    """
+    pyarrow.Table をバッチ単位で列から行タプルへ変換しながら返す
+
+    行辞書は作らず、書き込み側（Excel/CSV）へそのまま流せる形にする
+    """
+    for batch in table.to_batches(max_chunksize=batch_size):
+        yield from iter_batch_rows(batch)
@@ -0,0 +1,83 @@
+"""
+ストリーミングCSVライター
+
+正規化済みの列配列（pyarrow.Table）をバッチ単位で行に変換し、RFC 4180 に従って
+（カンマ・ダブルクォート・改行を含む値はクォートし、行末は CRLF）エンコード済みのチャンクとして返す。
+全行の文字列を一度に作らないため、作業用のメモリは行数によらず1バッチ分で済む。
+
+- 文字コード: "utf-8-sig"（BOM付きUTF-8、既定。日本語版Excelでそのまま開ける）/ "utf-8" / "cp932"（Shift_JIS）
+- cp932 で表せない文字は "?" に置き換える
+- gzip圧縮しながら書き込むこともできる
+"""
+import codecs
+import csv
+import gzip
+import io
+from typing import BinaryIO, Iterator
+import pyarrow as pa
+
+from .bq_result import ROW_BATCH_SIZE, iter_batch_rows
+
+# 指定できる文字コード（別名 → Pythonのコーデック名）
+CSV_ENCODINGS = {
+    "utf-8-sig": "utf-8-sig",
+    "utf-8": "utf-8",
+    "utf8": "utf-8",
+    "cp932": "cp932",
+    "shift-jis": "cp932",
+    "sjis": "cp932",
+}
+
+def resolve_encoding(encoding: str) -> str | None:
+    """文字コード名をコーデック名にする。未対応の場合は None"""
+    return CSV_ENCODINGS.get(encoding.lower().replace("_", "-"))
+
+
+def iter_csv_chunks(
+    table: pa.Table,
+    encoding: str = "utf-8-sig",
+    batch_size: int = ROW_BATCH_SIZE
+) -> Iterator[bytes]:
+    """
+    ヘッダー行とデータ行をバッチ単位でエンコード済みのチャンクとして返す
+
+    Args:
+        table: 正規化済みの結果
+        encoding: コーデック名（resolve_encoding の戻り値）
+        batch_size: 1チャンクあたりの行数
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\r\n")
+    # インクリメンタルエンコーダーを使うため、utf-8-sig のBOMは先頭に1回だけ付く
+    encoder = codecs.getincrementalencoder(encoding)(errors="replace")
+
+    def flush(final: bool = False) -> bytes:
+        chunk = encoder.encode(buffer.getvalue(), final)
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    writer.writerow(table.column_names)
+    for batch in table.to_batches(max_chunksize=batch_size):
+        # NULL（None）は空欄として書き込まれる
+        writer.writerows(iter_batch_rows(batch))
+        yield flush()
+    yield flush(final=True)
+
+
+def write_csv(table: pa.Table, fileobj: BinaryIO, encoding: str = "utf-8-sig", compress: bool = False) -> int:
+    """
+    CSVをファイルへ書き込み、書き込んだ行数を返す（同期処理）
+
+    compress=True の場合は gzip 圧縮しながら書き込む
+    """
+    sink: BinaryIO = gzip.GzipFile(fileobj=fileobj, mode="wb", mtime=0) if compress else fileobj
+    try:
+        for chunk in iter_csv_chunks(table, encoding):
+            if chunk:
+                sink.write(chunk)
+    finally:
+        if compress:
+            sink.close()
+    return table.num_rows
+
@@ -0,0 +1,139 @@
+"""
+出力ファイルの索引と内容による再利用
+
+出力ツールが保存したファイルのメタデータ（サイズ・行数・列数・形式・作成日時・元のSQL）を
+セッションstateの索引に記録し、list_saved_files はArtifact本体を読まずに索引から一覧を返す。
+
+同じ結果を同じオプションで出力し直す場合は、ファイルを生成し直さずに既存のArtifactを再利用する。
+キーは正規化済みの結果（Arrow IPC）と出力オプションのハッシュ（BLAKE2b）。
+
+- 索引のstateキー: "export_index"（{ファイル名: メタデータ}）
+- 再利用を無効にする: BQ_EXPORT_DEDUP=0
+"""
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Any
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+STATE_KEY = "export_index"
+
+EXPORT_DEDUP_ENABLED = os.getenv("BQ_EXPORT_DEDUP", "1") != "0"
+
+# ハッシュ計算時にまとめる行数（チャンクの切れ目によらず同じキーになるよう、一定の行数ごとに連結する）
+HASH_WINDOW_ROWS = 65_536
+
+
+class _DigestSink:
+    """書き込まれたバイト列をハッシュに流すだけのファイルオブジェクト"""
+
+    def __init__(self, digest: Any):
+        self.digest = digest
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        self.digest.update(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def content_key(data: pa.Table | str, **options: Any) -> str:
+    """
+    出力内容のキー（同期処理）
+
+    Args:
+        data: 正規化済みの結果、または結果JSON文字列
+        options: 出力形式・シート名・文字コードなど、出力ファイルの中身に影響するオプション
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps(options, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+    if isinstance(data, str):
+        digest.update(b"json:")
+        digest.update(data.encode("utf-8"))
+        return digest.hexdigest()
+
+    digest.update(b"arrow:")
+    with pa.ipc.new_stream(_DigestSink(digest), data.schema) as writer:
+        for start in range(0, data.num_rows, HASH_WINDOW_ROWS):
+            window = data.slice(start, HASH_WINDOW_ROWS)
+            writer.write_batch(pa.RecordBatch.from_arrays(
+                [pa.concat_arrays(column.chunks) for column in window.columns],
+                schema=data.schema
+            ))
+    return digest.hexdigest()
+
+
+def _index(tool_context: Any) -> dict[str, dict[str, Any]]:
+    state = getattr(tool_context, "state", None)
+    if state is None:
+        return {}
+    return dict(state.get(STATE_KEY) or {})
+
+
+def find_export(tool_context: Any, key: str) -> dict[str, Any] | None:
+    """同じキーで保存済みのファイルの索引エントリ（最も新しいもの）"""
+    if not EXPORT_DEDUP_ENABLED:
+        return None
+    matches = [entry for entry in _index(tool_context).values() if entry.get("content_key") == key]
+    return max(matches, key=lambda entry: entry.get("created_at", ""), default=None)
+
+
+def record_export(tool_context: Any, filename: str, key: str | None = None, **metadata: Any) -> dict[str, Any]:
+    """保存したファイルを索引に記録し、記録したエントリを返す"""
+    entry = {
+        "filename": filename,
+        **metadata,
+        "content_key": key,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }
+    state = getattr(tool_context, "state", None)
+    if state is not None:
+        # stateの変更として記録されるよう、辞書を作り直して代入する
+        state[STATE_KEY] = {**_index(tool_context), filename: entry}
+    return entry
+
+
+async def reuse_export(tool_context: Any, entry: dict[str, Any], filename: str) -> dict[str, Any] | None:
+    """
+    保存済みのファイルを filename として再利用し、索引エントリを返す
+
+    同じファイル名なら何もしない。別のファイル名の場合は既存のArtifact（参照保存ならURIのみ）を
+    新しいファイル名で保存し直す。元のArtifactが見つからない場合は None
+    """
+    if entry["filename"] == filename:
+        return entry
+    try:
+        artifact = await tool_context.load_artifact(filename=entry["filename"], version=entry.get("version"))
+    except Exception as e:
+        logger.info(f"Export reuse skipped: {e}")
+        return None
+    if artifact is None:
+        return None
+    version = await tool_context.save_artifact(filename=filename, artifact=artifact)
+    metadata = {k: v for k, v in entry.items() if k not in ("filename", "created_at", "content_key", "version")}
+    return record_export(tool_context, filename, entry.get("content_key"), version=version, **metadata)
+
+
+def list_exports(tool_context: Any) -> list[dict[str, Any]]:
+    """索引のエントリを新しい順に返す（内部用のキーは除く）"""
+    entries = sorted(_index(tool_context).values(), key=lambda entry: entry.get("created_at", ""), reverse=True)
+    return [{k: v for k, v in entry.items() if k != "content_key"} for entry in entries]
+
+
+def reused_response(entry: dict[str, Any]) -> dict[str, Any]:
+    """再利用した場合のツールの応答"""
+    return {
+        "success": True,
+        **{k: v for k, v in entry.items() if k != "content_key"},
+        "reused": True,
+        "message": f"同じ内容のファイルがあるため生成を省略し、'{entry['filename']}' として保存済みのファイルを再利用しました",
+    }
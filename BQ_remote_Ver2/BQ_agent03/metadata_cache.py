@@ -0,0 +1,274 @@
+"""
+データセット/テーブル情報のキャッシュ
+
+list_dataset_ids → list_table_ids → get_table_info（テーブルごと）と続く
+MCPの往復を減らすため、データセット単位で INFORMATION_SCHEMA からテーブルと列を一括取得し、
+プロセス内の全セッションで共有するTTLキャッシュに保持する。
+
+- before_tool_callback（answer_metadata_locally）で3つのツールにキャッシュから応答する
+- TTL: BQ_METADATA_TTL_SECONDS（既定 600秒）
+- キャッシュから答えられない場合（取得失敗、未知のテーブルなど）は通常どおりMCPツールを実行する
+- get_table_info は、キャッシュで揃えられる項目（列・行数・サイズ・説明）だけで足りる通常のテーブルに限って応答する。
+  パーティション分割（分割の種類を取得しない）、STRUCT列（入れ子の列を取得しない）、ビューなどはMCPツールに任せる
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Protocol
+
+logger = logging.getLogger(__name__)
+
+# プロジェクトID（引数で指定がない場合に使う）
+PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "agent-vi-473112")
+
+METADATA_TTL_SECONDS = float(os.getenv("BQ_METADATA_TTL_SECONDS", "600"))
+
+# キャッシュから応答する対象のツール名
+METADATA_TOOLS = ("list_dataset_ids", "list_table_ids", "get_table_info")
+
+# データセット内の全テーブルと列を1回で取得するクエリ
+_DATASET_SCHEMA_SQL = """
+SELECT
+  t.table_name,
+  t.table_type,
+  t.creation_time,
+  s.row_count,
+  s.size_bytes,
+  o.option_value AS description,
+  c.column_name,
+  c.data_type,
+  c.is_nullable,
+  c.is_partitioning_column,
+  c.clustering_ordinal_position
+FROM `{project}.{dataset}`.INFORMATION_SCHEMA.TABLES AS t
+LEFT JOIN `{project}.{dataset}.__TABLES__` AS s
+  ON s.table_id = t.table_name
+LEFT JOIN `{project}.{dataset}`.INFORMATION_SCHEMA.TABLE_OPTIONS AS o
+  ON o.table_name = t.table_name AND o.option_name = 'description'
+LEFT JOIN `{project}.{dataset}`.INFORMATION_SCHEMA.COLUMNS AS c
+  ON c.table_name = t.table_name
+ORDER BY t.table_name, c.ordinal_position
+"""
+
+
+class MetadataClient(Protocol):
+    """データセット一覧とデータセット内のスキーマを返すクライアント"""
+
+    def list_datasets(self, project: str) -> list[str]:
+        ...
+
+    def dataset_schema(self, project: str, dataset: str) -> list[dict[str, Any]]:
+        """_DATASET_SCHEMA_SQL の結果行（列名 → 値）"""
+        ...
+
+
+class BigQueryMetadataClient:
+    """google-cloud-bigquery を使う MetadataClient"""
+
+    def __init__(self, project_id: str = PROJECT_ID):
+        self.project_id = project_id
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            from google.cloud import bigquery
+            self._client = bigquery.Client(project=self.project_id)
+        return self._client
+
+    def list_datasets(self, project: str) -> list[str]:
+        return [ds.dataset_id for ds in self._get_client().list_datasets(project=project)]
+
+    def dataset_schema(self, project: str, dataset: str) -> list[dict[str, Any]]:
+        sql = _DATASET_SCHEMA_SQL.format(project=project, dataset=dataset)
+        return [dict(row.items()) for row in self._get_client().query(sql).result()]
+
+
+def _option_text(value: Any) -> str | None:
+    """TABLE_OPTIONS の option_value（文字列リテラル）を文字列に戻す"""
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value.strip('"')
+
+
+def _column_field(column: str, data_type: str | None, is_nullable: str | None) -> dict[str, Any]:
+    """列の型から get_table_info の列情報を作る（ARRAY<T> は型 T の REPEATED 列）"""
+    data_type = data_type or ""
+    if data_type.startswith("ARRAY<"):
+        return {"name": column, "type": data_type[len("ARRAY<"):-1], "mode": "REPEATED"}
+    return {"name": column, "type": data_type, "mode": "NULLABLE" if is_nullable == "YES" else "REQUIRED"}
+
+
+def _build_tables(project: str, dataset: str, rows: list[dict[str, Any]]) -> dict[str, dict[str, Any]]:
+    """INFORMATION_SCHEMA の行をテーブル単位の情報（get_table_info 相当）にまとめる"""
+    tables: dict[str, dict[str, Any]] = {}
+    clustering: dict[str, list[tuple[int, str]]] = {}
+    for row in rows:
+        name = row["table_name"]
+        table = tables.get(name)
+        if table is None:
+            created = row.get("creation_time")
+            table = tables[name] = {
+                "tableReference": {"projectId": project, "datasetId": dataset, "tableId": name},
+                "type": row.get("table_type"),
+                "creationTime": created.isoformat() if hasattr(created, "isoformat") else created,
+                "schema": {"fields": []},
+            }
+            # tables.get と同じく、行数・サイズは文字列で返す
+            if row.get("row_count") is not None:
+                table["numRows"] = str(row["row_count"])
+                table["numBytes"] = str(row.get("size_bytes") or 0)
+            description = _option_text(row.get("description"))
+            if description:
+                table["description"] = description
+        column = row.get("column_name")
+        if column is None:
+            continue
+        table["schema"]["fields"].append(_column_field(column, row.get("data_type"), row.get("is_nullable")))
+        if row.get("is_partitioning_column") == "YES":
+            table["partitioning"] = {"field": column}
+        if row.get("clustering_ordinal_position"):
+            clustering.setdefault(name, []).append((row["clustering_ordinal_position"], column))
+
+    for name, fields in clustering.items():
+        tables[name]["clustering"] = {"fields": [column for _, column in sorted(fields)]}
+    return tables
+
+
+class _Entry:
+    __slots__ = ("value", "fetched_at")
+
+    def __init__(self, value: Any):
+        self.value = value
+        self.fetched_at = time.time()
+
+
+class MetadataCache:
+    """プロジェクトのデータセット一覧とデータセット内のスキーマを保持するTTLキャッシュ"""
+
+    def __init__(self, client: MetadataClient | None = None, ttl_seconds: float = METADATA_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._client = client
+        self._datasets: dict[str, _Entry] = {}
+        self._schemas: dict[tuple[str, str], _Entry] = {}
+        self._locks: dict[Any, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    @property
+    def client(self) -> MetadataClient:
+        if self._client is None:
+            self._client = BigQueryMetadataClient()
+        return self._client
+
+    def set_client(self, client: MetadataClient | None) -> None:
+        """MetadataClient を差し替える（None で既定に戻す）"""
+        self._client = client
+
+    def invalidate(self) -> None:
+        """キャッシュをすべて破棄する"""
+        self._datasets.clear()
+        self._schemas.clear()
+
+    def _fresh(self, entry: _Entry | None) -> bool:
+        return entry is not None and time.time() - entry.fetched_at < self.ttl_seconds
+
+    def _lock_for(self, key: Any) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _cached(self, store: dict, key: Any, fetch) -> _Entry:
+        """新しいエントリを返す（期限切れなら取得する。同じキーの取得は1回にまとめる）"""
+        entry = store.get(key)
+        if self._fresh(entry):
+            return entry
+        with self._lock_for(key):
+            entry = store.get(key)
+            if not self._fresh(entry):
+                started = time.perf_counter()
+                entry = store[key] = _Entry(fetch())
+                logger.info(f"Metadata fetched for {key} in {(time.perf_counter() - started) * 1000:.1f}ms")
+        return entry
+
+    def datasets(self, project: str) -> _Entry:
+        return self._cached(self._datasets, project, lambda: sorted(self.client.list_datasets(project)))
+
+    def tables(self, project: str, dataset: str) -> _Entry:
+        return self._cached(
+            self._schemas,
+            (project, dataset),
+            lambda: _build_tables(project, dataset, self.client.dataset_schema(project, dataset))
+        )
+
+    def answer(self, tool_name: str, args: dict[str, Any]) -> dict[str, Any] | None:
+        """ツール呼び出しにキャッシュから応答する（答えられない場合は None）"""
+        project = _arg(args, "project_id", "projectId") or PROJECT_ID
+        dataset = _arg(args, "dataset_id", "datasetId")
+
+        if tool_name == "list_dataset_ids":
+            entry = self.datasets(project)
+            return _cached_response({"datasets": entry.value}, entry)
+        if not dataset:
+            return None
+
+        entry = self.tables(project, dataset)
+        if tool_name == "list_table_ids":
+            return _cached_response({"tables": sorted(entry.value)}, entry)
+
+        table = entry.value.get(_arg(args, "table_id", "tableId"))
+        if tool_name == "get_table_info" and table is not None and _answerable(table):
+            return _cached_response(table, entry)
+        return None
+
+
+def _answerable(table: dict[str, Any]) -> bool:
+    """キャッシュの情報だけで get_table_info に答えられるか"""
+    return (
+        table.get("type") == "BASE TABLE"
+        and "numRows" in table
+        and "partitioning" not in table
+        and not any(field["type"].startswith("STRUCT") for field in table["schema"]["fields"])
+    )
+
+
+def _arg(args: dict[str, Any], *names: str) -> str | None:
+    for name in names:
+        if args.get(name):
+            return args[name]
+    return None
+
+
+def _cached_response(result: dict[str, Any], entry: _Entry) -> dict[str, Any]:
+    return {
+        **result,
+        "metadata_source": "INFORMATION_SCHEMA (cached)",
+        "metadata_age_seconds": round(time.time() - entry.fetched_at, 1),
+    }
+
+
+# プロセス全体で共有するキャッシュ
+metadata_cache = MetadataCache()
+
+
+async def answer_metadata_locally(
+    tool: Any,
+    args: dict[str, Any],
+    tool_context: Any,
+) -> dict[str, Any] | None:
+    """
+    before_tool_callback: データセット/テーブル情報のツールにキャッシュから応答する
+
+    dict を返すとMCPツールは実行されない。None の場合は通常どおり実行する
+    """
+    tool_name = getattr(tool, "name", None)
+    if tool_name not in METADATA_TOOLS:
+        return None
+    try:
+        return await asyncio.to_thread(metadata_cache.answer, tool_name, args)
+    except Exception as e:
+        logger.info(f"Metadata cache skipped for {tool_name}: {e}")
+        return None
@@ -0,0 +1,356 @@
+"""
+execute_sql の結果キャッシュ
+
+同じ集計クエリの繰り返し（毎日のKPI確認など）で BigQuery を再実行しないよう、
+MCPツールセットの execute_sql を結果キャッシュ付きのツールに差し替える。
+
+- キー: 正規化したSQL + 引数 + 参照テーブルの最終更新時刻
+  （テーブルが更新されるとキーが変わり、古い結果は使われずにLRUで押し出される）
+- 上限: BQ_QUERY_CACHE_MAX_BYTES（既定 128MB）を超えたら古い順に破棄、
+  BQ_QUERY_CACHE_TTL_SECONDS（既定 24時間）を過ぎた結果は使わない
+- 同じキーの同時実行は1回の実行を共有する（single-flight）
+- 応答の "cache" にヒット/ミス/破棄件数を載せる
+
+参照テーブルを特定できないクエリ、乱数や現在時刻を使うクエリ、SELECT以外の文はキャッシュしない。
+ビュー・マテリアライズドビュー・外部テーブルなど、元データが変わっても最終更新時刻が変わらない
+テーブルを参照するクエリもキャッシュしない。
+結果はプロセス内で共有するため、同一の認証情報で実行される前提とする。
+"""
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Protocol
+
+from google.adk.tools.base_tool import BaseTool
+from google.adk.tools.base_toolset import BaseToolset
+
+logger = logging.getLogger(__name__)
+
+# プロジェクトID（データセット名だけのテーブル参照に補う）
+PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "agent-vi-473112")
+
+QUERY_CACHE_MAX_BYTES = int(os.getenv("BQ_QUERY_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("BQ_QUERY_CACHE_TTL_SECONDS", str(24 * 3600)))
+
+# テーブルの最終更新時刻を再確認するまでの秒数
+TABLE_VERSION_TTL_SECONDS = float(os.getenv("BQ_TABLE_VERSION_TTL_SECONDS", "30"))
+
+# キャッシュ対象のツール名
+CACHED_QUERY_TOOLS = ("execute_sql",)
+
+_QUOTED = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)", re.DOTALL)
+_COMMENT = re.compile(r"--[^\n]*|#[^\n]*|/\*.*?\*/", re.DOTALL)
+_TABLE_REF = re.compile(
+    r"\b(?:FROM|JOIN)\s+(`[^`]+`|[A-Za-z_][\w\-]*(?:\.[A-Za-z_][\w\-]*){1,2})",
+    re.IGNORECASE
+)
+_READ_ONLY = re.compile(r"^\s*\(*\s*(SELECT|WITH)\b", re.IGNORECASE)
+_VOLATILE = re.compile(
+    r"\b(RAND|GENERATE_UUID|CURRENT_TIMESTAMP|CURRENT_DATETIME|CURRENT_TIME|SESSION_USER)\b",
+    re.IGNORECASE
+)
+_CURRENT_DATE = re.compile(r"\bCURRENT_DATE\b", re.IGNORECASE)
+
+
+def normalize_sql(sql: str) -> str:
+    """コメントと余分な空白・末尾のセミコロンを除く（文字列リテラル内は変更しない）"""
+    parts = []
+    for i, piece in enumerate(_QUOTED.split(sql)):
+        if i % 2 == 1:
+            parts.append(piece)
+        else:
+            parts.append(re.sub(r"\s+", " ", _COMMENT.sub(" ", piece)))
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def referenced_tables(sql: str, default_project: str = PROJECT_ID) -> list[str] | None:
+    """
+    FROM / JOIN で参照しているテーブルを "project.dataset.table" の形で返す
+
+    データセットで修飾されていない名前（CTEなど）は対象外。1つも見つからなければ None
+    """
+    unquoted = "".join(
+        piece if i % 2 == 0 or piece.startswith("`") else "''"
+        for i, piece in enumerate(_QUOTED.split(_COMMENT.sub(" ", sql)))
+    )
+    tables = set()
+    for ref in _TABLE_REF.findall(unquoted):
+        parts = ref.strip("`").split(".")
+        if len(parts) == 2:
+            parts = [default_project, *parts]
+        if len(parts) == 3:
+            tables.add(".".join(parts))
+    return sorted(tables) or None
+
+
+class TableVersionResolver(Protocol):
+    """
+    テーブル名から最終更新時刻（ISO形式の文字列）を返す
+
+    更新時刻で内容の変化を判定できないテーブルは None とする（そのクエリはキャッシュしない）
+    """
+
+    def table_versions(self, tables: list[str]) -> dict[str, str | None]:
+        ...
+
+
+class BigQueryTableVersionResolver:
+    """
+    BigQuery API（tables.get）で最終更新時刻を取得する TableVersionResolver
+
+    同じテーブルの確認は TABLE_VERSION_TTL_SECONDS の間まとめる
+    """
+
+    def __init__(self, project_id: str = PROJECT_ID, ttl_seconds: float = TABLE_VERSION_TTL_SECONDS):
+        self.project_id = project_id
+        self.ttl_seconds = ttl_seconds
+        self._client = None
+        self._versions: dict[str, tuple[float, str | None]] = {}
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        if self._client is None:
+            from google.cloud import bigquery
+            self._client = bigquery.Client(project=self.project_id)
+        return self._client
+
+    def table_versions(self, tables: list[str]) -> dict[str, str | None]:
+        now = time.monotonic()
+        versions = {}
+        for table in tables:
+            with self._lock:
+                cached = self._versions.get(table)
+            if cached and now - cached[0] < self.ttl_seconds:
+                versions[table] = cached[1]
+                continue
+            info = self._get_client().get_table(table)
+            # ビュー・外部テーブルなどの modified は元データが変わっても更新されない
+            trusted = info.table_type == "TABLE" and info.modified is not None
+            version = info.modified.isoformat() if trusted else None
+            with self._lock:
+                self._versions[table] = (now, version)
+            versions[table] = version
+        return versions
+
+
+class _CachedResult:
+    __slots__ = ("response", "size_bytes", "created_at")
+
+    def __init__(self, response: Any, size_bytes: int):
+        self.response = response
+        self.size_bytes = size_bytes
+        self.created_at = time.time()
+
+
+class QueryResultCache:
+    """サイズ上限付きLRUの結果キャッシュ（同一キーの同時実行は1回にまとめる）"""
+
+    def __init__(
+        self,
+        resolver: TableVersionResolver | None = None,
+        max_bytes: int = QUERY_CACHE_MAX_BYTES,
+        ttl_seconds: float = QUERY_CACHE_TTL_SECONDS
+    ):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._resolver = resolver
+        self._entries: OrderedDict[str, _CachedResult] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def resolver(self) -> TableVersionResolver:
+        if self._resolver is None:
+            self._resolver = BigQueryTableVersionResolver()
+        return self._resolver
+
+    def set_resolver(self, resolver: TableVersionResolver | None) -> None:
+        """TableVersionResolver を差し替える（None で既定に戻す）"""
+        self._resolver = resolver
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "total_bytes": self._total_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+            }
+
+    async def cache_key(self, args: dict[str, Any]) -> str | None:
+        """キャッシュキーを作る（キャッシュできないクエリは None）"""
+        sql = args.get("query") or args.get("sql")
+        if not isinstance(sql, str) or not _READ_ONLY.match(sql) or _VOLATILE.search(sql):
+            return None
+        tables = referenced_tables(sql)
+        if not tables:
+            return None
+        try:
+            versions = await asyncio.to_thread(self.resolver.table_versions, tables)
+        except Exception as e:
+            logger.info(f"Query cache bypassed (table metadata unavailable): {e}")
+            return None
+        unversioned = [table for table, version in versions.items() if version is None]
+        if unversioned:
+            logger.info(f"Query cache bypassed (no reliable modified time): {', '.join(unversioned)}")
+            return None
+
+        key_source = {
+            "sql": normalize_sql(sql),
+            "args": {k: v for k, v in args.items() if k not in ("query", "sql")},
+            "tables": versions,
+        }
+        if _CURRENT_DATE.search(sql):
+            key_source["date"] = datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+        encoded = json.dumps(key_source, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    async def has_result(self, args: dict[str, Any]) -> bool:
+        """args の結果がキャッシュにある（または同じキーで実行中）か（ヒット数には数えない）"""
+        key = await self.cache_key(args)
+        if key is None:
+            return False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry.created_at <= self.ttl_seconds:
+                return True
+        return key in self._inflight
+
+    def _get(self, key: str) -> _CachedResult | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry.created_at > self.ttl_seconds:
+                del self._entries[key]
+                self._total_bytes -= entry.size_bytes
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry
+
+    def _put(self, key: str, response: Any) -> int:
+        """結果を保存し、押し出した件数を返す"""
+        size_bytes = len(json.dumps(response, ensure_ascii=False, default=str))
+        if size_bytes > self.max_bytes:
+            return 0
+        evicted = 0
+        with self._lock:
+            self._entries[key] = _CachedResult(response, size_bytes)
+            self._total_bytes += size_bytes
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, old = self._entries.popitem(last=False)
+                self._total_bytes -= old.size_bytes
+                evicted += 1
+            self._evictions += evicted
+        if evicted:
+            logger.info(f"Query cache evicted {evicted} entries ({self._total_bytes} bytes in use)")
+        return evicted
+
+    def _with_cache_info(self, response: Any, info: dict[str, Any]) -> Any:
+        """応答（dict）にキャッシュ情報を付けたコピーを返す"""
+        if not isinstance(response, dict):
+            return response
+        return {**response, "cache": {**info, **self.stats()}}
+
+    async def run(self, args: dict[str, Any], execute: Callable[[], Awaitable[Any]]) -> Any:
+        """キャッシュを確認し、必要な場合のみ execute() でクエリを実行する"""
+        key = await self.cache_key(args)
+        if key is None:
+            return self._with_cache_info(await execute(), {"status": "bypass"})
+
+        entry = self._get(key)
+        if entry is not None:
+            return self._with_cache_info(entry.response, {
+                "status": "hit",
+                "age_seconds": round(time.time() - entry.created_at, 1),
+            })
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            response = await asyncio.shield(inflight)
+            return self._with_cache_info(response, {"status": "shared"})
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        with self._lock:
+            self._misses += 1
+        try:
+            response = await execute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 待機者がいない場合の "exception was never retrieved" を避ける
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        future.set_result(response)
+
+        evicted = 0
+        if not _is_error(response):
+            evicted = self._put(key, response)
+        return self._with_cache_info(response, {"status": "miss", "evicted": evicted})
+
+
+def _is_error(response: Any) -> bool:
+    return isinstance(response, dict) and bool(response.get("isError") or "error" in response)
+
+
+# プロセス全体で共有するキャッシュ
+query_cache = QueryResultCache()
+
+
+class CachedQueryTool(BaseTool):
+    """execute_sql を結果キャッシュ経由で実行するラッパー"""
+
+    def __init__(self, tool: BaseTool, cache: QueryResultCache):
+        super().__init__(name=tool.name, description=tool.description)
+        self._tool = tool
+        self._cache = cache
+
+    @property
+    def cache(self) -> QueryResultCache:
+        return self._cache
+
+    def _get_declaration(self):
+        return self._tool._get_declaration()
+
+    async def run_async(self, *, args: dict[str, Any], tool_context: Any) -> Any:
+        return await self._cache.run(
+            args,
+            lambda: self._tool.run_async(args=args, tool_context=tool_context)
+        )
+
+
+class QueryCachingToolset(BaseToolset):
+    """ツールセットの execute_sql を CachedQueryTool に差し替えるラッパー"""
+
+    def __init__(self, toolset: BaseToolset, cache: QueryResultCache = query_cache):
+        super().__init__()
+        self._toolset = toolset
+        self._cache = cache
+
+    async def get_tools(self, readonly_context: Any = None) -> list[BaseTool]:
+        tools = await self._toolset.get_tools(readonly_context)
+        return [
+            CachedQueryTool(tool, self._cache) if tool.name in CACHED_QUERY_TOOLS else tool
+            for tool in tools
+        ]
+
+    async def close(self) -> None:
+        await self._toolset.close()
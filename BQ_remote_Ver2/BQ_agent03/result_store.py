@@ -0,0 +1,329 @@
+"""
+クエリ結果ストア
+
+execute_sql の結果をサーバー側（プロセス内）にセッション単位で保持し、
+モデルには短い結果ハンドルとプレビューだけを返す。
+Excel/CSV出力ツールは結果JSONの代わりにハンドルを受け取って出力する。
+
+- 取り込みは after_tool_callback（capture_execute_sql）で行う
+- 結果は正規化済みの pyarrow.Table として保持し、続きの行は fetch_result_page で読む
+- プレビュー/ページはトークン数の目安（BQ_PREVIEW_TOKEN_BUDGET / BQ_PAGE_TOKEN_BUDGET）に収める
+- 保持量はバイト数で上限を設け、古いものからLRUで破棄する
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any
+import pyarrow as pa
+
+from .bq_result import normalize_bq_result
+
+logger = logging.getLogger(__name__)
+
+# ストア全体の上限バイト数
+DEFAULT_MAX_BYTES = int(os.getenv("BQ_RESULT_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# モデルに返すプレビュー行数
+PREVIEW_ROWS = int(os.getenv("BQ_RESULT_PREVIEW_ROWS", "20"))
+
+# プレビュー/1ページに使うトークン数の目安
+PREVIEW_TOKEN_BUDGET = int(os.getenv("BQ_PREVIEW_TOKEN_BUDGET", "2000"))
+PAGE_TOKEN_BUDGET = int(os.getenv("BQ_PAGE_TOKEN_BUDGET", "4000"))
+
+# fetch_result_page の1回あたりの最大行数
+MAX_PAGE_ROWS = 200
+
+# プレビュー/ページで1セルに載せる最大文字数
+MAX_CELL_CHARS = 200
+
+# 結果を取り込む対象のツール名
+CAPTURED_TOOLS = ("execute_sql",)
+
+HANDLE_PREFIX = "qr_"
+
+
+class _StoredResult:
+    """ストアに保持する1件分の結果"""
+
+    __slots__ = ("payload", "size_bytes", "sql", "created_at")
+
+    def __init__(self, payload: Any, size_bytes: int, sql: str | None):
+        self.payload = payload
+        self.size_bytes = size_bytes
+        self.sql = sql
+        self.created_at = time.time()
+
+
+class QueryResultStore:
+    """
+    セッション単位のクエリ結果ストア（サイズ上限付きLRU）
+
+    キーは (session_id, handle)。別セッションのハンドルは参照できない。
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple[str, str], _StoredResult] = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def put(self, session_id: str, payload: Any, size_bytes: int, sql: str | None = None) -> str:
+        """結果を保存してハンドルを返す"""
+        handle = f"{HANDLE_PREFIX}{uuid.uuid4().hex[:12]}"
+        with self._lock:
+            self._entries[(session_id, handle)] = _StoredResult(payload, size_bytes, sql)
+            self._total_bytes += size_bytes
+            self._evict()
+        return handle
+
+    def get(self, session_id: str, handle: str) -> Any | None:
+        """ハンドルから結果を取り出す（見つからなければNone）"""
+        with self._lock:
+            entry = self._entries.get((session_id, handle))
+            if entry is None:
+                return None
+            self._entries.move_to_end((session_id, handle))
+            return entry.payload
+
+    def get_sql(self, session_id: str, handle: str) -> str | None:
+        """ハンドルの結果を取得したSQL（見つからなければNone）"""
+        with self._lock:
+            entry = self._entries.get((session_id, handle))
+            return entry.sql if entry is not None else None
+
+    def _evict(self) -> None:
+        """上限を超えた分を古い順に破棄する（直近の1件は残す）"""
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            (session_id, handle), entry = self._entries.popitem(last=False)
+            self._total_bytes -= entry.size_bytes
+            logger.info(f"Result store evicted {handle} (session={session_id}, {entry.size_bytes} bytes)")
+
+
+# プロセス全体で共有するストア
+result_store = QueryResultStore()
+
+
+def _session_id(tool_context: Any) -> str:
+    """ToolContextからセッションIDを取得する"""
+    session = getattr(tool_context, "session", None)
+    return getattr(session, "id", None) or "default"
+
+
+def extract_tool_payload(tool_response: Any) -> tuple[Any, int]:
+    """
+    MCPツールの応答から結果本体とそのサイズ（バイト）を取り出す
+
+    structuredContent があればそれを、なければ content[].text をJSONとして解釈する
+    """
+    if isinstance(tool_response, dict):
+        structured = tool_response.get("structuredContent")
+        if structured:
+            if isinstance(structured, dict) and set(structured) == {"result"}:
+                structured = structured["result"]
+            return structured, len(json.dumps(structured, ensure_ascii=False, default=str))
+
+        texts = [
+            item.get("text", "")
+            for item in tool_response.get("content") or []
+            if isinstance(item, dict) and item.get("type") == "text"
+        ]
+        if texts:
+            text = "".join(texts)
+            try:
+                return json.loads(text), len(text)
+            except json.JSONDecodeError:
+                return text, len(text)
+
+    if isinstance(tool_response, str):
+        try:
+            return json.loads(tool_response), len(tool_response)
+        except json.JSONDecodeError:
+            return tool_response, len(tool_response)
+
+    return tool_response, len(json.dumps(tool_response, ensure_ascii=False, default=str))
+
+
+def _json_safe(value: Any) -> Any:
+    """プレビュー用にJSONへ載せられる値にする"""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, list):
+        return [_json_safe(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _json_safe(v) for k, v in value.items()}
+    return str(value)
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の目安（ASCIIは4文字で1トークン、それ以外は1文字1トークンとして数える）"""
+    ascii_chars = sum(1 for ch in text if ch.isascii())
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def _shorten(value: Any) -> Any:
+    """長い文字列セルを MAX_CELL_CHARS で切り詰める"""
+    if isinstance(value, str) and len(value) > MAX_CELL_CHARS:
+        return value[:MAX_CELL_CHARS] + "…"
+    return value
+
+
+def _budgeted_rows(table: pa.Table, offset: int, limit: int, token_budget: int) -> list[dict[str, Any]]:
+    """offset から最大 limit 行を、トークン数の目安に収まる範囲で返す（最低1行）"""
+    rows = []
+    used = 0
+    for row in table.slice(offset, limit).to_pylist():
+        row = {k: _shorten(v) for k, v in _json_safe(row).items()}
+        cost = estimate_tokens(json.dumps(row, ensure_ascii=False))
+        if rows and used + cost > token_budget:
+            break
+        rows.append(row)
+        used += cost
+    return rows
+
+
+def result_schema(table: pa.Table) -> list[dict[str, str]]:
+    """列名と型の一覧"""
+    return [{"name": field.name, "type": str(field.type)} for field in table.schema]
+
+
+def build_preview(
+    payload: Any,
+    max_rows: int = PREVIEW_ROWS,
+    token_budget: int = PREVIEW_TOKEN_BUDGET
+) -> dict[str, Any]:
+    """結果の行数・スキーマ・先頭行のプレビューを作る（トークン数の目安に収める）"""
+    table = normalize_bq_result(payload)
+    preview_rows = _budgeted_rows(table, 0, max_rows, token_budget)
+    return {
+        "row_count": table.num_rows,
+        "columns": table.column_names,
+        "schema": result_schema(table),
+        "preview": preview_rows,
+        "truncated": table.num_rows > len(preview_rows),
+    }
+
+
+def capture_execute_sql(
+    tool: Any,
+    args: dict[str, Any],
+    tool_context: Any,
+    tool_response: Any,
+) -> dict[str, Any] | None:
+    """
+    after_tool_callback: execute_sql の結果をストアに取り込み、ハンドルとプレビューに置き換える
+
+    エラー応答や他のツールの応答はそのまま返す
+    """
+    if getattr(tool, "name", None) not in CAPTURED_TOOLS:
+        return None
+    if isinstance(tool_response, dict) and (tool_response.get("isError") or "error" in tool_response):
+        return None
+
+    try:
+        payload, _ = extract_tool_payload(tool_response)
+        if isinstance(payload, str):
+            return None
+        # 正規化済みのテーブルを保持し、ページ取得や出力のたびに変換し直さない
+        table = normalize_bq_result(payload)
+        preview = build_preview(table)
+    except Exception as e:
+        logger.warning(f"Result capture skipped: {e}")
+        return None
+
+    handle = result_store.put(_session_id(tool_context), table, table.nbytes, sql=args.get("query"))
+    message = f"クエリ結果を保存しました（{preview['row_count']}行）。"
+    if preview["truncated"]:
+        message += f"続きの行は fetch_result_page(result_handle='{handle}', offset={len(preview['preview'])}) で取得できます。"
+    captured = {
+        "result_handle": handle,
+        **preview,
+        "message": message + f"ファイル出力時は result_handle='{handle}' を指定してください。",
+    }
+    # 結果キャッシュ（query_cache）のヒット/ミス情報は応答に残す
+    if isinstance(tool_response, dict) and "cache" in tool_response:
+        captured["cache"] = tool_response["cache"]
+    return captured
+
+
+def resolve_result_handle(tool_context: Any, result_handle: str) -> Any | None:
+    """出力ツール用: ハンドルから保存済みの結果を取り出す"""
+    return result_store.get(_session_id(tool_context), result_handle)
+
+
+def result_handle_sql(tool_context: Any, result_handle: str) -> str | None:
+    """出力ツール用: ハンドルの結果を取得したSQL"""
+    return result_store.get_sql(_session_id(tool_context), result_handle)
+
+
+def load_query_result(
+    tool_context: Any,
+    result_handle: str = "",
+    query_result: Any = None,
+) -> tuple[Any, str | None]:
+    """
+    出力ツール用: ハンドルまたは結果JSONからデータを取り出す
+
+    Returns:
+        (データ, エラーメッセージ)。成功時のエラーメッセージは None
+    """
+    if result_handle:
+        data = resolve_result_handle(tool_context, result_handle)
+        if data is None:
+            return None, f"結果ハンドル '{result_handle}' が見つかりません。execute_sqlを再実行してください。"
+        return data, None
+    if isinstance(query_result, str):
+        try:
+            return json.loads(query_result), None
+        except json.JSONDecodeError:
+            return None, "query_resultのJSON解析に失敗しました。"
+    return query_result, None
+
+
+async def fetch_result_page(
+    result_handle: str,
+    offset: int = 0,
+    limit: int = 50,
+    tool_context: Any = None
+) -> dict[str, Any]:
+    """
+    保存済みのクエリ結果から指定範囲の行を取得する
+
+    Args:
+        result_handle: execute_sqlの応答に含まれる結果ハンドル
+        offset: 取得を始める行番号（0始まり）
+        limit: 取得する最大行数（最大200行。トークン数の目安を超える分は次のページに回す）
+        tool_context: ADKのToolContext
+
+    Returns:
+        dict: 行データと次ページの offset
+    """
+    if not tool_context:
+        return {"success": False, "error": "ToolContextが提供されていません。"}
+    if offset < 0 or limit <= 0:
+        return {"success": False, "error": "offset は0以上、limit は1以上を指定してください。"}
+
+    data = resolve_result_handle(tool_context, result_handle)
+    if data is None:
+        return {"success": False, "error": f"結果ハンドル '{result_handle}' が見つかりません。execute_sqlを再実行してください。"}
+
+    table = normalize_bq_result(data)
+    rows = _budgeted_rows(table, offset, min(limit, MAX_PAGE_ROWS), PAGE_TOKEN_BUDGET)
+    next_offset = offset + len(rows)
+    has_more = next_offset < table.num_rows
+    return {
+        "success": True,
+        "result_handle": result_handle,
+        "offset": offset,
+        "rows": rows,
+        "row_count": table.num_rows,
+        "next_offset": next_offset if has_more else None,
+        "has_more": has_more,
+    }
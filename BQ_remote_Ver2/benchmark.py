@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+benchmark.py - 結果の正規化とファイル出力のベンチマーク
+
+合成したBigQuery形式の結果を使い、次の処理の実行時間・行/秒・ピークメモリを計測する。
+ピークメモリは Python のオブジェクト（tracemalloc）と Arrow のメモリプール（列配列のバッファ）を別々に記録する。
+- normalize:      bq_agent.excel_tool._normalize_bq_data
+- excel_bq_agent: bq_agent.excel_tool.export_to_excel
+- excel_agent02:  BQ_agent02.excel_tool.export_to_excel
+- csv_agent03:    BQ_agent03.agent03.export_to_csv
+
+合成データの形式は次の3種類で、行数・列数・入れ子の深さを変えて組み合わせる。
+- fv: schema + f/v 行（execute_sql の応答と同じ形式）
+- schema_rows: schema + 辞書行
+- dicts: スキーマなしの辞書リスト
+
+計測結果は基準値（ベースライン）のJSONと比較し、しきい値を超えて遅く（重く）なったケースを回帰として報告する。
+基準値はマシンに依存するため、同じ環境で保存した値と比較すること。
+
+使い方:
+    python benchmark.py --save-baseline          # 計測して基準値として保存
+    python benchmark.py                          # 計測して基準値と比較（回帰があれば終了コード 1）
+    python benchmark.py --target normalize --rows 1000 100000 --threshold 0.3
+
+xlsx出力は1ケースあたり数秒かかるため、大きな行数は --target で対象を絞って計測すること。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Any, Callable
+
+# インポート時のバックグラウンド初期化（ネットワークアクセス）を止める
+os.environ.setdefault("BQ_WARMUP_DELAY_SECONDS", "-1")
+
+DEFAULT_BASELINE = Path(__file__).with_name("benchmark_baseline.json")
+DEFAULT_ROWS = (1_000, 10_000)
+DEFAULT_WIDTHS = (8, 32)
+DEFAULT_NESTING = (0, 2)
+SHAPES = ("fv", "schema_rows", "dicts")
+
+# 列の型（列数に合わせて繰り返す）
+COLUMN_TYPES = ("INT64", "FLOAT64", "STRING", "BOOL", "DATE", "TIMESTAMP", "NUMERIC")
+
+# これより小さい時間の増加は計測誤差とみなして回帰にしない（秒）
+MIN_REGRESSION_SECONDS = 0.005
+
+# この間隔で NULL を混ぜる
+NULL_EVERY = 17
+
+_EPOCH_DATE = date(2024, 1, 1)
+
+
+# ============================================================
+# 合成データ
+# ============================================================
+
+def _rest_value(bq_type: str, i: int, rng: random.Random) -> Any:
+    """BigQuery REST 形式（文字列）のセル値"""
+    if bq_type == "INT64":
+        return str(rng.randrange(-10**9, 10**9))
+    if bq_type == "FLOAT64":
+        return repr(rng.uniform(-1e6, 1e6))
+    if bq_type == "STRING":
+        # CSVのクォート処理も通るようにカンマ・ダブルクォートを含める
+        return f'name_{rng.randrange(5000)}, "q"' if i % 5 == 0 else f"name_{rng.randrange(5000)}"
+    if bq_type == "BOOL":
+        return "true" if rng.random() < 0.5 else "false"
+    if bq_type == "DATE":
+        return (_EPOCH_DATE + timedelta(days=rng.randrange(3650))).isoformat()
+    if bq_type == "TIMESTAMP":
+        return f"{1.7e9 + rng.randrange(10**8):.6E}"
+    return f"{rng.randrange(10**6)}.{rng.randrange(100):02d}"
+
+
+def _native_value(bq_type: str, i: int, rng: random.Random) -> Any:
+    """スキーマなしの辞書行に入れる Python の値"""
+    value = _rest_value(bq_type, i, rng)
+    if bq_type == "INT64":
+        return int(value)
+    if bq_type in ("FLOAT64", "NUMERIC", "TIMESTAMP"):
+        return float(value)
+    if bq_type == "BOOL":
+        return value == "true"
+    return value
+
+
+def _record_fields(level: int) -> list[dict[str, Any]]:
+    """入れ子の深さ level の RECORD 列のフィールド"""
+    fields = [
+        {"name": "id", "type": "INT64", "mode": "NULLABLE"},
+        {"name": "label", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "tags", "type": "STRING", "mode": "REPEATED"},
+    ]
+    if level > 1:
+        fields.append({"name": "inner", "type": "RECORD", "mode": "NULLABLE", "fields": _record_fields(level - 1)})
+    return fields
+
+
+def _record_value(level: int, shape: str, i: int, rng: random.Random) -> Any:
+    """入れ子の深さ level の RECORD 値（形式ごとの表現）"""
+    values = [
+        _rest_value("INT64", i, rng),
+        _rest_value("STRING", i + 1, rng),
+        [f"tag_{rng.randrange(50)}" for _ in range(rng.randrange(4))],
+    ]
+    inner = _record_value(level - 1, shape, i, rng) if level > 1 else None
+    if shape == "fv":
+        cells = [{"v": values[0]}, {"v": values[1]}, {"v": [{"v": tag} for tag in values[2]]}]
+        if level > 1:
+            cells.append({"v": inner})
+        return {"f": cells}
+    record = {"id": int(values[0]) if shape == "dicts" else values[0], "label": values[1], "tags": values[2]}
+    if level > 1:
+        record["inner"] = inner
+    return record
+
+
+def make_payload(shape: str, rows: int, width: int, nesting: int, seed: int = 0) -> Any:
+    """
+    合成したBigQuery形式の結果を作る
+
+    Args:
+        shape: "fv" / "schema_rows" / "dicts"
+        rows: 行数
+        width: スカラー列の数
+        nesting: RECORD 列の入れ子の深さ（0 で RECORD 列なし）
+    """
+    rng = random.Random(seed)
+    types = [COLUMN_TYPES[c % len(COLUMN_TYPES)] for c in range(width)]
+    names = [f"{t.lower()}_{c}" for c, t in enumerate(types)]
+    fields = [{"name": n, "type": t, "mode": "NULLABLE"} for n, t in zip(names, types)]
+    if nesting:
+        fields.append({"name": "rec", "type": "RECORD", "mode": "NULLABLE", "fields": _record_fields(nesting)})
+
+    out_rows = []
+    for i in range(rows):
+        cells = []
+        for c, t in enumerate(types):
+            if (i + c) % NULL_EVERY == 0:
+                cells.append(None)
+            elif shape == "dicts":
+                cells.append(_native_value(t, i, rng))
+            else:
+                cells.append(_rest_value(t, i, rng))
+        if nesting:
+            cells.append(_record_value(nesting, shape, i, rng))
+
+        if shape == "fv":
+            out_rows.append({"f": [{"v": v} for v in cells]})
+        else:
+            out_rows.append(dict(zip([f["name"] for f in fields], cells)))
+
+    if shape == "dicts":
+        return out_rows
+    return {"schema": {"fields": fields}, "rows": out_rows, "totalRows": str(rows)}
+
+
+# ============================================================
+# 計測対象
+# ============================================================
+
+class _BenchToolContext:
+    """Artifactを保存せずにサイズだけ記録する ToolContext の代わり"""
+
+    def __init__(self):
+        self.state: dict[str, Any] = {}
+        self.saved_bytes = 0
+
+    async def save_artifact(self, filename: str, artifact: Any) -> int:
+        self.saved_bytes = len(artifact.inline_data.data)
+        return 0
+
+
+def _check_export(result: dict[str, Any]) -> None:
+    if not result.get("success"):
+        raise RuntimeError(result.get("error"))
+
+
+def _normalize_target() -> Callable[[Any], Any]:
+    from bq_agent.excel_tool import _normalize_bq_data
+    return _normalize_bq_data
+
+
+def _excel_bq_agent_target() -> Callable[[Any], Any]:
+    from bq_agent.excel_tool import export_to_excel
+
+    def run(payload: Any) -> None:
+        _check_export(asyncio.run(export_to_excel(
+            data=payload, filename="bench.xlsx", tool_context=_BenchToolContext()
+        )))
+    return run
+
+
+def _excel_agent02_target() -> Callable[[Any], Any]:
+    from BQ_agent02.excel_tool import export_to_excel
+
+    def run(payload: Any) -> None:
+        _check_export(asyncio.run(export_to_excel(_BenchToolContext(), "bench.xlsx", data=payload)))
+    return run
+
+
+def _csv_agent03_target() -> Callable[[Any], Any]:
+    from BQ_agent03.agent03 import export_to_csv
+
+    def run(payload: Any) -> None:
+        _check_export(asyncio.run(export_to_csv(_BenchToolContext(), "bench.csv", data=payload)))
+    return run
+
+
+# 計測対象名 → (関数を返すローダー, 対象にする合成データの形式)
+TARGETS: dict[str, tuple[Callable[[], Callable[[Any], Any]], tuple[str, ...]]] = {
+    "normalize": (_normalize_target, SHAPES),
+    "excel_bq_agent": (_excel_bq_agent_target, ("fv",)),
+    "excel_agent02": (_excel_agent02_target, ("fv",)),
+    "csv_agent03": (_csv_agent03_target, ("fv",)),
+}
+
+
+# ============================================================
+# 計測
+# ============================================================
+
+# 計測に使った Arrow のプロキシプール（プールより長く生きるバッファがあるため破棄しない）
+_ARROW_POOLS: list[Any] = []
+
+
+def measure(func: Callable[[Any], Any], payload: Any, rows: int, repeat: int) -> dict[str, Any]:
+    """
+    実行時間（repeat回の中央値）とピークメモリ（tracemalloc / Arrowのメモリプール）を計測する
+
+    tracemalloc は実行を遅くするため、時間の計測とは別に1回だけ実行する。
+    Arrowのバッファは tracemalloc に現れないため、同じ1回を既定プールのプロキシに切り替えて実行し、
+    そのプールの最大確保量を記録する（既定プールの最大値はプロセス全体で累積し、リセットできない）
+    """
+    import pyarrow as pa
+
+    func(payload)  # ウォームアップ（遅延インポートなどを除く）
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(payload)
+        timings.append(time.perf_counter() - started)
+
+    default_pool = pa.default_memory_pool()
+    arrow_pool = pa.proxy_memory_pool(default_pool)
+    _ARROW_POOLS.append(arrow_pool)
+    pa.set_memory_pool(arrow_pool)
+    tracemalloc.start()
+    try:
+        func(payload)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        pa.set_memory_pool(default_pool)
+
+    seconds = statistics.median(timings)
+    return {
+        "seconds": round(seconds, 6),
+        "rows_per_second": round(rows / seconds, 1) if seconds else None,
+        "peak_memory_bytes": peak,
+        "arrow_peak_memory_bytes": arrow_pool.max_memory(),
+    }
+
+
+def run_benchmarks(
+    targets: list[str],
+    rows_list: list[int],
+    widths: list[int],
+    nesting_levels: list[int],
+    repeat: int
+) -> dict[str, dict[str, Any]]:
+    """全ケースを計測し、ケース名 → 計測結果 を返す"""
+    results: dict[str, dict[str, Any]] = {}
+    for target in targets:
+        loader, shapes = TARGETS[target]
+        func = loader()
+        for shape in shapes:
+            for rows in rows_list:
+                for width in widths:
+                    for nesting in nesting_levels:
+                        case = f"{target}/{shape}/rows={rows}/cols={width}/nest={nesting}"
+                        payload = make_payload(shape, rows, width, nesting)
+                        result = measure(func, payload, rows, repeat)
+                        results[case] = result
+                        print(
+                            f"  {case:<52} {result['seconds'] * 1000:>10.1f} ms"
+                            f" {result['rows_per_second']:>12,.0f} rows/s"
+                            f" {result['peak_memory_bytes'] / 2**20:>9.1f} MiB"
+                            f" {result['arrow_peak_memory_bytes'] / 2**20:>9.1f} MiB (arrow)",
+                            flush=True
+                        )
+    return results
+
+
+def compare(
+    results: dict[str, dict[str, Any]],
+    baseline: dict[str, dict[str, Any]],
+    threshold: float
+) -> list[str]:
+    """基準値より threshold（割合）を超えて遅い/メモリが多いケースを返す"""
+    regressions = []
+    for case, result in results.items():
+        base = baseline.get(case)
+        if not base:
+            continue
+        for metric, label in (
+            ("seconds", "時間"),
+            ("peak_memory_bytes", "メモリ"),
+            ("arrow_peak_memory_bytes", "Arrowメモリ"),
+        ):
+            if not base.get(metric) or result[metric] <= base[metric] * (1 + threshold):
+                continue
+            if metric == "seconds" and result[metric] - base[metric] < MIN_REGRESSION_SECONDS:
+                continue
+            ratio = result[metric] / base[metric]
+            regressions.append(f"{case}: {label} {ratio:.2f}倍（基準 {base[metric]} → {result[metric]}）")
+    return regressions
+
+
+def _environment() -> dict[str, Any]:
+    import platform
+    import pyarrow
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pyarrow": pyarrow.__version__,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="結果の正規化とファイル出力のベンチマーク")
+    parser.add_argument("--target", nargs="+", choices=list(TARGETS), default=list(TARGETS))
+    parser.add_argument("--rows", nargs="+", type=int, default=list(DEFAULT_ROWS))
+    parser.add_argument("--cols", nargs="+", type=int, default=list(DEFAULT_WIDTHS))
+    parser.add_argument("--nest", nargs="+", type=int, default=list(DEFAULT_NESTING))
+    parser.add_argument("--repeat", type=int, default=3, help="時間計測の繰り返し回数（中央値を使う）")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE, help="基準値のJSONファイル")
+    parser.add_argument("--save-baseline", action="store_true", help="計測結果を基準値として保存する")
+    parser.add_argument("--threshold", type=float, default=0.2, help="回帰とみなす増加の割合（既定 0.2 = 20%%）")
+    args = parser.parse_args()
+
+    print("⏱️  ベンチマーク")
+    print("=" * 50)
+    results = run_benchmarks(args.target, args.rows, args.cols, args.nest, args.repeat)
+    print()
+
+    if args.save_baseline:
+        # 既存の基準値に今回のケースを上書きでマージする
+        saved = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        cases = {**saved.get("cases", {}), **results}
+        args.baseline.write_text(json.dumps(
+            {"environment": _environment(), "cases": cases}, indent=2, ensure_ascii=False
+        ) + "\n")
+        print(f"💾 基準値を保存しました: {args.baseline}（{len(results)}ケース）")
+        return 0
+
+    if not args.baseline.exists():
+        print(f"ℹ️  基準値がありません（{args.baseline}）。--save-baseline で保存してください。")
+        return 0
+
+    baseline = json.loads(args.baseline.read_text())
+    if baseline.get("environment") != _environment():
+        print("⚠️  基準値と実行環境が異なります。比較結果は参考値です。")
+    regressions = compare(results, baseline.get("cases", {}), args.threshold)
+    if regressions:
+        print(f"❌ 回帰 {len(regressions)}件（しきい値 +{args.threshold:.0%}）")
+        for line in regressions:
+            print(f"  - {line}")
+        return 1
+    print(f"✅ 回帰なし（しきい値 +{args.threshold:.0%}）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,18 +9,31 @@ Excel出力機能:
 - execute_sqlの結果をExcelファイルとして保存可能
 - ArtifactServiceを通じてファイルを管理
 """
+import time
+
+_IMPORT_STARTED = time.perf_counter()
+
 import os
-import json
 from typing import Any
-import google.auth
-from google.auth.transport import requests as google_requests
 from google.adk.agents import LlmAgent
 from google.adk.tools import FunctionTool
 from google.adk.tools.mcp_tool.mcp_toolset import MCPToolset
 from google.adk.tools.mcp_tool.mcp_session_manager import StreamableHTTPConnectionParams
 
 # Excel出力用ツールをインポート
-from .excel_tool import export_to_excel, list_saved_files
+from .excel_tool import export_json_to_excel, export_to_excel, list_saved_files
+from .auth import bigquery_header_provider, credential_cache
+from .result_store import capture_execute_sql, fetch_result_page, load_query_result, result_handle_sql
+from .direct_export import export_sql_to_file
+from .columnar_tool import save_query_result_to_columnar
+from .spill_export import save_query_result_split
+from .report_export import export_report
+from .profile_tool import profile_result
+from .budget_guard import guard_query_budget
+from .lazy_init import report_import_time, schedule_warmup, warm_imports
+from .metadata_cache import answer_metadata_locally
+from .query_cache import QueryCachingToolset
+from .tool_cache import CachedToolset
 
 # BigQuery Remote MCP Server URL
 BIGQUERY_MCP_URL = "https://bigquery.googleapis.com/mcp"
@@ -29,37 +42,26 @@ BIGQUERY_MCP_URL = "https://bigquery.googleapis.com/mcp"
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "agent-vi-473112")
 
 
-def _get_auth_headers():
-    """認証ヘッダーを取得"""
-    credentials, project = google.auth.default(
-        scopes=[
-            "https://www.googleapis.com/auth/bigquery",
-            "https://www.googleapis.com/auth/cloud-platform"
-        ]
-    )
-    
-    auth_request = google_requests.Request()
-    credentials.refresh(auth_request)
-    
-    return {
-        "Authorization": f"Bearer {credentials.token}",
-        "x-goog-user-project": project or PROJECT_ID
-    }
-
-
 # MCPToolset をグローバルで1回だけ初期化
-_bigquery_toolset = MCPToolset(
-    connection_params=StreamableHTTPConnectionParams(
-        url=BIGQUERY_MCP_URL,
-        headers=_get_auth_headers()
+# トークンは auth.credential_cache がバックグラウンドで更新し、リクエストごとに最新のヘッダーを付与する
+# ツール一覧はディスクにキャッシュし、セッション開始ごとの tools/list を省略する
+# execute_sql は結果キャッシュ（query_cache）を経由して実行する
+_bigquery_toolset = QueryCachingToolset(
+    CachedToolset(
+        BIGQUERY_MCP_URL,
+        MCPToolset(
+            connection_params=StreamableHTTPConnectionParams(url=BIGQUERY_MCP_URL),
+            header_provider=bigquery_header_provider
+        )
     )
 )
 
 
 # Excel出力ツール定義
 async def save_query_result_to_excel(
-    query_result: str,
     filename: str,
+    result_handle: str = "",
+    query_result: str = "",
     sheet_name: str = "QueryResult",
     tool_context: Any = None
 ) -> dict[str, Any]:
@@ -67,44 +69,48 @@ async def save_query_result_to_excel(
     SQLクエリの結果をExcelファイルとして保存する
     
     Args:
-        query_result: execute_sqlの結果（JSON文字列またはリスト）
         filename: 保存するファイル名（例: "sales_report.xlsx"）
+        result_handle: execute_sqlの応答に含まれる結果ハンドル（例: "qr_1a2b3c4d5e6f"）
+        query_result: execute_sqlの結果（JSON文字列）。result_handleがない場合のみ使用
         sheet_name: シート名（デフォルト: "QueryResult"）
         tool_context: ADKのToolContext
     
     Returns:
         dict: 保存結果
     """
-    # 文字列の場合はJSONとしてパース
-    if isinstance(query_result, str):
-        try:
-            data = json.loads(query_result)
-        except json.JSONDecodeError:
-            return {
-                "success": False,
-                "error": "query_resultのJSON解析に失敗しました。"
-            }
-    else:
-        data = query_result
+    # JSON文字列は全体をパースせず、rows を1行ずつデコードしながら書き込む
+    if not result_handle and isinstance(query_result, str) and query_result.strip():
+        return await export_json_to_excel(
+            query_result=query_result,
+            filename=filename,
+            sheet_name=sheet_name,
+            tool_context=tool_context
+        )
     
-    # データがリストでない場合の処理
-    if not isinstance(data, list):
-        if isinstance(data, dict) and "rows" in data:
-            data = data["rows"]
-        elif isinstance(data, dict) and "result" in data:
-            data = data["result"]
+    # ハンドル指定時はサーバー側に保存済みの結果を使う
+    data, error = load_query_result(tool_context, result_handle, query_result)
+    if error:
+        return {"success": False, "error": error}
     
+    # schema + rows 形式はスキーマごと渡す（列名と型の復元に使う）
     return await export_to_excel(
         data=data,
         filename=filename,
         sheet_name=sheet_name,
-        tool_context=tool_context
+        tool_context=tool_context,
+        source_query=result_handle_sql(tool_context, result_handle) if result_handle else None
     )
 
 
 # FunctionToolとして登録
 excel_export_tool = FunctionTool(func=save_query_result_to_excel)
 list_files_tool = FunctionTool(func=list_saved_files)
+direct_export_tool = FunctionTool(func=export_sql_to_file)
+report_export_tool = FunctionTool(func=export_report)
+columnar_export_tool = FunctionTool(func=save_query_result_to_columnar)
+split_export_tool = FunctionTool(func=save_query_result_split)
+result_page_tool = FunctionTool(func=fetch_result_page)
+profile_tool = FunctionTool(func=profile_result)
 
 
 # エージェント定義
@@ -122,13 +128,32 @@ root_agent = LlmAgent(
 - list_dataset_ids: データセット一覧を取得
 - list_table_ids: テーブル一覧を取得  
 - get_table_info: テーブルのスキーマ情報を取得
-- execute_sql: 任意のSQLクエリを実行
+- execute_sql: 任意のSQLクエリを実行（応答は result_handle・行数・スキーマ・先頭行のプレビュー）
+- fetch_result_page: execute_sqlの結果の続きの行を取得（result_handle, offset, limit）
+- profile_result: execute_sqlの結果の列ごとの統計（欠損数・最小/最大/平均/四分位・異なり数・上位の値）を取得（result_handle）
 
 ### ファイル出力
 - save_query_result_to_excel: SQLクエリの結果をExcelファイルとして保存
-  - query_result: execute_sqlの結果をそのまま渡す
+  - result_handle: execute_sqlの応答に含まれる result_handle をそのまま渡す
   - filename: ファイル名（例: "sales_report.xlsx"）
   - sheet_name: シート名（オプション）
+- save_query_result_to_columnar: SQLクエリの結果を Parquet / Arrow IPC ファイルとして保存（pandas・DuckDBで再利用する場合）
+  - result_handle: execute_sqlの応答に含まれる result_handle
+  - format: "parquet"（デフォルト）または "arrow"
+  - compression: 圧縮方式（オプション、デフォルト: "zstd"）
+- save_query_result_split: 大量の結果を行数ごとに分割して保存（Excelの104万行上限を超える場合）
+  - result_handle: execute_sqlの応答に含まれる result_handle
+  - format: "xlsx" / "csv"
+  - split_mode: "files"（複数ファイル）または "sheets"（1ファイル内の複数シート）
+  - rows_per_part: 1シート/1ファイルあたりの行数（オプション）
+  - as_zip: 分割ファイルをzipにまとめる場合は true
+- export_sql_to_file: SQLを実行して結果を直接ファイルに保存（大量データ向け）
+  - sql: 実行するSQL
+  - format: "xlsx" / "csv" / "parquet" / "arrow"
+  - filename: ファイル名（オプション）
+- export_report: 複数のSQLを並行して実行し、結果を1つのExcelファイルのシートに分けて保存（月次レポートなど）
+  - queries: {{シート名: SQL}} の辞書
+  - filename: ファイル名（オプション）
 - list_saved_files: 保存済みファイル一覧を表示
 
 ## 重要なルール
@@ -136,13 +161,42 @@ root_agent = LlmAgent(
 2. 「〜を取得します」「〜を実行します」と言う前に、まずツールを呼び出してください
 3. ツールの結果を待ってから、結果をユーザーに説明してください
 4. 1回のレスポンスで複数のツールを連続して呼び出すことができます
+5. SELECT * は避けて必要な列だけを選び、パーティション列があれば期間で絞ってください。execute_sql がスキャン量の上限で実行されなかった場合は、suggested_query や notes を参考にSQLを絞り込んで再実行してください
 
 ## Excel出力のワークフロー
-1. execute_sql でデータを取得
-2. 取得した結果を save_query_result_to_excel に渡して保存
+1. execute_sql でデータを取得（応答には result_handle とプレビュー行が含まれる）
+2. result_handle を save_query_result_to_excel に渡して保存（結果の行を書き写さないこと）
 3. 保存完了を報告
 
+結果の傾向や要約を答える場合は、行を読み進めずに profile_result の統計を使ってください。
+
+数万行を超えるような大量データの出力は、execute_sql を使わず export_sql_to_file で直接保存してください。
+
+複数の集計を1つのExcelにまとめる場合は、execute_sql と save_query_result_to_excel を繰り返さず、export_report に全クエリをまとめて1回で渡してください。
+
 日本語で分かりやすく回答してください。
 """,
-    tools=[_bigquery_toolset, excel_export_tool, list_files_tool]
+    tools=[
+        _bigquery_toolset,
+        result_page_tool,
+        profile_tool,
+        excel_export_tool,
+        columnar_export_tool,
+        split_export_tool,
+        direct_export_tool,
+        report_export_tool,
+        list_files_tool
+    ],
+    before_tool_callback=[answer_metadata_locally, guard_query_budget],
+    after_tool_callback=capture_execute_sql
+)
+
+
+# インポート時はネットワークにアクセスせず、起動後にバックグラウンドで
+# トークン取得と重いライブラリの読み込みを済ませておく
+schedule_warmup(
+    credential_cache.get_credentials,
+    credential_cache.start_background_refresh,
+    warm_imports("openpyxl", "pyarrow.csv", "pyarrow.parquet"),
 )
+report_import_time(__name__, _IMPORT_STARTED)
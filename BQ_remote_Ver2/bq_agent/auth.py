@@ -0,0 +1,140 @@
+"""
+認証ヘッダーの共有キャッシュ
+
+BigQuery MCP Server へのリクエストごとに最新のBearerトークンを付与する。
+トークンは期限切れ前にバックグラウンドスレッドで更新するため、
+リクエスト処理中に credentials.refresh を待つことはない（初回取得前を除く）。
+
+プロセス内の全MCP接続で credential_cache を共有する。
+インポート時にはネットワークアクセスを行わない。
+"""
+import datetime
+import logging
+import os
+import threading
+from typing import Any
+import google.auth
+from google.auth.transport import requests as google_requests
+
+logger = logging.getLogger(__name__)
+
+# プロジェクトID
+PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "agent-vi-473112")
+
+SCOPES = [
+    "https://www.googleapis.com/auth/bigquery",
+    "https://www.googleapis.com/auth/cloud-platform"
+]
+
+# 有効期限の何秒前に更新するか
+REFRESH_MARGIN_SECONDS = 300
+
+# 有効期限が取得できない場合の更新間隔
+DEFAULT_REFRESH_INTERVAL_SECONDS = 45 * 60
+
+# 更新に失敗した場合の再試行間隔
+RETRY_INTERVAL_SECONDS = 30
+
+
+class CredentialCache:
+    """
+    google.auth のデフォルト認証情報を保持し、期限前に自動更新するキャッシュ
+
+    - headers(): 現在のトークンでヘッダーを返す（未取得・期限切れの場合のみその場で更新）
+    - start_background_refresh(): 更新スレッドを開始する（何度呼んでもスレッドは1つ）
+    """
+
+    def __init__(self, scopes: list[str] = SCOPES, refresh_margin: int = REFRESH_MARGIN_SECONDS):
+        self.scopes = scopes
+        self.refresh_margin = refresh_margin
+        self._credentials = None
+        self._project: str | None = None
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    def _load(self):
+        if self._credentials is None:
+            self._credentials, self._project = google.auth.default(scopes=self.scopes)
+        return self._credentials
+
+    def _seconds_until_expiry(self) -> float | None:
+        expiry = getattr(self._credentials, "expiry", None)
+        if expiry is None:
+            return None
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (expiry - now).total_seconds()
+
+    def _needs_refresh(self) -> bool:
+        if self._credentials is None or not self._credentials.token:
+            return True
+        remaining = self._seconds_until_expiry()
+        return remaining is not None and remaining <= self.refresh_margin
+
+    def refresh(self, force: bool = False) -> None:
+        """トークンを更新する（他スレッドが更新済みなら何もしない）"""
+        with self._lock:
+            credentials = self._load()
+            if force or self._needs_refresh():
+                credentials.refresh(google_requests.Request())
+                logger.info(f"Credentials refreshed (expiry={getattr(credentials, 'expiry', None)})")
+
+    def get_credentials(self):
+        """有効なトークンを持つ認証情報を返す"""
+        if self._needs_refresh():
+            self.refresh()
+        return self._credentials
+
+    def headers(self) -> dict[str, str]:
+        """MCPリクエスト用の認証ヘッダー"""
+        credentials = self.get_credentials()
+        return {
+            "Authorization": f"Bearer {credentials.token}",
+            "x-goog-user-project": self._project or PROJECT_ID
+        }
+
+    def _next_refresh_delay(self) -> float:
+        remaining = self._seconds_until_expiry()
+        if remaining is None:
+            return DEFAULT_REFRESH_INTERVAL_SECONDS
+        return max(remaining - self.refresh_margin, 0.0)
+
+    def _refresh_loop(self) -> None:
+        delay = 0.0
+        while not self._stop.wait(delay):
+            try:
+                self.refresh()
+                delay = self._next_refresh_delay()
+            except Exception as e:
+                logger.warning(f"Background credential refresh failed: {e}")
+                delay = RETRY_INTERVAL_SECONDS
+
+    def start_background_refresh(self) -> None:
+        """バックグラウンド更新スレッドを開始する（初回のトークン取得もこのスレッドで行う）"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._refresh_loop,
+                name="bq-credential-refresh",
+                daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+# プロセス全体で共有するキャッシュ
+credential_cache = CredentialCache()
+
+
+def bigquery_header_provider(context: Any = None) -> dict[str, str]:
+    """
+    MCPToolset の header_provider
+
+    リクエストごとに呼ばれ、キャッシュ済みのトークンでヘッダーを返す
+    """
+    credential_cache.start_background_refresh()
+    return credential_cache.headers()
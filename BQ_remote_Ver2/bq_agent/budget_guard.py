@@ -0,0 +1,394 @@
+"""
+スキャン量の上限チェック
+
+execute_sql の実行前にクエリをドライランしてスキャン予定のバイト数を調べ、
+上限を超える場合は実行せずに、パーティション条件を加えた書き換え案と列の絞り込みの案内をモデルに返す。
+結果キャッシュ（query_cache）から返るクエリはBigQueryで実行されないため、見積もらず累計にも加えない。
+
+- 1クエリあたりの上限: BQ_QUERY_MAX_BYTES（既定 10GiB）
+- 累計の上限: BQ_BYTE_BUDGET（既定 100GiB）
+- 累計の単位: BQ_BYTE_BUDGET_SCOPE=session|user（既定 session）。セッションstateに記録する
+- 見積もり値は state（bq_last_estimated_bytes と累計）とログに記録し、budget_guard.metrics() で確認できる
+
+execute_sql を経由せずにクエリを実行する出力ツール（export_sql_to_file など）は check_export_query を呼ぶ。
+こちらは上限に加えてドライランの statement_type で SELECT 文だけを認め、ドライランが失敗したクエリは実行しない。
+"""
+import asyncio
+import logging
+import os
+import re
+import threading
+from typing import Any, Protocol
+
+from .metadata_cache import metadata_cache
+from .query_cache import _READ_ONLY, PROJECT_ID, CachedQueryTool, referenced_tables
+
+logger = logging.getLogger(__name__)
+
+GIB = 1024 ** 3
+
+QUERY_MAX_BYTES = int(os.getenv("BQ_QUERY_MAX_BYTES", str(10 * GIB)))
+BYTE_BUDGET = int(os.getenv("BQ_BYTE_BUDGET", str(100 * GIB)))
+BYTE_BUDGET_SCOPE = os.getenv("BQ_BYTE_BUDGET_SCOPE", "session")
+
+# 書き換え案で補うパーティション条件の期間（日）
+DEFAULT_PARTITION_DAYS = int(os.getenv("BQ_DEFAULT_PARTITION_DAYS", "7"))
+
+# チェック対象のツール名
+GUARDED_TOOLS = ("execute_sql",)
+
+# 出力ツールで実行を認める文の種類（ドライランの statement_type）
+READ_ONLY_STATEMENT_TYPES = ("SELECT",)
+
+# パーティション列の型ごとの直近N日の条件
+_RECENT_PREDICATES = {
+    "DATE": "{col} >= DATE_SUB(CURRENT_DATE(), INTERVAL {days} DAY)",
+    "TIMESTAMP": "{col} >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {days} DAY)",
+    "DATETIME": "{col} >= DATETIME_SUB(CURRENT_DATETIME(), INTERVAL {days} DAY)",
+}
+
+_SIMPLE_SELECT = re.compile(
+    r"^\s*SELECT\s+(?P<columns>.+?)\s+FROM\s+(?P<table>`[^`]+`|[\w\-.]+)"
+    r"(?P<alias>\s+(?:AS\s+)?(?!(?:WHERE|GROUP|HAVING|QUALIFY|WINDOW|ORDER|LIMIT|TABLESAMPLE|FOR)\b)\w+)?"
+    r"(?P<rest>\s.*)?$",
+    re.IGNORECASE | re.DOTALL
+)
+_CLAUSE = re.compile(r"\b(WHERE|GROUP\s+BY|HAVING|QUALIFY|WINDOW|ORDER\s+BY|LIMIT)\b", re.IGNORECASE)
+
+
+class DryRunClient(Protocol):
+    """クエリのスキャン予定バイト数を返すクライアント"""
+
+    def estimate_bytes(self, sql: str) -> int:
+        ...
+
+
+class BigQueryDryRunClient:
+    """BigQueryのドライラン（課金なし）で見積もる DryRunClient"""
+
+    def __init__(self, project_id: str = PROJECT_ID):
+        self.project_id = project_id
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            from google.cloud import bigquery
+            self._client = bigquery.Client(project=self.project_id)
+        return self._client
+
+    def dry_run(self, sql: str) -> tuple[int, str | None]:
+        """(スキャン予定バイト数, 文の種類) を返す"""
+        from google.cloud import bigquery
+
+        config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+        job = self._get_client().query(sql, job_config=config)
+        return job.total_bytes_processed or 0, job.statement_type
+
+    def estimate_bytes(self, sql: str) -> int:
+        return self.dry_run(sql)[0]
+
+
+def _format_bytes(size: int) -> str:
+    value = float(size)
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if value < 1024:
+            return f"{value:.0f}{unit}" if unit == "B" else f"{value:.1f}{unit}"
+        value /= 1024
+    return f"{value:.1f}TiB"
+
+
+def _table_info(table: str) -> dict[str, Any] | None:
+    project, dataset, name = table.split(".")
+    return metadata_cache.tables(project, dataset).value.get(name)
+
+
+def suggest_rewrite(sql: str, days: int = DEFAULT_PARTITION_DAYS) -> tuple[str | None, list[str]]:
+    """
+    1テーブルへの単純なSELECTに、パーティション列の条件を加えた形に書き換える
+
+    返す列は変えない（SELECT * の場合は列の一覧を notes で案内し、選ぶのはモデルに任せる）
+
+    Returns:
+        (書き換え後のSQL, 書き換え内容の説明)。書き換えられない場合のSQLは None
+    """
+    tables = referenced_tables(sql)
+    match = _SIMPLE_SELECT.match(sql.strip().rstrip(";"))
+    if not match or not tables or len(tables) != 1:
+        return None, ["複数テーブルや副問い合わせを含むため自動で書き換えできません。"]
+
+    info = _table_info(tables[0])
+    if info is None:
+        return None, [f"{tables[0]} のスキーマを取得できません。"]
+
+    columns = match.group("columns").strip()
+    rest = (match.group("rest") or "").strip()
+    alias = match.group("alias") or ""
+    fields = {field["name"].lower(): field for field in info["schema"]["fields"]}
+    notes = []
+
+    # SELECT * は結果が変わるため書き換えず、列の一覧を案内する
+    if columns == "*":
+        notes.append(
+            "SELECT * のままでは全列をスキャンします。必要な列だけを指定してください"
+            f"（列: {', '.join(f['name'] for f in info['schema']['fields'][:30])}）。"
+        )
+
+    # パーティション列の条件がなければ直近N日の条件を加える
+    partition = info.get("partitioning", {}).get("field")
+    if partition:
+        where = re.search(r"\bWHERE\b(?P<cond>.*?)(?=\b(?:GROUP\s+BY|HAVING|QUALIFY|WINDOW|ORDER\s+BY|LIMIT)\b|$)",
+                          rest, re.IGNORECASE | re.DOTALL)
+        if not where or not re.search(rf"\b{re.escape(partition)}\b", where.group("cond"), re.IGNORECASE):
+            field_type = str(fields.get(partition.lower(), {}).get("type", "")).upper()
+            template = _RECENT_PREDICATES.get(field_type)
+            if template is None:
+                # 整数範囲パーティションなど、直近N日の条件を作れない型には条件を加えない
+                notes.append(f"パーティション列 {partition}（{field_type or '型不明'}）で範囲を絞り込む条件を追加してください。")
+            else:
+                predicate = template.format(col=partition, days=days)
+                if where:
+                    rest = f"{rest[:where.start('cond')]} {predicate} AND ({where.group('cond').strip()}) {rest[where.end('cond'):]}".strip()
+                else:
+                    clause = _CLAUSE.search(rest)
+                    head, tail = (rest[:clause.start()], rest[clause.start():]) if clause else (rest, "")
+                    rest = f"{head} WHERE {predicate} {tail}".strip()
+                notes.append(f"パーティション列 {partition} に直近{days}日の条件を追加しました（期間は質問に合わせて調整してください）。")
+
+    rewritten = f"SELECT {columns} FROM {match.group('table')}{alias} {rest}".strip()
+    if rewritten == re.sub(r"\s+", " ", sql.strip().rstrip(";")):
+        return None, notes
+    return re.sub(r"[ \t]+", " ", rewritten), notes
+
+
+class BudgetGuard:
+    """ドライランの見積もりで1クエリ/累計の上限を確認する"""
+
+    def __init__(
+        self,
+        client: DryRunClient | None = None,
+        query_max_bytes: int = QUERY_MAX_BYTES,
+        budget_bytes: int = BYTE_BUDGET,
+        scope: str = BYTE_BUDGET_SCOPE
+    ):
+        self.query_max_bytes = query_max_bytes
+        self.budget_bytes = budget_bytes
+        self.scope = scope
+        self._client = client
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._blocked = 0
+        self._estimated_total = 0
+
+    @property
+    def client(self) -> DryRunClient:
+        if self._client is None:
+            self._client = BigQueryDryRunClient()
+        return self._client
+
+    def set_client(self, client: DryRunClient | None) -> None:
+        """DryRunClient を差し替える（None で既定に戻す）"""
+        self._client = client
+
+    @property
+    def state_key(self) -> str:
+        # "user:" 接頭辞のstateはユーザー単位で全セッションに共有される
+        return "user:bq_bytes_estimated" if self.scope == "user" else "bq_bytes_estimated"
+
+    def metrics(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "checked": self._checked,
+                "blocked": self._blocked,
+                "estimated_bytes_total": self._estimated_total,
+            }
+
+    def _dry_run(self, sql: str) -> tuple[int, str | None]:
+        # dry_run を持たない DryRunClient では文の種類は分からない
+        dry_run = getattr(self.client, "dry_run", None)
+        if dry_run is not None:
+            return dry_run(sql)
+        return self.client.estimate_bytes(sql), None
+
+    def check(
+        self,
+        sql: str,
+        used_bytes: int,
+        require_select: bool = False,
+        tool_name: str = "execute_sql"
+    ) -> tuple[int, dict[str, Any] | None]:
+        """
+        ドライランで見積もり、(スキャン予定バイト数, 実行しない場合にモデルへ返す応答) を返す（同期処理）
+
+        上限内の場合、応答は None。require_select=True ではSELECT文以外も実行しない
+        """
+        estimated, statement_type = self.dry_run(sql)
+        return estimated, self.apply_limits(sql, estimated, statement_type, used_bytes, require_select, tool_name)
+
+    def dry_run(self, sql: str) -> tuple[int, str | None]:
+        """ドライランだけを行い、(スキャン予定バイト数, 文の種類) を返す（同期処理）"""
+        estimated, statement_type = self._dry_run(sql)
+        with self._lock:
+            self._checked += 1
+        logger.info(f"Dry run estimated {_format_bytes(estimated)}")
+        return estimated, statement_type
+
+    def apply_limits(
+        self,
+        sql: str,
+        estimated: int,
+        statement_type: str | None,
+        used_bytes: int,
+        require_select: bool = False,
+        tool_name: str = "execute_sql"
+    ) -> dict[str, Any] | None:
+        """
+        ドライランの結果に上限を適用し、実行しない場合にモデルへ返す応答を返す（上限内なら None）
+
+        上限を超える場合は書き換え案を作り、その見積もりのためにドライランすることがある（同期処理）
+        """
+        if require_select:
+            # 文の種類が分からない場合はSQLの先頭で判定する
+            read_only = (
+                statement_type in READ_ONLY_STATEMENT_TYPES if statement_type
+                else bool(_READ_ONLY.match(sql))
+            )
+            if not read_only:
+                with self._lock:
+                    self._blocked += 1
+                return {
+                    "error": f"クエリは実行されませんでした: {tool_name} ではSELECT文だけを実行できます"
+                             f"（文の種類: {statement_type or '不明'}）。",
+                    "statement_type": statement_type,
+                }
+
+        if estimated <= self.query_max_bytes and used_bytes + estimated <= self.budget_bytes:
+            with self._lock:
+                self._estimated_total += estimated
+            return None
+
+        with self._lock:
+            self._blocked += 1
+        if estimated > self.query_max_bytes:
+            reason = f"1クエリあたりの上限 {_format_bytes(self.query_max_bytes)} を超えます"
+        else:
+            reason = f"{self.scope}の累計上限 {_format_bytes(self.budget_bytes)} を超えます（使用済み {_format_bytes(used_bytes)}）"
+
+        try:
+            suggested, notes = suggest_rewrite(sql)
+        except Exception as e:
+            logger.info(f"Query rewrite skipped: {e}")
+            suggested, notes = None, []
+        response = {
+            "error": f"クエリは実行されませんでした: スキャン予定 {_format_bytes(estimated)} が{reason}。",
+            "estimated_bytes": estimated,
+            "query_max_bytes": self.query_max_bytes,
+            "budget_bytes": self.budget_bytes,
+            "used_bytes": used_bytes,
+            "notes": notes,
+        }
+        if suggested:
+            response["suggested_query"] = suggested
+            try:
+                response["suggested_query_estimated_bytes"] = self.client.estimate_bytes(suggested)
+            except Exception as e:
+                logger.info(f"Dry run of suggested query failed: {e}")
+        response["message"] = (
+            f"必要な列だけを選び、パーティション列で期間を絞ってから {tool_name} を再実行してください。"
+            + ("suggested_query を参考にできます。" if suggested else "")
+        )
+        return response
+
+
+# プロセス全体で共有するチェッカー
+budget_guard = BudgetGuard()
+
+
+async def guard_query_budget(
+    tool: Any,
+    args: dict[str, Any],
+    tool_context: Any,
+) -> dict[str, Any] | None:
+    """
+    before_tool_callback: execute_sql をドライランし、上限を超える場合は実行せずに書き換え案を返す
+
+    ドライラン自体が失敗した場合（構文エラーなど）は通常どおり実行し、エラーはツールに任せる。
+    結果キャッシュから返るクエリはドライランせず、累計にも加えない
+    """
+    if getattr(tool, "name", None) not in GUARDED_TOOLS:
+        return None
+    sql = args.get("query") or args.get("sql")
+    if not isinstance(sql, str):
+        return None
+    if isinstance(tool, CachedQueryTool) and await tool.cache.has_result(args):
+        logger.info("Budget check skipped (query cache hit)")
+        return None
+
+    state = getattr(tool_context, "state", None)
+    used_bytes = int(state.get(budget_guard.state_key, 0)) if state is not None else 0
+    try:
+        estimated, blocked = await asyncio.to_thread(budget_guard.check, sql, used_bytes)
+    except Exception as e:
+        logger.info(f"Budget check skipped: {e}")
+        return None
+
+    _record_estimate(state, used_bytes, estimated, blocked)
+    return blocked
+
+
+def _record_estimate(state: Any, used_bytes: int, estimated: int, blocked: dict[str, Any] | None) -> None:
+    """見積もり値と、実行する場合は累計をstateに記録する"""
+    if state is not None:
+        state["bq_last_estimated_bytes"] = estimated
+        if blocked is None:
+            state[budget_guard.state_key] = used_bytes + estimated
+
+
+async def check_export_query(sql: str, tool_context: Any, tool_name: str) -> dict[str, Any] | None:
+    """
+    出力ツールのクエリをドライランし、SELECT文で上限内なら None、そうでなければモデルに返す応答を返す
+
+    execute_sql と違い、ドライラン自体が失敗したクエリ（構文エラーなど）も実行しない
+    """
+    return (await check_export_queries([sql], tool_context, tool_name))[0]
+
+
+async def check_export_queries(
+    sqls: list[str],
+    tool_context: Any,
+    tool_name: str,
+    semaphore: asyncio.Semaphore | None = None
+) -> list[dict[str, Any] | None]:
+    """
+    出力ツールの複数のクエリを並行してドライランし、指定した順に上限を適用する
+
+    ドライランは semaphore の範囲で同時に行い、1クエリ/累計の上限は見積もりが揃ってから
+    先頭のクエリから順に確認する（前のクエリの見積もりを累計に加えてから次を確認する）。
+
+    Returns:
+        クエリごとの check_export_query と同じ応答（実行できるクエリは None）
+    """
+    semaphore = semaphore or asyncio.Semaphore(max(len(sqls), 1))
+
+    async def dry_run(sql: str) -> tuple[int, str | None]:
+        async with semaphore:
+            return await asyncio.to_thread(budget_guard.dry_run, sql)
+
+    results = await asyncio.gather(*(dry_run(sql) for sql in sqls), return_exceptions=True)
+
+    state = getattr(tool_context, "state", None)
+    checked = []
+    for sql, result in zip(sqls, results):
+        if isinstance(result, Exception):
+            logger.info(f"Export query rejected by dry run: {result}")
+            checked.append({"error": f"クエリは実行されませんでした: ドライランに失敗しました: {result}"})
+            continue
+        if isinstance(result, BaseException):
+            raise result
+        estimated, statement_type = result
+        used_bytes = int(state.get(budget_guard.state_key, 0)) if state is not None else 0
+        blocked = await asyncio.to_thread(
+            budget_guard.apply_limits, sql, estimated, statement_type, used_bytes, True, tool_name
+        )
+        _record_estimate(state, used_bytes, estimated, blocked)
+        checked.append(blocked)
+    return checked
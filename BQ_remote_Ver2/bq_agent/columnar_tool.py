@@ -0,0 +1,138 @@
+"""
+列指向ファイル出力ツール
+
+正規化済みのクエリ結果（pyarrow.Table）を Parquet または Arrow IPC として保存する。
+pandas / DuckDB で再読み込みする分析用途向けで、xlsx より小さく高速に読み書きできる。
+"""
+from typing import Any, BinaryIO
+
+from .artifact_store import run_to_file, save_file_artifact
+from .excel_tool import _normalize_bq_data
+from .export_executor import ExportQueueFullError
+from .export_index import record_export
+from .file_writers import MIME_TYPES, open_batch_writer
+from .result_store import load_query_result, result_handle_sql
+
+
+# 出力形式ごとに指定できる圧縮方式
+COLUMNAR_COMPRESSIONS = {
+    "parquet": ("zstd", "snappy", "gzip", "brotli", "lz4", "none"),
+    "arrow": ("zstd", "lz4", "none"),
+}
+
+# Parquetの行グループサイズ（既定値）
+DEFAULT_ROW_GROUP_SIZE = 128 * 1024
+
+
+def build_columnar_file(
+    data: Any,
+    fmt: str,
+    row_group_size: int,
+    options: dict[str, Any],
+    fileobj: BinaryIO
+) -> tuple[int, int] | None:
+    """
+    データを正規化して Parquet / Arrow IPC を fileobj に書き込む（同期処理）
+
+    Returns:
+        (行数, 列数)。データが空の場合は None
+    """
+    table = _normalize_bq_data(data)
+    if table.num_rows == 0 or table.num_columns == 0:
+        return None
+
+    writer = open_batch_writer(fmt, fileobj, table.schema, **options)
+    for batch in table.to_batches(max_chunksize=row_group_size):
+        writer.write_batch(batch)
+    writer.close()
+    return table.num_rows, table.num_columns
+
+
+async def save_query_result_to_columnar(
+    filename: str,
+    result_handle: str = "",
+    query_result: str = "",
+    format: str = "parquet",
+    compression: str = "zstd",
+    row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+    tool_context: Any = None
+) -> dict[str, Any]:
+    """
+    クエリ結果を Parquet または Arrow IPC ファイルとして保存する
+
+    Args:
+        filename: 保存するファイル名（拡張子は自動付与）
+        result_handle: execute_sqlの応答に含まれる結果ハンドル
+        query_result: execute_sqlの結果（JSON文字列）。result_handleがない場合のみ使用
+        format: "parquet" または "arrow"（Arrow IPC / Feather V2）
+        compression: 圧縮方式（parquet: zstd/snappy/gzip/brotli/lz4/none、arrow: zstd/lz4/none）
+        row_group_size: Parquetの行グループあたりの行数
+        tool_context: ADKのToolContext
+
+    Returns:
+        dict: 保存結果
+    """
+    fmt = format.lower().lstrip(".")
+    if fmt not in COLUMNAR_COMPRESSIONS:
+        return {"success": False, "error": f"未対応の出力形式です: {format}（parquet / arrow のいずれか）"}
+
+    codec = compression.lower()
+    if codec not in COLUMNAR_COMPRESSIONS[fmt]:
+        return {
+            "success": False,
+            "error": f"{fmt} では圧縮方式 {compression} は使えません（{', '.join(COLUMNAR_COMPRESSIONS[fmt])}）"
+        }
+    if row_group_size <= 0:
+        return {"success": False, "error": "row_group_size は1以上を指定してください。"}
+
+    if not tool_context:
+        return {"success": False, "error": "ToolContextが提供されていません。"}
+
+    data, error = load_query_result(tool_context, result_handle, query_result)
+    if error:
+        return {"success": False, "error": error}
+
+    if not filename.endswith(f".{fmt}"):
+        filename = f"{filename}.{fmt}"
+
+    options: dict[str, Any] = {"compression": None if codec == "none" else codec}
+    if fmt == "parquet":
+        options["row_group_size"] = row_group_size
+
+    try:
+        built, fileobj, queue_wait = await run_to_file(
+            build_columnar_file, data, fmt, row_group_size, options
+        )
+    except ExportQueueFullError as e:
+        return {"success": False, "error": str(e)}
+
+    with fileobj:
+        if built is None:
+            return {"success": False, "error": "データが空です。ファイルを作成できません。"}
+        rows, columns = built
+
+        try:
+            saved = await save_file_artifact(tool_context, filename, fileobj, MIME_TYPES[fmt])
+        except Exception as e:
+            return {
+                "success": False,
+                "error": f"Artifact保存エラー: {str(e)}",
+                "filename": filename
+            }
+
+    record_export(
+        tool_context, filename,
+        format=fmt, rows=rows, columns=columns,
+        source_query=result_handle_sql(tool_context, result_handle) if result_handle else None, **saved
+    )
+    return {
+        "success": True,
+        "filename": filename,
+        "format": fmt,
+        "compression": codec,
+        "rows": rows,
+        "columns": columns,
+        **saved,
+        "queue_wait_ms": round(queue_wait * 1000, 1),
+        "message": f"{fmt}ファイル '{filename}' を保存しました（{rows}行 x {columns}列）"
+    }
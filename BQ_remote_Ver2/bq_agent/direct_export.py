@@ -0,0 +1,218 @@
+"""
+SQL → ファイル直接出力ツール
+
+クエリを実行し、結果テーブルを BigQuery Storage Read API から Arrow の
+RecordBatch として1バッチずつ読み出して xlsx / csv / parquet / Arrow IPC に書き込む。
+結果はLLMを経由せず、全件をメモリに保持することもない。
+実行前に budget_guard のドライランで、SELECT文であることとスキャン量の上限を確認する。
+
+BigQueryへのアクセスは ExportClient に切り出しているため、
+set_export_client() で InMemoryExportClient などに差し替えてオフラインで動作確認できる
+（ドライランは budget_guard.set_client() で差し替える）。
+"""
+import logging
+import os
+from typing import Any, Iterator, Protocol
+import pyarrow as pa
+
+from .artifact_store import run_to_file, save_file_artifact
+from .budget_guard import check_export_query
+from .export_executor import ExportQueueFullError
+from .export_index import record_export
+from .file_writers import EXPORT_FORMATS, MIME_TYPES, open_batch_writer
+
+logger = logging.getLogger(__name__)
+
+# プロジェクトID
+PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "agent-vi-473112")
+
+
+class ExportClient(Protocol):
+    """クエリ結果をArrowのバッチ列として返すクライアント"""
+
+    def query_batches(self, sql: str) -> tuple[pa.Schema, Iterator[pa.RecordBatch]]:
+        ...
+
+
+class BigQueryStorageExportClient:
+    """
+    BigQuery + Storage Read API を使う ExportClient
+
+    クエリジョブの完了を待ち、出力先（一時）テーブルをARROW形式の読み取りセッションで読む。
+    ORDER BY の順序を保つため、ストリーム数は1に固定する。
+    """
+
+    def __init__(self, project_id: str = PROJECT_ID):
+        self.project_id = project_id
+        self._bq_client = None
+        self._read_client = None
+
+    def _clients(self):
+        if self._bq_client is None:
+            from google.cloud import bigquery
+            from google.cloud.bigquery_storage import BigQueryReadClient
+            self._bq_client = bigquery.Client(project=self.project_id)
+            self._read_client = BigQueryReadClient()
+        return self._bq_client, self._read_client
+
+    def query_batches(self, sql: str) -> tuple[pa.Schema, Iterator[pa.RecordBatch]]:
+        from google.cloud.bigquery_storage import types as bqs_types
+
+        bq_client, read_client = self._clients()
+        job = bq_client.query(sql)
+        job.result()
+        dest = job.destination
+
+        session = read_client.create_read_session(
+            parent=f"projects/{self.project_id}",
+            read_session=bqs_types.ReadSession(
+                table=f"projects/{dest.project}/datasets/{dest.dataset_id}/tables/{dest.table_id}",
+                data_format=bqs_types.DataFormat.ARROW,
+            ),
+            max_stream_count=1,
+        )
+        schema = pa.ipc.read_schema(pa.py_buffer(session.arrow_schema.serialized_schema))
+
+        def batches() -> Iterator[pa.RecordBatch]:
+            for stream in session.streams:
+                reader = read_client.read_rows(stream.name)
+                for page in reader.rows(session).pages:
+                    yield from page.to_arrow().to_batches()
+
+        return schema, batches()
+
+
+class InMemoryExportClient:
+    """
+    オフライン確認用の ExportClient
+
+    SQL文字列 → pyarrow.Table の対応表から結果を返す
+    """
+
+    def __init__(self, tables: dict[str, pa.Table], batch_size: int = 1024):
+        self.tables = tables
+        self.batch_size = batch_size
+
+    def query_batches(self, sql: str) -> tuple[pa.Schema, Iterator[pa.RecordBatch]]:
+        if sql not in self.tables:
+            raise KeyError(f"未登録のクエリです: {sql}")
+        table = self.tables[sql]
+        return table.schema, iter(table.to_batches(max_chunksize=self.batch_size))
+
+
+_export_client: ExportClient | None = None
+
+
+def get_export_client() -> ExportClient:
+    """共有の ExportClient を返す（初回呼び出し時に作成）"""
+    global _export_client
+    if _export_client is None:
+        _export_client = BigQueryStorageExportClient()
+    return _export_client
+
+
+def set_export_client(client: ExportClient | None) -> None:
+    """ExportClient を差し替える（None で既定のクライアントに戻す）"""
+    global _export_client
+    _export_client = client
+
+
+def write_query_to_file(
+    client: ExportClient,
+    sql: str,
+    fmt: str,
+    fileobj: Any,
+    sheet_name: str = "QueryResult",
+) -> int:
+    """
+    クエリ結果をバッチ単位でファイルへ書き込み、書き込んだ行数を返す
+
+    同期処理のため、イベントループからは export_executor 経由で呼び出す
+    """
+    schema, batches = client.query_batches(sql)
+    options = {"sheet_name": sheet_name} if fmt == "xlsx" else {}
+    writer = open_batch_writer(fmt, fileobj, schema, **options)
+    rows = 0
+    for batch in batches:
+        writer.write_batch(batch)
+        rows += batch.num_rows
+    writer.close()
+    return rows
+
+
+def _write_query_result(sql: str, fmt: str, fileobj: Any) -> int:
+    """
+    共有の ExportClient でクエリ結果を fileobj に書き込む（run_to_file から呼ぶ同期処理）
+
+    クライアントは引数で渡さず実行先で取得するため、process モードでは
+    子プロセスが自身の既定クライアントを作る
+    """
+    return write_query_to_file(get_export_client(), sql, fmt, fileobj)
+
+
+async def export_sql_to_file(
+    sql: str,
+    format: str = "xlsx",
+    filename: str = "query_result",
+    tool_context: Any = None
+) -> dict[str, Any]:
+    """
+    SQLを実行し、結果をファイルへ直接出力する（大量データ向け）
+
+    結果はモデルに返さず、Storage Read API からバッチ単位で読み出して書き込む
+
+    Args:
+        sql: 実行するSQL（SELECT文）
+        format: 出力形式（"xlsx" / "csv" / "parquet" / "arrow"）
+        filename: 保存するファイル名（拡張子は自動付与）
+        tool_context: ADKのToolContext
+
+    Returns:
+        dict: 保存結果
+    """
+    fmt = format.lower().lstrip(".")
+    if fmt not in EXPORT_FORMATS:
+        return {
+            "success": False,
+            "error": f"未対応の出力形式です: {format}（{', '.join(EXPORT_FORMATS)} のいずれか）"
+        }
+    if not tool_context:
+        return {"success": False, "error": "ToolContextが提供されていません。"}
+
+    if not filename.endswith(f".{fmt}"):
+        filename = f"{filename}.{fmt}"
+
+    # SELECT文以外と、スキャン量の上限を超えるクエリは実行しない
+    blocked = await check_export_query(sql, tool_context, "export_sql_to_file")
+    if blocked is not None:
+        return {"success": False, **blocked}
+
+    # 書き込みは他の出力ツールと同じ export_executor の同時実行数・待ち行列の上限に従う
+    try:
+        rows, fileobj, _ = await run_to_file(_write_query_result, sql, fmt)
+    except ExportQueueFullError as e:
+        return {"success": False, "error": str(e)}
+    except Exception as e:
+        logger.error(f"Direct export error: {e}")
+        return {"success": False, "error": f"クエリ実行/書き込みエラー: {str(e)}"}
+
+    with fileobj:
+        # 一時ファイルのまま渡し、大きいファイルは BlobStore への参照で保存する
+        try:
+            saved = await save_file_artifact(tool_context, filename, fileobj, MIME_TYPES[fmt])
+        except Exception as e:
+            return {
+                "success": False,
+                "error": f"Artifact保存エラー: {str(e)}",
+                "filename": filename
+            }
+
+    record_export(tool_context, filename, format=fmt, rows=rows, source_query=sql, **saved)
+    return {
+        "success": True,
+        "filename": filename,
+        "format": fmt,
+        "rows": rows,
+        **saved,
+        "message": f"クエリ結果を '{filename}' に保存しました（{rows}行）"
+    }
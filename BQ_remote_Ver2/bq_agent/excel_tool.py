@@ -3,197 +3,385 @@ Excel出力用ツール
 
 BigQueryから取得したデータをExcelファイルとしてArtifactsに保存する
 """
-import io
-from typing import Any
-import google.genai.types as types
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
-from openpyxl.utils import get_column_letter
+import json
+from functools import partial
+from typing import TYPE_CHECKING, Any, BinaryIO, Sequence
+import pyarrow as pa
 
+from .artifact_store import run_to_file, save_file_artifact
+from .bq_result import normalize_bq_result, iter_table_rows, rows_to_table
+from .export_executor import ExportQueueFullError, export_executor
+from .export_index import content_key, find_export, list_exports, record_export, reuse_export, reused_response
+from .json_stream import iter_row_batches, stream_query_result
 
-def _extract_value(val: Any) -> Any:
+# 結果JSONを逐次デコードする際に、まとめて正規化する行数
+# （デコード直後の f/v 行は1セルごとに辞書を持つため、列配列よりはるかに大きい）
+JSON_ROW_BATCH_SIZE = 1_000
+
+# openpyxl は起動時間短縮のため、ワークブックを作る時点で読み込む
+if TYPE_CHECKING:
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+
+
+def _normalize_bq_data(data: Any) -> pa.Table:
     """
-    BigQueryの結果形式から実際の値を抽出する
-    
-    BigQueryは {'v': value} 形式で値を返すことがある
-    """
-    if isinstance(val, dict):
-        if 'v' in val:
-            return _extract_value(val['v'])
-        return str(val)
-    elif isinstance(val, list):
-        return [_extract_value(v) for v in val]
-    else:
-        return val
+    BigQueryの様々な結果形式を型付きの列配列（pyarrow.Table）に変換する
+
+    schema.fields がある場合は列名と型（数値・日付・時刻）をスキーマに従って復元し、
+    STRUCT/ARRAYもスキーマに沿って展開する
+    """
+    return normalize_bq_result(data)
+
+
+# スタイル名（ワークブック単位で共有するNamedStyle）
+HEADER_STYLE_NAME = "bq_header"
+BODY_STYLE_NAME = "bq_body"
+
+# 列幅の推定に使う先頭行数
+WIDTH_SAMPLE_ROWS = 100
+
+# 列幅の上限
+MAX_COLUMN_WIDTH = 50
+
+# Excelの1シートあたりの最大行数（ヘッダー行を含む）
+EXCEL_MAX_ROWS = 1_048_576
+
+# シート名の最大文字数
+MAX_SHEET_NAME_LENGTH = 31
+
+
+def _register_styles(wb: "Workbook") -> None:
+    """
+    ヘッダー/データ行用のNamedStyleをワークブックに登録する
 
+    セルごとにFontやAlignmentを生成せず、登録済みのスタイルを名前で参照させる
+    """
+    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
 
-def _normalize_bq_data(data: Any) -> list[dict[str, Any]]:
+    thin_border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+    header_style = NamedStyle(
+        name=HEADER_STYLE_NAME,
+        font=Font(bold=True, color="FFFFFF"),
+        fill=PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid"),
+        alignment=Alignment(horizontal="center", vertical="center"),
+        border=thin_border
+    )
+    body_style = NamedStyle(
+        name=BODY_STYLE_NAME,
+        alignment=Alignment(vertical="center"),
+        border=thin_border
+    )
+    for style in (header_style, body_style):
+        if style.name not in wb.named_styles:
+            wb.add_named_style(style)
+
+
+class StreamingSheetWriter:
     """
-    BigQueryの様々な結果形式を統一された辞書リストに変換する
+    write_onlyワークブックのシートへ行を逐次書き込むライター
+
+    列幅は先頭 sample_rows 行だけを見て決め、決まった時点でバッファを書き出す。
+    以降の行はそのままシートへ流すため、メモリ使用量は行数に依存しない。
     """
-    if not data:
-        return []
+
+    def __init__(
+        self,
+        wb: "Workbook",
+        sheet_name: str,
+        headers: list[str],
+        sample_rows: int = WIDTH_SAMPLE_ROWS
+    ):
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.utils import get_column_letter
+
+        self._cell_class = WriteOnlyCell
+        self._column_letter = get_column_letter
+        _register_styles(wb)
+        self._ws = wb.create_sheet(title=sheet_name)
+        self._headers = [str(h) for h in headers]
+        self._sample_rows = sample_rows
+        self._pending: list[Sequence[Any]] | None = []
+        self._widths = [len(h) for h in self._headers]
+        self.rows_written = 0
+
+    @property
+    def worksheet(self) -> Any:
+        return self._ws
+
+    @property
+    def title(self) -> str:
+        """作成したシートの実際の名前（同名のシートがあるとopenpyxlが番号を付ける）"""
+        return self._ws.title
+
+    def _cell(self, value: Any, style_name: str) -> "WriteOnlyCell":
+        cell = self._cell_class(self._ws, value=value)
+        cell.style = style_name
+        return cell
+
+    def _flush_sample(self) -> None:
+        """サンプル行から列幅を確定し、ヘッダーとバッファ済みの行を書き出す"""
+        for col_idx, width in enumerate(self._widths, 1):
+            self._ws.column_dimensions[self._column_letter(col_idx)].width = min(
+                width + 2, MAX_COLUMN_WIDTH
+            )
+        self._ws.append([self._cell(h, HEADER_STYLE_NAME) for h in self._headers])
+        pending, self._pending = self._pending, None
+        for values in pending:
+            self._write(values)
+
+    def _write(self, values: Sequence[Any]) -> None:
+        self._ws.append([self._cell(v, BODY_STYLE_NAME) for v in values])
+        self.rows_written += 1
+
+    def append(self, values: Sequence[Any]) -> None:
+        """1行分の値を書き込む（サンプル収集中はバッファする）"""
+        if self._pending is None:
+            self._write(values)
+            return
+
+        for col_idx, value in enumerate(values):
+            if value is not None and col_idx < len(self._widths):
+                self._widths[col_idx] = max(self._widths[col_idx], len(str(value)))
+        self._pending.append(values)
+        if len(self._pending) >= self._sample_rows:
+            self._flush_sample()
+
+    def close(self) -> int:
+        """残りのバッファを書き出してオートフィルターを設定し、書き込んだ行数を返す"""
+        if self._pending is not None:
+            self._flush_sample()
+        last_col = self._column_letter(max(len(self._headers), 1))
+        self._ws.auto_filter.ref = f"A1:{last_col}{self.rows_written + 1}"
+        return self.rows_written
+
+
+def spill_sheet_name(base_name: str, index: int) -> str:
+    """分割シートの名前（2枚目以降は "_2", "_3"... を付与し、31文字に収める）"""
+    if index <= 1:
+        return base_name[:MAX_SHEET_NAME_LENGTH]
+    suffix = f"_{index}"
+    return f"{base_name[:MAX_SHEET_NAME_LENGTH - len(suffix)]}{suffix}"
+
+
+class SpillingWorkbookWriter:
+    """
+    行数が rows_per_sheet に達したら次のシートへ書き進めるライター
+
+    既定ではExcelのシート上限（1,048,576行）で自動的に分割する
+    """
+
+    def __init__(
+        self,
+        wb: "Workbook",
+        sheet_name: str,
+        headers: list[str],
+        rows_per_sheet: int = EXCEL_MAX_ROWS - 1
+    ):
+        self._wb = wb
+        self._base_name = sheet_name
+        self._headers = headers
+        self._rows_per_sheet = min(rows_per_sheet, EXCEL_MAX_ROWS - 1)
+        self._sheet: StreamingSheetWriter | None = None
+        self.worksheets: list[Any] = []
+        self.sheet_names: list[str] = []
+        self.rows_written = 0
+
+    def _next_sheet(self) -> StreamingSheetWriter:
+        if self._sheet is not None:
+            self._sheet.close()
+        name = spill_sheet_name(self._base_name, len(self.sheet_names) + 1)
+        self._sheet = StreamingSheetWriter(self._wb, name, self._headers)
+        self.worksheets.append(self._sheet.worksheet)
+        self.sheet_names.append(self._sheet.title)
+        return self._sheet
+
+    def append(self, values: Sequence[Any]) -> None:
+        sheet = self._sheet
+        if sheet is None or sheet.rows_written >= self._rows_per_sheet:
+            sheet = self._next_sheet()
+        sheet.append(values)
+        self.rows_written += 1
+
+    def close(self) -> int:
+        """最後のシートを閉じ、全シート合計の行数を返す"""
+        if self._sheet is None:
+            self._next_sheet()
+        self._sheet.close()
+        return self.rows_written
+
+
+def build_excel_file(data: Any, sheet_name: str, fileobj: BinaryIO) -> dict[str, Any] | None:
+    """
+    データを正規化してExcelファイルを fileobj に書き込み、行数などを返す（同期処理）
+
+    CPUを占有するため、export_executor 経由でイベントループの外で実行する。
+    データが空の場合は None を返す
+    """
+    table = _normalize_bq_data(data)
+    if table.num_rows == 0 or table.num_columns == 0:
+        return None
     
-    # 既に正規化された形式の場合
-    if isinstance(data, list) and len(data) > 0:
-        first_row = data[0]
-        
-        # 標準的な辞書リスト形式
-        if isinstance(first_row, dict) and 'f' not in first_row and 'v' not in first_row:
-            normalized = []
-            for row in data:
-                normalized_row = {}
-                for key, val in row.items():
-                    normalized_row[key] = _extract_value(val)
-                normalized.append(normalized_row)
-            return normalized
-        
-        # BigQuery行形式: [{"f": [{"v": val1}, {"v": val2}]}, ...]
-        if isinstance(first_row, dict) and 'f' in first_row:
-            headers = [f"column_{i}" for i in range(len(first_row['f']))]
-            normalized = []
-            for row in data:
-                fields = row.get('f', [])
-                normalized_row = {}
-                for i, field in enumerate(fields):
-                    col_name = headers[i] if i < len(headers) else f"column_{i}"
-                    normalized_row[col_name] = _extract_value(field)
-                normalized.append(normalized_row)
-            return normalized
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
     
-    # 辞書形式（schema + rows）
-    if isinstance(data, dict):
-        rows = data.get('rows', [])
-        schema = data.get('schema', {})
-        fields = schema.get('fields', [])
-        
-        headers = [f.get('name', f'column_{i}') for i, f in enumerate(fields)]
-        
-        if not headers and rows:
-            first_row = rows[0] if rows else {}
-            if isinstance(first_row, dict) and 'f' in first_row:
-                headers = [f"column_{i}" for i in range(len(first_row['f']))]
-            elif isinstance(first_row, list):
-                headers = [f"column_{i}" for i in range(len(first_row))]
-        
-        normalized = []
-        for row in rows:
-            if isinstance(row, dict) and 'f' in row:
-                fields_data = row['f']
-                normalized_row = {}
-                for i, field in enumerate(fields_data):
-                    col_name = headers[i] if i < len(headers) else f"column_{i}"
-                    normalized_row[col_name] = _extract_value(field)
-                normalized.append(normalized_row)
-            elif isinstance(row, list):
-                normalized_row = {}
-                for i, val in enumerate(row):
-                    col_name = headers[i] if i < len(headers) else f"column_{i}"
-                    normalized_row[col_name] = _extract_value(val)
-                normalized.append(normalized_row)
-            elif isinstance(row, dict):
-                normalized_row = {k: _extract_value(v) for k, v in row.items()}
-                normalized.append(normalized_row)
-        
-        return normalized
+    # ヘッダー行・データ行（列配列から直接行を組み立てる）
+    writer = SpillingWorkbookWriter(wb, sheet_name, table.column_names)
+    for values in iter_table_rows(table):
+        writer.append(values)
+    writer.close()
+    wb.save(fileobj)
     
-    return []
+    return {
+        "rows": table.num_rows,
+        "columns": table.num_columns,
+        "sheets": writer.sheet_names,
+    }
 
 
-async def export_to_excel(
-    data: list[dict[str, Any]],
+def _align_columns(table: pa.Table, names: list[str]) -> pa.Table:
+    """列を names の並びに揃える（ない列はNULL）"""
+    return pa.table({
+        name: table.column(name) if name in table.column_names else pa.nulls(table.num_rows)
+        for name in names
+    })
+
+
+def build_excel_file_from_json(text: str, sheet_name: str, fileobj: BinaryIO) -> dict[str, Any] | None:
+    """
+    結果JSON文字列の rows を1行ずつデコードしながらExcelファイルを fileobj に書き込む（同期処理）
+
+    json.loads で全体をパースしたコピーを作らず、JSON_ROW_BATCH_SIZE 行ずつ正規化して書き込む。
+    スキーマがない結果は後のバッチで初めて現れる列もあるため、列配列にしたバッチを保持し、
+    全行の列がそろってから書き込む。
+    rows を持たない形式は従来どおり全体をパースして build_excel_file に渡す。
+    データが空の場合は None を返す
+    """
+    try:
+        fields, rows = stream_query_result(text)
+    except LookupError:
+        return build_excel_file(json.loads(text), sheet_name, fileobj)
+
+    headers: dict[str, None] = {}
+    tables: list[pa.Table] = []
+    wb = None
+    writer = None
+    for batch in iter_row_batches(rows, JSON_ROW_BATCH_SIZE):
+        table = rows_to_table(batch, fields)
+        if table.num_columns == 0:
+            continue
+        if fields is None:
+            headers.update(dict.fromkeys(table.column_names))
+            tables.append(table)
+            continue
+        if writer is None:
+            from openpyxl import Workbook
+            wb = Workbook(write_only=True)
+            headers = dict.fromkeys(table.column_names)
+            writer = SpillingWorkbookWriter(wb, sheet_name, list(headers))
+        for values in iter_table_rows(table):
+            writer.append(values)
+
+    if tables:
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        writer = SpillingWorkbookWriter(wb, sheet_name, list(headers))
+        # 書き込んだバッチから順に手放す
+        tables.reverse()
+        while tables:
+            table = tables.pop()
+            if table.column_names != list(headers):
+                table = _align_columns(table, list(headers))
+            for values in iter_table_rows(table):
+                writer.append(values)
+
+    if writer is None or writer.rows_written == 0:
+        return None
+    rows_written = writer.close()
+    wb.save(fileobj)
+
+    return {
+        "rows": rows_written,
+        "columns": len(headers),
+        "sheets": writer.sheet_names,
+    }
+
+
+def _normalize_with_key(data: Any, sheet_name: str) -> tuple[pa.Table, str]:
+    """データを正規化し、出力内容のキーとあわせて返す（同期処理）"""
+    table = _normalize_bq_data(data)
+    return table, content_key(table, format="xlsx", sheet_name=sheet_name)
+
+
+def _xlsx_filename(filename: str) -> str:
+    return filename if filename.endswith(".xlsx") else f"{filename}.xlsx"
+
+
+async def _reuse_excel(tool_context: Any, key: str, filename: str) -> dict[str, Any] | None:
+    """同じ内容の出力が保存済みなら再利用し、ツールの応答を返す"""
+    if not tool_context:
+        return None
+    cached = find_export(tool_context, key)
+    if cached is None:
+        return None
+    reused = await reuse_export(tool_context, cached, _xlsx_filename(filename))
+    return reused_response(reused) if reused else None
+
+
+async def _save_excel_artifact(
+    built: dict[str, Any] | None,
+    fileobj: BinaryIO,
+    queue_wait: float,
     filename: str,
-    sheet_name: str = "Sheet1",
-    tool_context: Any = None
+    tool_context: Any,
+    key: str | None = None,
+    source_query: str | None = None
 ) -> dict[str, Any]:
     """
-    データをExcelファイルとして保存し、Artifactとして出力する
+    生成したExcelファイルをArtifactとして保存し、ツールの応答を返す
+
+    大きいファイルはバイト列にせず、artifact_store 経由でGCSへアップロードして参照を保存する。
+    保存したファイルは export_index の索引に記録する
     """
-    normalized_data = _normalize_bq_data(data)
-    
-    if not normalized_data:
+    if built is None:
         return {
             "success": False,
             "error": "データが空です。Excelファイルを作成できません。"
         }
     
-    if not filename.endswith('.xlsx'):
-        filename = f"{filename}.xlsx"
-    
-    wb = Workbook()
-    ws = wb.active
-    ws.title = sheet_name
-    
-    # スタイル定義
-    header_font = Font(bold=True, color="FFFFFF")
-    header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-    header_alignment = Alignment(horizontal="center", vertical="center")
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    # ヘッダー行
-    headers = list(normalized_data[0].keys())
-    for col_idx, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col_idx, value=str(header))
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = header_alignment
-        cell.border = thin_border
+    filename = _xlsx_filename(filename)
     
-    # データ行
-    for row_idx, row_data in enumerate(normalized_data, 2):
-        for col_idx, header in enumerate(headers, 1):
-            value = row_data.get(header, "")
-            if isinstance(value, (list, dict)):
-                value = str(value)
-            cell = ws.cell(row=row_idx, column=col_idx, value=value)
-            cell.border = thin_border
-            cell.alignment = Alignment(vertical="center")
-    
-    # 列幅調整
-    for col_idx, header in enumerate(headers, 1):
-        max_length = len(str(header))
-        for row in ws.iter_rows(min_row=2, min_col=col_idx, max_col=col_idx):
-            for cell in row:
-                try:
-                    if cell.value:
-                        max_length = max(max_length, len(str(cell.value)))
-                except:
-                    pass
-        ws.column_dimensions[get_column_letter(col_idx)].width = min(max_length + 2, 50)
-    
-    # フィルター設定
-    ws.auto_filter.ref = ws.dimensions
-    
-    # バイトストリームに保存
-    excel_buffer = io.BytesIO()
-    wb.save(excel_buffer)
-    excel_bytes = excel_buffer.getvalue()
-    excel_buffer.close()
+    rows = built["rows"]
+    columns = built["columns"]
     
     # Artifactとして保存
     if tool_context:
         try:
-            excel_artifact = types.Part.from_bytes(
-                data=excel_bytes,
-                mime_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            saved = await save_file_artifact(
+                tool_context,
+                filename,
+                fileobj,
+                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
             )
-            version = await tool_context.save_artifact(
-                filename=filename,
-                artifact=excel_artifact
+            record_export(
+                tool_context, filename, key,
+                format="xlsx", rows=rows, columns=columns, sheets=built["sheets"],
+                source_query=source_query, **saved
             )
             return {
                 "success": True,
                 "filename": filename,
-                "rows": len(normalized_data),
-                "columns": len(headers),
-                "version": version,
-                "size_bytes": len(excel_bytes),
-                "message": f"Excelファイル '{filename}' を保存しました（{len(normalized_data)}行 x {len(headers)}列）"
+                "rows": rows,
+                "columns": columns,
+                "sheets": built["sheets"],
+                **saved,
+                "queue_wait_ms": round(queue_wait * 1000, 1),
+                "message": f"Excelファイル '{filename}' を保存しました（{rows}行 x {columns}列）"
             }
         except Exception as e:
             return {
@@ -209,17 +397,82 @@ async def export_to_excel(
         }
 
 
+async def export_to_excel(
+    data: Any,
+    filename: str,
+    sheet_name: str = "Sheet1",
+    tool_context: Any = None,
+    source_query: str | None = None
+) -> dict[str, Any]:
+    """
+    データをExcelファイルとして保存し、Artifactとして出力する
+
+    write_onlyモードで行をストリーミング書き込みするため、
+    行数が増えてもワークブックのメモリ使用量はほぼ一定。
+    シートの行数上限を超える場合は "<sheet_name>_2" 以降のシートへ続けて書き込む。
+    生成処理は export_executor で実行し、イベントループは完成したファイルを待つだけにする。
+    同じ結果・同じシート名の出力が保存済みの場合は生成を省略して再利用する
+    """
+    try:
+        (table, key), _ = await export_executor.run(_normalize_with_key, data, sheet_name)
+        reused = await _reuse_excel(tool_context, key, filename)
+        if reused:
+            return reused
+        built, fileobj, queue_wait = await run_to_file(build_excel_file, table, sheet_name)
+    except ExportQueueFullError as e:
+        return {"success": False, "error": str(e)}
+    
+    with fileobj:
+        return await _save_excel_artifact(built, fileobj, queue_wait, filename, tool_context, key, source_query)
+
+
+async def export_json_to_excel(
+    query_result: str,
+    filename: str,
+    sheet_name: str = "Sheet1",
+    tool_context: Any = None
+) -> dict[str, Any]:
+    """
+    結果JSON文字列をExcelファイルとして保存し、Artifactとして出力する
+
+    rows を1行ずつデコードしながら書き込むため、パース済みの行リストや
+    正規化済みの全件コピーを作らない。
+    再利用のキーは（正規化せずに）JSON文字列そのものから作る
+    """
+    try:
+        key, _ = await export_executor.run(partial(content_key, format="xlsx", sheet_name=sheet_name), query_result)
+        reused = await _reuse_excel(tool_context, key, filename)
+        if reused:
+            return reused
+        built, fileobj, queue_wait = await run_to_file(build_excel_file_from_json, query_result, sheet_name)
+    except ExportQueueFullError as e:
+        return {"success": False, "error": str(e)}
+    except json.JSONDecodeError:
+        return {"success": False, "error": "query_resultのJSON解析に失敗しました。"}
+    
+    with fileobj:
+        return await _save_excel_artifact(built, fileobj, queue_wait, filename, tool_context, key)
+
+
 async def list_saved_files(tool_context: Any = None) -> dict[str, Any]:
-    """保存済みのArtifactファイル一覧を取得する"""
+    """
+    保存済みのArtifactファイル一覧を取得する
+
+    出力ツールが記録した索引から、サイズ・行数・列数・形式・作成日時・元のSQLを返す
+    （Artifact本体は読まない）。索引にないファイルは名前のみ
+    """
     if not tool_context:
         return {"success": False, "error": "ToolContextが提供されていません。"}
     
     try:
-        files = await tool_context.list_artifacts()
+        files = list_exports(tool_context)
+        indexed = {f["filename"] for f in files}
+        names = await tool_context.list_artifacts()
+        files += [{"filename": name} for name in names or [] if name not in indexed]
         return {
             "success": True,
-            "files": files if files else [],
-            "count": len(files) if files else 0
+            "files": files,
+            "count": len(files)
         }
     except Exception as e:
         return {"success": False, "error": f"ファイル一覧取得エラー: {str(e)}"}
@@ -0,0 +1,127 @@
+"""
+ファイル生成用の実行プール
+
+ワークブック/CSVの生成はCPUを占有するため、イベントループ上では実行せず
+上限付きのスレッド（またはプロセス）プールに渡し、ループ側は完成したバイト列を待つだけにする。
+
+- 同時実行数: BQ_EXPORT_CONCURRENCY（既定 2）
+- 待ち行列の上限: BQ_EXPORT_QUEUE_LIMIT（既定 32）。超えた場合は ExportQueueFullError
+- 実行方式: BQ_EXPORT_EXECUTOR=thread|process（既定 thread）
+- キュー待ち時間は metrics() と各ジョブの戻り値（queue_wait_ms）で確認できる
+
+run(..., process=True) のジョブは実行方式によらずプロセスプールで実行する（分割出力のパート生成など）。
+プロセスは gRPC や認証情報の更新スレッドを持つ親プロセスを fork せず、spawn で起動する。
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CONCURRENCY = int(os.getenv("BQ_EXPORT_CONCURRENCY", "2"))
+EXPORT_QUEUE_LIMIT = int(os.getenv("BQ_EXPORT_QUEUE_LIMIT", "32"))
+EXPORT_EXECUTOR_KIND = os.getenv("BQ_EXPORT_EXECUTOR", "thread")
+
+
+class ExportQueueFullError(RuntimeError):
+    """待ち行列が上限に達しているため、ジョブを受け付けられない"""
+
+
+def _timed_call(submitted_at: float, func: Callable[..., Any], args: tuple) -> tuple[float, Any]:
+    """ワーカー側で開始までの待ち時間を計測してから関数を実行する"""
+    waited = time.time() - submitted_at
+    return waited, func(*args)
+
+
+class ExportExecutor:
+    """同時実行数と待ち行列の長さに上限を設けたファイル生成用の実行プール"""
+
+    def __init__(
+        self,
+        max_workers: int = EXPORT_CONCURRENCY,
+        queue_limit: int = EXPORT_QUEUE_LIMIT,
+        kind: str = EXPORT_EXECUTOR_KIND
+    ):
+        self.max_workers = max_workers
+        self.queue_limit = queue_limit
+        self.kind = kind
+        self._pool: Executor | None = None
+        self._process_pool: Executor | None = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _get_pool(self, process: bool = False) -> Executor:
+        if process or self.kind == "process":
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._process_pool
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="bq-export"
+            )
+        return self._pool
+
+    async def run(self, func: Callable[..., Any], *args: Any, process: bool = False) -> tuple[Any, float]:
+        """
+        関数をプールで実行し、(戻り値, キュー待ち時間[秒]) を返す
+
+        process モードまたは process=True では func と引数がpickle可能である必要がある
+        """
+        with self._lock:
+            if self._pending >= self.max_workers + self.queue_limit:
+                self._rejected += 1
+                raise ExportQueueFullError(
+                    f"出力処理が混み合っています（実行中・待機中 {self._pending} 件）。しばらくしてから再実行してください。"
+                )
+            self._pending += 1
+
+        loop = asyncio.get_running_loop()
+        pool = self._get_pool(process)
+        try:
+            waited, result = await loop.run_in_executor(pool, _timed_call, time.time(), func, args)
+        except BrokenProcessPool:
+            # ワーカーが異常終了したプールは使えないため、次のジョブで作り直す
+            with self._lock:
+                if self._process_pool is pool:
+                    self._process_pool = None
+            raise
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+        with self._lock:
+            self._completed += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        if waited >= 1.0:
+            logger.info(f"Export waited {waited:.2f}s in queue ({getattr(func, '__name__', func)})")
+        return result, waited
+
+    def metrics(self) -> dict[str, Any]:
+        """キュー待ち時間などの統計"""
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "queue_wait_ms_avg": round(self._wait_total / self._completed * 1000, 1) if self._completed else 0.0,
+                "queue_wait_ms_max": round(self._wait_max * 1000, 1),
+            }
+
+
+# プロセス全体で共有する実行プール
+export_executor = ExportExecutor()
@@ -0,0 +1,153 @@
+"""
+バッチ単位のファイルライター
+
+Arrow の RecordBatch を1バッチずつ受け取り、xlsx / csv / parquet / Arrow IPC に書き出す。
+結果全体をメモリに載せずに出力するために使う。
+"""
+import json
+from typing import Any, BinaryIO
+import pyarrow as pa
+
+from .bq_result import iter_batch_rows
+from .excel_tool import EXCEL_MAX_ROWS, SpillingWorkbookWriter
+
+
+# 出力形式ごとのMIMEタイプ
+MIME_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.file",
+}
+
+EXPORT_FORMATS = tuple(MIME_TYPES)
+
+
+class ExcelBatchWriter:
+    """
+    RecordBatchをwrite_onlyワークブックへ書き込む
+
+    シートの行数上限（または rows_per_sheet）を超えたら次のシートへ書き進める
+    """
+
+    def __init__(
+        self,
+        fileobj: BinaryIO,
+        schema: pa.Schema,
+        sheet_name: str = "Sheet1",
+        rows_per_sheet: int = EXCEL_MAX_ROWS - 1
+    ):
+        from openpyxl import Workbook
+
+        self._fileobj = fileobj
+        self._wb = Workbook(write_only=True)
+        self._sheet = SpillingWorkbookWriter(self._wb, sheet_name, schema.names, rows_per_sheet)
+
+    @property
+    def sheet_names(self) -> list[str]:
+        return self._sheet.sheet_names
+
+    def write_batch(self, batch: pa.RecordBatch) -> None:
+        for values in iter_batch_rows(batch):
+            self._sheet.append(values)
+
+    def close(self) -> None:
+        self._sheet.close()
+        self._wb.save(self._fileobj)
+
+
+def _csv_compatible(batch: pa.RecordBatch) -> pa.RecordBatch:
+    """CSVに書けない入れ子型（LIST等）の列をJSON文字列の列に置き換える"""
+    if not any(pa.types.is_nested(field.type) for field in batch.schema):
+        return batch
+    arrays = []
+    for column in batch.columns:
+        if pa.types.is_nested(column.type):
+            column = pa.array(
+                [None if v is None else json.dumps(v, ensure_ascii=False, default=str)
+                 for v in column.to_pylist()],
+                pa.string()
+            )
+        arrays.append(column)
+    return pa.RecordBatch.from_arrays(arrays, names=batch.schema.names)
+
+
+def _csv_schema(schema: pa.Schema) -> pa.Schema:
+    return pa.schema([
+        pa.field(f.name, pa.string()) if pa.types.is_nested(f.type) else f
+        for f in schema
+    ])
+
+
+class CsvBatchWriter:
+    """RecordBatchをCSV（RFC 4180準拠のクォート）として書き込む"""
+
+    def __init__(self, fileobj: BinaryIO, schema: pa.Schema):
+        import pyarrow.csv as pa_csv
+
+        self._sink = pa.PythonFile(fileobj, mode="w")
+        self._writer = pa_csv.CSVWriter(self._sink, _csv_schema(schema))
+
+    def write_batch(self, batch: pa.RecordBatch) -> None:
+        self._writer.write_batch(_csv_compatible(batch))
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+class ParquetBatchWriter:
+    """RecordBatchをParquetの行グループとして書き込む"""
+
+    def __init__(
+        self,
+        fileobj: BinaryIO,
+        schema: pa.Schema,
+        compression: str = "zstd",
+        row_group_size: int | None = None
+    ):
+        import pyarrow.parquet as pq
+
+        self._writer = pq.ParquetWriter(fileobj, schema, compression=compression)
+        self._row_group_size = row_group_size
+
+    def write_batch(self, batch: pa.RecordBatch) -> None:
+        self._writer.write_batch(batch, row_group_size=self._row_group_size)
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+class ArrowIpcBatchWriter:
+    """RecordBatchをArrow IPCファイル形式（Feather V2）で書き込む"""
+
+    def __init__(self, fileobj: BinaryIO, schema: pa.Schema, compression: str | None = "zstd"):
+        self._sink = pa.PythonFile(fileobj, mode="w")
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        self._writer = pa.ipc.new_file(self._sink, schema, options=options)
+
+    def write_batch(self, batch: pa.RecordBatch) -> None:
+        self._writer.write_batch(batch)
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+def open_batch_writer(fmt: str, fileobj: BinaryIO, schema: pa.Schema, **options: Any):
+    """
+    出力形式に応じたバッチライターを作る
+
+    Args:
+        fmt: "xlsx" / "csv" / "parquet" / "arrow"
+        fileobj: 書き込み先のバイナリファイル
+        schema: 書き込むデータのArrowスキーマ
+        options: ライター固有のオプション（sheet_name, compression, row_group_size など）
+    """
+    if fmt == "xlsx":
+        return ExcelBatchWriter(fileobj, schema, **options)
+    if fmt == "csv":
+        return CsvBatchWriter(fileobj, schema)
+    if fmt == "parquet":
+        return ParquetBatchWriter(fileobj, schema, **options)
+    if fmt == "arrow":
+        return ArrowIpcBatchWriter(fileobj, schema, **options)
+    raise ValueError(f"未対応の出力形式です: {fmt}（{', '.join(EXPORT_FORMATS)} のいずれか）")
@@ -0,0 +1,119 @@
+"""
+結果JSONの逐次デコード
+
+execute_sql の結果JSON文字列から "rows" 配列の要素を1行ずつデコードして返す。
+json.loads で全体を Python オブジェクトにしないため、出力処理（Excel書き込み）と
+デコードが交互に進み、行リスト全体のコピーを持たずに済む。
+
+デコードには標準ライブラリの json.JSONDecoder.raw_decode を使う。
+"""
+import itertools
+import json
+import re
+from typing import Any, Iterator
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def _skip_whitespace(text: str, pos: int) -> int:
+    return _WHITESPACE.match(text, pos).end()
+
+
+def _expect(text: str, pos: int, chars: str) -> str:
+    char = text[pos:pos + 1]
+    if not char or char not in chars:
+        raise json.JSONDecodeError(f"'{chars}' が必要です", text, pos)
+    return char
+
+
+def _array_items(text: str, pos: int) -> Iterator[Any]:
+    """
+    text[pos] から始まる配列の要素を1つずつデコードして返す
+
+    ジェネレーターの戻り値（StopIteration.value）は配列の直後の位置
+    """
+    _expect(text, pos, "[")
+    pos = _skip_whitespace(text, pos + 1)
+    if text[pos:pos + 1] == "]":
+        return pos + 1
+    while True:
+        item, pos = _decoder.raw_decode(text, pos)
+        yield item
+        pos = _skip_whitespace(text, pos)
+        if _expect(text, pos, ",]") == "]":
+            return pos + 1
+        pos = _skip_whitespace(text, pos + 1)
+
+
+def _skip_array(text: str, pos: int) -> int:
+    """配列を要素ごとにデコードして読み飛ばし、直後の位置を返す（要素は保持しない）"""
+    items = _array_items(text, pos)
+    while True:
+        try:
+            next(items)
+        except StopIteration as stop:
+            return stop.value
+
+
+def _scan_object(text: str, pos: int) -> tuple[dict[str, Any], int | None]:
+    """
+    text[pos] から始まるオブジェクトを走査し、("rows" 以外の値, "rows" 配列の開始位置) を返す
+
+    "schema" の後に "rows" が来た場合はそこで走査を終える（残りのキーは読まない）
+    """
+    _expect(text, pos, "{")
+    values: dict[str, Any] = {}
+    rows_at = None
+    pos = _skip_whitespace(text, pos + 1)
+    if text[pos:pos + 1] == "}":
+        return values, rows_at
+    while True:
+        key, pos = _decoder.raw_decode(text, pos)
+        pos = _skip_whitespace(text, pos)
+        _expect(text, pos, ":")
+        pos = _skip_whitespace(text, pos + 1)
+        if key == "rows" and text[pos:pos + 1] == "[":
+            rows_at = pos
+            if "schema" in values:
+                return values, rows_at
+            # schema が rows より後ろにある（またはない）場合は、いったん読み飛ばして先を調べる
+            pos = _skip_array(text, pos)
+        else:
+            values[key], pos = _decoder.raw_decode(text, pos)
+        pos = _skip_whitespace(text, pos)
+        if _expect(text, pos, ",}") == "}":
+            return values, rows_at
+        pos = _skip_whitespace(text, pos + 1)
+
+
+def stream_query_result(text: str) -> tuple[list[dict[str, Any]] | None, Iterator[Any]]:
+    """
+    結果JSON文字列から (schema.fields, 行のイテレーター) を返す
+
+    対応する形式:
+    - {"schema": {...}, "rows": [...], ...}
+    - 行のリスト [...]
+
+    "rows" 配列を持たないオブジェクトの場合は LookupError、JSONが不正な場合は ValueError
+    （json.JSONDecodeError）を送出する。行のイテレーターも読み進める途中で ValueError を送出しうる
+    """
+    pos = _skip_whitespace(text, 0)
+    if text[pos:pos + 1] == "[":
+        return None, _array_items(text, pos)
+
+    values, rows_at = _scan_object(text, pos)
+    if rows_at is None:
+        raise LookupError("rows がありません")
+    schema = values.get("schema") or {}
+    fields = schema.get("fields") if isinstance(schema, dict) else None
+    return fields or None, _array_items(text, rows_at)
+
+
+def iter_row_batches(rows: Iterator[Any], batch_size: int) -> Iterator[list[Any]]:
+    """行のイテレーターを batch_size 行ずつのリストにまとめて返す"""
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
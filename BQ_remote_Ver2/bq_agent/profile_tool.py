@@ -0,0 +1,275 @@
+"""
+クエリ結果のプロファイルツール
+
+結果の行をモデルに読ませる代わりに、列ごとの統計を pyarrow.compute / NumPy で
+まとめて計算し、コンパクトな要約として返す。
+
+- 欠損数・欠損率
+- 数値: 最小/最大/平均/標準偏差/四分位
+- 日付・時刻: 最小/最大
+- 文字列・真偽値・整数・日付: 出現回数の上位k件（異なり数が多い列は省略）
+- 異なり数: HyperLogLog（2^14レジスタ、誤差 約0.8%）による近似
+"""
+import math
+import time
+from typing import Any
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .excel_tool import _normalize_bq_data
+from .export_executor import ExportQueueFullError, export_executor
+from .result_store import load_query_result
+
+# HyperLogLog のレジスタ数 = 2^HLL_PRECISION
+HLL_PRECISION = 14
+
+# 文字列のハッシュ計算を分割する行数（作業用配列の大きさを抑える）
+HASH_CHUNK_ROWS = 65_536
+
+# 四分位に使う分位点
+QUANTILES = (0.25, 0.5, 0.75)
+
+# 上位の値を集計する列の異なり数の上限（これを超える列はID的な値とみなして省略する）
+TOP_VALUES_MAX_DISTINCT = 1000
+TOP_VALUES_MAX_DISTINCT_RATIO = 0.05
+
+_UINT64 = np.uint64
+_POLY_BASE = _UINT64(0x100000001B3)
+
+
+def _mix64(x: np.ndarray) -> np.ndarray:
+    """splitmix64 の最終化関数で64bit値を攪拌する（uint64配列、桁あふれは折り返し）"""
+    x = x.astype(_UINT64, copy=True)
+    x ^= x >> _UINT64(30)
+    x *= _UINT64(0xBF58476D1CE4E5B9)
+    x ^= x >> _UINT64(27)
+    x *= _UINT64(0x94D049BB133111EB)
+    x ^= x >> _UINT64(31)
+    return x
+
+
+def _hash_strings(array: pa.Array) -> np.ndarray:
+    """文字列/バイナリ配列（欠損なし）の各要素を64bitハッシュにする（多項式ハッシュ + 攪拌）"""
+    if pa.types.is_large_string(array.type) or pa.types.is_large_binary(array.type):
+        offset_type = np.int64
+    else:
+        offset_type = np.int32
+    n = len(array)
+    offsets = np.frombuffer(array.buffers()[1], dtype=offset_type)[array.offset:array.offset + n + 1]
+    offsets = offsets.astype(np.int64)
+    data_buffer = array.buffers()[2]
+    data = np.frombuffer(data_buffer, dtype=np.uint8) if data_buffer is not None else np.zeros(0, np.uint8)
+    data = data[offsets[0]:offsets[-1]].astype(_UINT64)
+    lengths = np.diff(offsets)
+    starts = offsets[:-1] - offsets[0]
+
+    hashes = lengths.astype(_UINT64)
+    if len(data):
+        # 各バイトの重み = BASE^(文字列末尾からの位置)
+        max_len = int(lengths.max())
+        powers = np.empty(max_len, dtype=_UINT64)
+        powers[0] = 1
+        if max_len > 1:
+            powers[1:] = _POLY_BASE
+            powers = np.cumprod(powers, dtype=_UINT64)
+        ends = np.repeat(starts + lengths, lengths)
+        position_from_end = ends - np.arange(len(data)) - 1
+        weighted = data * powers[position_from_end]
+        non_empty = lengths > 0
+        hashes[non_empty] += np.add.reduceat(weighted, starts[non_empty])
+    return _mix64(hashes)
+
+
+def _hash_values(array: pa.Array) -> np.ndarray | None:
+    """配列（欠損なし）を64bitハッシュにする。対応しない型は None"""
+    t = array.type
+    if pa.types.is_string(t) or pa.types.is_large_string(t) or pa.types.is_binary(t) or pa.types.is_large_binary(t):
+        return _hash_strings(array)
+    if pa.types.is_boolean(t):
+        return _mix64(array.to_numpy(zero_copy_only=False).astype(_UINT64))
+    if pa.types.is_floating(t):
+        values = array.cast(pa.float64()).to_numpy(zero_copy_only=False) + 0.0  # -0.0 を 0.0 に揃える
+        return _mix64(values.view(_UINT64))
+    if pa.types.is_decimal(t):
+        return _hash_values(array.cast(pa.string()))
+    if pa.types.is_integer(t) or pa.types.is_temporal(t):
+        values = array.to_numpy(zero_copy_only=False)
+        if values.dtype.kind in "mM":
+            values = values.view(np.int64)
+        return _mix64(values.astype(np.int64).view(_UINT64))
+    return None
+
+
+class HyperLogLog:
+    """64bitハッシュ配列を受け取る HyperLogLog（レジスタ更新はベクトル化）"""
+
+    def __init__(self, precision: int = HLL_PRECISION):
+        self.precision = precision
+        self.m = 1 << precision
+        # レジスタごとに観測した rank（1〜65-p）を記録する
+        self._seen = np.zeros((self.m, 65 - precision + 1), dtype=bool)
+
+    def add_hashes(self, hashes: np.ndarray) -> None:
+        if len(hashes) == 0:
+            return
+        p = self.precision
+        index = (hashes >> _UINT64(64 - p)).astype(np.int64)
+        rest = hashes & _UINT64((1 << (64 - p)) - 1)
+        # 残りの (64-p) ビットは float64 の仮数部に収まるため、frexp の指数がそのままビット長になる
+        _, bit_length = np.frexp(rest.astype(np.float64))
+        rank = (64 - p) - bit_length + 1
+        self._seen.reshape(-1)[index * self._seen.shape[1] + rank] = True
+
+    def estimate(self) -> int:
+        # レジスタ値 = そのレジスタで観測した最大の rank
+        observed = self._seen.any(axis=1)
+        registers = np.where(
+            observed,
+            self._seen.shape[1] - 1 - np.argmax(self._seen[:, ::-1], axis=1),
+            0
+        )
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        raw = alpha * self.m * self.m / np.sum(np.exp2(-registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(registers == 0))
+        if raw <= 2.5 * self.m and zeros:
+            return int(round(self.m * math.log(self.m / zeros)))
+        return int(round(raw))
+
+
+def approx_distinct(column: pa.ChunkedArray) -> int | None:
+    """HyperLogLog による異なり数の近似（対応しない型は None）"""
+    hll = HyperLogLog()
+    for chunk in column.chunks:
+        chunk = pc.drop_null(chunk)
+        for start in range(0, len(chunk), HASH_CHUNK_ROWS):
+            hashes = _hash_values(chunk.slice(start, HASH_CHUNK_ROWS))
+            if hashes is None:
+                return None
+            hll.add_hashes(hashes)
+    return hll.estimate()
+
+
+def _py(value: Any) -> Any:
+    """統計値をJSONに載せられる値にする"""
+    if isinstance(value, pa.Scalar):
+        value = value.as_py()
+    if isinstance(value, float):
+        return None if math.isnan(value) else round(value, 6)
+    if value is None or isinstance(value, (str, int, bool)):
+        return value
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def _top_values(column: pa.ChunkedArray, top_k: int) -> list[dict[str, Any]]:
+    counts = pc.value_counts(pc.drop_null(column))
+    if len(counts) == 0:
+        return []
+    frequencies = counts.field("counts")
+    order = pc.select_k_unstable(frequencies, k=min(top_k, len(counts)), sort_keys=[("dummy", "descending")])
+    values = counts.field("values").take(order)
+    return [
+        {"value": _py(value), "count": count}
+        for value, count in zip(values.to_pylist(), frequencies.take(order).to_pylist())
+    ]
+
+
+def profile_column(column: pa.ChunkedArray, name: str, top_k: int) -> dict[str, Any]:
+    """1列分の統計"""
+    t = column.type
+    rows = len(column)
+    profile: dict[str, Any] = {
+        "name": name,
+        "type": str(t),
+        "null_count": column.null_count,
+        "null_ratio": round(column.null_count / rows, 4) if rows else 0.0,
+    }
+    if column.null_count == rows:
+        return profile
+
+    if pa.types.is_nested(t):
+        return profile
+
+    profile["approx_distinct"] = approx_distinct(column)
+
+    if pa.types.is_integer(t) or pa.types.is_floating(t) or pa.types.is_decimal(t):
+        values = column.cast(pa.float64()) if pa.types.is_decimal(t) else column
+        min_max = pc.min_max(values)
+        profile["min"] = _py(min_max["min"])
+        profile["max"] = _py(min_max["max"])
+        profile["mean"] = _py(pc.mean(values))
+        profile["stddev"] = _py(pc.stddev(values))
+        # 四分位は NumPy の選択アルゴリズム（np.partition）で求める（t-digestより速く、値も厳密）
+        finite = pc.drop_null(values).to_numpy().astype(np.float64, copy=False)
+        finite = finite[np.isfinite(finite)]
+        if len(finite):
+            for q, value in zip(QUANTILES, np.quantile(finite, QUANTILES)):
+                profile[f"p{int(q * 100)}"] = _py(float(value))
+    elif pa.types.is_temporal(t):
+        min_max = pc.min_max(column)
+        profile["min"] = _py(min_max["min"])
+        profile["max"] = _py(min_max["max"])
+
+    if top_k > 0 and not pa.types.is_floating(t) and not pa.types.is_timestamp(t):
+        distinct = profile["approx_distinct"]
+        limit = max(TOP_VALUES_MAX_DISTINCT, TOP_VALUES_MAX_DISTINCT_RATIO * (rows - column.null_count))
+        if distinct is not None and distinct <= limit:
+            profile["top_values"] = _top_values(column, top_k)
+    return profile
+
+
+def build_profile(data: Any, top_k: int = 5) -> dict[str, Any]:
+    """データを正規化して全列のプロファイルを作る（同期処理）"""
+    started = time.perf_counter()
+    table = _normalize_bq_data(data)
+    columns = [
+        profile_column(table.column(i), name, top_k)
+        for i, name in enumerate(table.column_names)
+    ]
+    return {
+        "row_count": table.num_rows,
+        "column_count": table.num_columns,
+        "columns": columns,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+
+async def profile_result(
+    result_handle: str = "",
+    query_result: str = "",
+    top_k: int = 5,
+    tool_context: Any = None
+) -> dict[str, Any]:
+    """
+    クエリ結果の列ごとの統計（欠損数・最小/最大/平均/四分位・異なり数の近似・上位の値）を返す
+
+    結果の行を読まずに傾向をつかむ場合や、要約を作る場合に使う
+
+    Args:
+        result_handle: execute_sqlの応答に含まれる結果ハンドル
+        query_result: execute_sqlの結果（JSON文字列）。result_handleがない場合のみ使用
+        top_k: 列ごとに返す出現回数上位の値の件数（0で省略）
+        tool_context: ADKのToolContext
+
+    Returns:
+        dict: 列ごとの統計
+    """
+    if not tool_context:
+        return {"success": False, "error": "ToolContextが提供されていません。"}
+
+    data, error = load_query_result(tool_context, result_handle, query_result)
+    if error:
+        return {"success": False, "error": error}
+
+    try:
+        profile, _ = await export_executor.run(build_profile, data, max(top_k, 0))
+    except ExportQueueFullError as e:
+        return {"success": False, "error": str(e)}
+    except Exception as e:
+        return {"success": False, "error": f"プロファイル作成エラー: {str(e)}"}
+
+    if profile["row_count"] == 0:
+        return {"success": False, "error": "データが空です。"}
+    return {"success": True, **profile}
@@ -0,0 +1,185 @@
+"""
+複数クエリのレポート出力ツール
+
+{シート名: SQL} の各クエリを並行して実行し、1つのワークブックの別々のシートに書き込む。
+クエリは ExportClient（Storage Read API）で実行し、結果はLLMを経由しない。
+
+- 同時に実行するクエリ数の上限: BQ_REPORT_CONCURRENCY（既定 4）
+- 1回に指定できるクエリ数の上限: BQ_REPORT_MAX_QUERIES（既定 20）
+
+実行前に各クエリを budget_guard で並行してドライランし、SELECT文以外や上限を超えるクエリは実行しない。
+クエリの実行は並行し、シートは指定した順に、完了した結果をバッチ単位で読み出しながら書き込む
+（結果をまとめてメモリに持たない）。レポート全体の待ち時間は各クエリの合計ではなく、
+最も遅いクエリと書き込み時間でほぼ決まる。
+"""
+import asyncio
+import logging
+import os
+import re
+import time
+from typing import Any, Iterator
+import pyarrow as pa
+
+from .artifact_store import save_file_artifact, spooled_file
+from .bq_result import iter_batch_rows
+from .budget_guard import check_export_queries
+from .direct_export import get_export_client
+from .excel_tool import MAX_SHEET_NAME_LENGTH, SpillingWorkbookWriter
+from .export_index import record_export
+from .file_writers import MIME_TYPES
+
+logger = logging.getLogger(__name__)
+
+REPORT_CONCURRENCY = max(int(os.getenv("BQ_REPORT_CONCURRENCY", "4")), 1)
+REPORT_MAX_QUERIES = int(os.getenv("BQ_REPORT_MAX_QUERIES", "20"))
+
+# シート名に使えない文字
+_INVALID_SHEET_CHARS = re.compile(r"[\\/*?:\[\]]")
+
+
+def _validate_sheet_names(sheet_names: list[str]) -> list[str]:
+    """Excelのシート名として使えない名前の説明を返す（問題がなければ空）"""
+    problems = []
+    seen: dict[str, str] = {}
+    for name in sheet_names:
+        if not name.strip():
+            problems.append("空のシート名は使えません")
+        elif len(name) > MAX_SHEET_NAME_LENGTH:
+            problems.append(f"'{name}' は{MAX_SHEET_NAME_LENGTH}文字を超えています")
+        elif _INVALID_SHEET_CHARS.search(name):
+            problems.append(f"'{name}' に使えない文字（\\ / * ? : [ ]）が含まれています")
+        elif name.startswith("'") or name.endswith("'"):
+            problems.append(f"'{name}' の先頭・末尾にアポストロフィは使えません")
+        # Excelのシート名は大文字・小文字を区別しない
+        key = name.lower()
+        if key in seen:
+            problems.append(f"'{name}' は '{seen[key]}' と重複しています（大文字・小文字は区別されません）")
+        seen.setdefault(key, name)
+    return problems
+
+
+def _write_sheet(wb: Any, sheet_name: str, schema: pa.Schema, batches: Iterator[pa.RecordBatch]) -> tuple[int, list[str]]:
+    """
+    バッチを読み出しながらシートに書き込み、(行数, 作成したシート名) を返す（同期処理）
+
+    途中で失敗した場合は作成したシートをワークブックから取り除く
+    """
+    writer = SpillingWorkbookWriter(wb, sheet_name, schema.names)
+    try:
+        for batch in batches:
+            for values in iter_batch_rows(batch):
+                writer.append(values)
+        rows = writer.close()
+    except Exception:
+        for ws in writer.worksheets:
+            wb.remove(ws)
+        raise
+    return rows, writer.sheet_names
+
+
+async def export_report(
+    queries: dict[str, str],
+    filename: str = "report",
+    tool_context: Any = None
+) -> dict[str, Any]:
+    """
+    複数のSQLを並行して実行し、結果を1つのExcelファイルのシートに分けて保存する
+
+    Args:
+        queries: {シート名: SQL}（例: {"売上": "SELECT ...", "顧客数": "SELECT ..."}）
+        filename: 保存するファイル名（拡張子 .xlsx は自動付与）
+        tool_context: ADKのToolContext
+
+    Returns:
+        dict: 保存結果（シートごとの行数・所要時間と、失敗したクエリのエラー）
+    """
+    if not queries:
+        return {"success": False, "error": "queries に {シート名: SQL} を1件以上指定してください。"}
+    if len(queries) > REPORT_MAX_QUERIES:
+        return {"success": False, "error": f"1回に指定できるクエリは{REPORT_MAX_QUERIES}件までです。"}
+    if not tool_context:
+        return {"success": False, "error": "ToolContextが提供されていません。"}
+
+    problems = _validate_sheet_names(list(queries))
+    if problems:
+        return {"success": False, "error": "シート名を修正してください: " + "、".join(problems)}
+
+    if not filename.endswith(".xlsx"):
+        filename = f"{filename}.xlsx"
+
+    started = time.perf_counter()
+    failed = []
+
+    semaphore = asyncio.Semaphore(REPORT_CONCURRENCY)
+
+    # ドライランは並行して行い、上限は見積もりが揃ってから指定した順に累計で確認する
+    checked = await check_export_queries(list(queries.values()), tool_context, "export_report", semaphore)
+    runnable = {}
+    for (sheet_name, sql), blocked in zip(queries.items(), checked):
+        if blocked is None:
+            runnable[sheet_name] = sql
+        else:
+            failed.append({"sheet_name": sheet_name, **blocked})
+    if not runnable:
+        return {"success": False, "error": "実行できるクエリがありません。", "failed": failed}
+
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    client = get_export_client()
+
+    async def run_query(sql: str) -> tuple[pa.Schema, Iterator[pa.RecordBatch], float]:
+        """クエリを実行し、(スキーマ, バッチ列, 所要時間) を返す（バッチはまだ読み出さない）"""
+        query_started = time.perf_counter()
+        async with semaphore:
+            schema, batches = await asyncio.to_thread(client.query_batches, sql)
+        return schema, batches, time.perf_counter() - query_started
+
+    tasks = {name: asyncio.create_task(run_query(sql)) for name, sql in runnable.items()}
+    written = []
+    # シートは指定した順に作る（先のクエリを待つ間も後のクエリは実行が進む）
+    for sheet_name, task in tasks.items():
+        try:
+            schema, batches, query_seconds = await task
+            write_started = time.perf_counter()
+            rows, sheets = await asyncio.to_thread(_write_sheet, wb, sheet_name, schema, batches)
+        except Exception as e:
+            logger.error(f"Report query error ({sheet_name}): {e}")
+            failed.append({"sheet_name": sheet_name, "error": str(e)})
+            continue
+        written.append({
+            "sheet_name": sheet_name,
+            "rows": rows,
+            "columns": len(schema),
+            "sheets": sheets,
+            "query_ms": round(query_seconds * 1000, 1),
+            "write_ms": round((time.perf_counter() - write_started) * 1000, 1),
+        })
+    if not written:
+        return {"success": False, "error": "すべてのクエリが失敗しました。", "failed": failed}
+
+    fileobj = spooled_file()
+    with fileobj:
+        try:
+            await asyncio.to_thread(wb.save, fileobj)
+            saved = await save_file_artifact(tool_context, filename, fileobj, MIME_TYPES["xlsx"])
+        except Exception as e:
+            return {"success": False, "error": f"Artifact保存エラー: {str(e)}", "failed": failed}
+
+    total_rows = sum(r["rows"] for r in written)
+    record_export(
+        tool_context, filename,
+        format="xlsx", rows=total_rows, sheets=[sheet for r in written for sheet in r["sheets"]],
+        source_query={r["sheet_name"]: queries[r["sheet_name"]] for r in written}, **saved
+    )
+    return {
+        "success": True,
+        "filename": filename,
+        "rows": total_rows,
+        "sheets": written,
+        "failed": failed,
+        **saved,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        "message": f"{len(written)}件のクエリ結果を '{filename}' に保存しました（{total_rows}行）"
+        + (f"。{len(failed)}件のクエリは失敗しました" if failed else "")
+    }
@@ -0,0 +1,219 @@
+"""
+大量データの分割出力ツール
+
+クエリ結果を指定行数ごとに分割して出力する。
+
+- split_mode="sheets": 1つのワークブック内で複数シートに分割する
+- split_mode="files": 複数のワークブック/CSVファイルに分割し、各パートを
+  export_executor のワーカープロセス（spawn）で並列に生成する。結果はパート一覧（マニフェスト）か zip で返す
+
+パートは一時ファイルに書き込み、バイト列としてメモリに集めない。
+"""
+import asyncio
+import logging
+import shutil
+import zipfile
+from contextlib import ExitStack
+from typing import Any, BinaryIO
+import pyarrow as pa
+
+from .artifact_store import run_to_file, save_file_artifact, spooled_file
+from .excel_tool import EXCEL_MAX_ROWS, _normalize_bq_data
+from .export_executor import ExportQueueFullError, export_executor
+from .export_index import record_export
+from .file_writers import MIME_TYPES, open_batch_writer
+from .result_store import load_query_result, result_handle_sql
+
+logger = logging.getLogger(__name__)
+
+# 分割出力に対応する形式
+SPLIT_FORMATS = ("xlsx", "csv")
+
+# 1パート（1シート/1ファイル）あたりの既定行数
+DEFAULT_ROWS_PER_PART = 1_000_000
+
+
+def render_part(
+    fmt: str,
+    table: pa.Table,
+    sheet_name: str,
+    rows_per_sheet: int,
+    fileobj: BinaryIO
+) -> None:
+    """
+    1パート分のテーブルを fileobj に書き込む
+
+    ワーカープロセスから呼ばれるため、モジュールのトップレベルに置いている
+    """
+    options = {"sheet_name": sheet_name, "rows_per_sheet": rows_per_sheet} if fmt == "xlsx" else {}
+    writer = open_batch_writer(fmt, fileobj, table.schema, **options)
+    for batch in table.to_batches():
+        writer.write_batch(batch)
+    writer.close()
+
+
+async def _render_parts_parallel(fmt: str, parts: list[pa.Table], sheet_name: str) -> list[BinaryIO]:
+    """
+    各パートを export_executor のワーカープロセスで並列に生成し、パートのファイルを返す
+
+    同時に投入するパートは export_executor の同時実行数までとし、共有の待ち行列を埋めない。
+    いずれかのパートが失敗したら残りのパートは投入せず、生成済みのファイルを閉じて例外を送出する
+    """
+    semaphore = asyncio.Semaphore(export_executor.max_workers)
+    failed = False
+
+    async def render(part: pa.Table) -> BinaryIO | None:
+        nonlocal failed
+        async with semaphore:
+            if failed:
+                return None
+            try:
+                _, fileobj, _ = await run_to_file(
+                    render_part, fmt, part, sheet_name, EXCEL_MAX_ROWS - 1, process=True
+                )
+            except BaseException:
+                failed = True
+                raise
+            return fileobj
+
+    results = await asyncio.gather(*(render(part) for part in parts), return_exceptions=True)
+    files = [result for result in results if result is not None and not isinstance(result, BaseException)]
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        for fileobj in files:
+            fileobj.close()
+        raise errors[0]
+    return files
+
+
+def _zip_parts(named_parts: list[tuple[str, BinaryIO]], fileobj: BinaryIO) -> None:
+    """パートのファイルを fileobj のzipへ書き込む（xlsxは圧縮済みのため無圧縮で格納する）"""
+    with zipfile.ZipFile(fileobj, "w") as zf:
+        for name, part in named_parts:
+            info = zipfile.ZipInfo(name)
+            info.compress_type = zipfile.ZIP_STORED if name.endswith(".xlsx") else zipfile.ZIP_DEFLATED
+            part.seek(0)
+            with zf.open(info, "w", force_zip64=True) as dest:
+                shutil.copyfileobj(part, dest)
+
+
+async def save_query_result_split(
+    filename: str,
+    result_handle: str = "",
+    query_result: str = "",
+    format: str = "xlsx",
+    split_mode: str = "files",
+    rows_per_part: int = DEFAULT_ROWS_PER_PART,
+    as_zip: bool = False,
+    sheet_name: str = "QueryResult",
+    tool_context: Any = None
+) -> dict[str, Any]:
+    """
+    大量のクエリ結果を行数ごとに分割して保存する（Excelの行数上限対策）
+
+    Args:
+        filename: ファイル名のベース（例: "sales" → sales_part001.xlsx ...）
+        result_handle: execute_sqlの応答に含まれる結果ハンドル
+        query_result: execute_sqlの結果（JSON文字列）。result_handleがない場合のみ使用
+        format: "xlsx" または "csv"
+        split_mode: "files"（複数ファイルに分割）または "sheets"（1ファイル内の複数シート、xlsxのみ）
+        rows_per_part: 1シート/1ファイルあたりの行数（xlsxは最大1,048,575行）
+        as_zip: Trueの場合、分割したファイルを1つのzipにまとめて保存する
+        sheet_name: シート名のベース
+        tool_context: ADKのToolContext
+
+    Returns:
+        dict: 保存結果（保存したファイルの一覧を含む）
+    """
+    fmt = format.lower().lstrip(".")
+    if fmt not in SPLIT_FORMATS:
+        return {"success": False, "error": f"未対応の出力形式です: {format}（xlsx / csv のいずれか）"}
+    if split_mode not in ("files", "sheets"):
+        return {"success": False, "error": f"split_mode は files / sheets のいずれかです: {split_mode}"}
+    if split_mode == "sheets" and fmt != "xlsx":
+        return {"success": False, "error": "シート分割は xlsx のみ対応しています。"}
+    if rows_per_part <= 0:
+        return {"success": False, "error": "rows_per_part は1以上を指定してください。"}
+    if fmt == "xlsx":
+        rows_per_part = min(rows_per_part, EXCEL_MAX_ROWS - 1)
+
+    if not tool_context:
+        return {"success": False, "error": "ToolContextが提供されていません。"}
+
+    data, error = load_query_result(tool_context, result_handle, query_result)
+    if error:
+        return {"success": False, "error": error}
+
+    try:
+        table, _ = await export_executor.run(_normalize_bq_data, data)
+    except ExportQueueFullError as e:
+        return {"success": False, "error": str(e)}
+    if table.num_rows == 0 or table.num_columns == 0:
+        return {"success": False, "error": "データが空です。ファイルを作成できません。"}
+
+    stem = filename[:-(len(fmt) + 1)] if filename.endswith(f".{fmt}") else filename
+
+    # 生成したパートのファイルは保存が終わるまで開いておく
+    with ExitStack() as stack:
+        try:
+            if split_mode == "sheets":
+                _, part_file, _ = await run_to_file(render_part, fmt, table, sheet_name, rows_per_part)
+                part_count = -(-table.num_rows // rows_per_part)
+                named_parts = [(f"{stem}.{fmt}", stack.enter_context(part_file))]
+                part_rows = [table.num_rows]
+            else:
+                parts = [
+                    table.slice(offset, rows_per_part)
+                    for offset in range(0, table.num_rows, rows_per_part)
+                ]
+                rendered = await _render_parts_parallel(fmt, parts, sheet_name)
+                named_parts = [
+                    (f"{stem}_part{i:03d}.{fmt}", stack.enter_context(part_file))
+                    for i, part_file in enumerate(rendered, 1)
+                ]
+                part_rows = [part.num_rows for part in parts]
+                part_count = len(parts)
+        except Exception as e:
+            logger.error(f"Split export error: {e}")
+            return {"success": False, "error": f"ファイル生成エラー: {str(e)}"}
+
+        try:
+            if as_zip:
+                zip_name = f"{stem}.zip"
+                zip_file = stack.enter_context(spooled_file())
+                await asyncio.to_thread(_zip_parts, named_parts, zip_file)
+                saved = await save_file_artifact(tool_context, zip_name, zip_file, "application/zip")
+                artifacts = [{
+                    "filename": zip_name,
+                    "rows": table.num_rows,
+                    **saved,
+                    "contents": [name for name, _ in named_parts],
+                }]
+            else:
+                artifacts = []
+                for (name, part_file), rows in zip(named_parts, part_rows):
+                    saved = await save_file_artifact(tool_context, name, part_file, MIME_TYPES[fmt])
+                    artifacts.append({"filename": name, "rows": rows, **saved})
+        except Exception as e:
+            return {"success": False, "error": f"Artifact保存エラー: {str(e)}"}
+
+    source_query = result_handle_sql(tool_context, result_handle) if result_handle else None
+    for artifact in artifacts:
+        record_export(
+            tool_context, artifact["filename"],
+            format="zip" if as_zip else fmt, rows=artifact["rows"], columns=table.num_columns,
+            source_query=source_query,
+            **{k: artifact[k] for k in ("version", "size_bytes", "storage", "uri") if k in artifact}
+        )
+
+    unit = "シート" if split_mode == "sheets" else "ファイル"
+    return {
+        "success": True,
+        "format": fmt,
+        "split_mode": split_mode,
+        "rows": table.num_rows,
+        "columns": table.num_columns,
+        "parts": part_count,
+        "artifacts": artifacts,
+        "message": f"{table.num_rows}行を{part_count}{unit}に分割して保存しました"
+    }
@@ -53,6 +53,9 @@ if [ ! -f "bq_agent/agent.py" ]; then
     error "bq_agent/agent.py が見つかりません"
 fi
 
+# 共通モジュールのコピーが正本（bq_agent/）と一致するかチェック
+python3 sync_shared_modules.py --check || error "共通モジュールが一致しません。python sync_shared_modules.py を実行してください"
+
 # .env チェック
 if [ ! -f ".env" ]; then
     error ".env ファイルが見つかりません。先に ./setup.sh を実行してください"
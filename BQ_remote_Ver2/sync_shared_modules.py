@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+sync_shared_modules.py - 共通モジュールを各エージェントディレクトリへコピーするスクリプト
+
+共通モジュールは bq_agent/ を正本とし、BQ_agent02/ と BQ_agent03/ へ同じ内容でコピーする
+（理由は README.md の「共通モジュール」を参照）。
+
+使用方法:
+    python sync_shared_modules.py          # bq_agent/ の内容をコピーする
+    python sync_shared_modules.py --check  # コピーが正本と一致するか確認する（不一致なら終了コード1）
+"""
+
+import argparse
+import filecmp
+import shutil
+import sys
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# 正本のディレクトリ
+SOURCE_DIR = BASE_DIR / "bq_agent"
+
+# コピー先のエージェントディレクトリ
+TARGET_DIRS = (BASE_DIR / "BQ_agent02", BASE_DIR / "BQ_agent03")
+
+# 共通モジュール
+SHARED_MODULES = (
+    "artifact_store.py",
+    "bq_result.py",
+    "budget_guard.py",
+    "export_executor.py",
+    "export_index.py",
+    "lazy_init.py",
+    "metadata_cache.py",
+    "query_cache.py",
+    "result_store.py",
+    "tool_cache.py",
+)
+
+
+def find_mismatches() -> list[Path]:
+    """正本と内容が異なる（または存在しない）コピーの一覧"""
+    return [
+        target / name
+        for target in TARGET_DIRS
+        for name in SHARED_MODULES
+        if not (target / name).exists() or not filecmp.cmp(SOURCE_DIR / name, target / name, shallow=False)
+    ]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="共通モジュールを各エージェントディレクトリへコピーする")
+    parser.add_argument("--check", action="store_true", help="コピーせずに一致するかだけ確認する")
+    args = parser.parse_args()
+
+    mismatches = find_mismatches()
+    if args.check:
+        for path in mismatches:
+            print(f"❌ {path.relative_to(BASE_DIR)} が {SOURCE_DIR.name}/{path.name} と一致しません")
+        if mismatches:
+            print("python sync_shared_modules.py を実行してコピーし直してください")
+            return 1
+        print("✅ 共通モジュールはすべて一致しています")
+        return 0
+
+    for path in mismatches:
+        shutil.copyfile(SOURCE_DIR / path.name, path)
+        print(f"コピー: {SOURCE_DIR.name}/{path.name} -> {path.relative_to(BASE_DIR)}")
+    print(f"✅ {len(mismatches)}ファイルを更新しました")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,15 @@
+"""
+オフラインで実行できる単体テストの共通設定
+
+BigQuery / GCS にはアクセスせず、各モジュールの差し替え口（set_client など）と
+monkeypatch でクライアントを置き換えて確認する。
+
+    cd BQ_remote_Ver2 && python -m pytest tests
+"""
+import os
+import sys
+
+# インポート時のバックグラウンド初期化（認証情報の取得）を止める
+os.environ.setdefault("BQ_WARMUP_DELAY_SECONDS", "-1")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,120 @@
+"""budget_guard の書き換え案と出力ツールの事前確認"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from bq_agent import budget_guard
+from bq_agent.metadata_cache import metadata_cache
+
+
+class FakeMetadataClient:
+    """INFORMATION_SCHEMA の結果行を返す MetadataClient"""
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def list_datasets(self, project):
+        return ["ds"]
+
+    def dataset_schema(self, project, dataset):
+        return [
+            {
+                "table_name": "events",
+                "table_type": "BASE TABLE",
+                "row_count": 100,
+                "size_bytes": 1000,
+                "column_name": name,
+                "data_type": data_type,
+                "is_nullable": "YES",
+                "is_partitioning_column": "YES" if partitioned else "NO",
+                "clustering_ordinal_position": None,
+            }
+            for name, data_type, partitioned in self.columns
+        ]
+
+
+@pytest.fixture
+def use_columns():
+    def use(columns):
+        metadata_cache.set_client(FakeMetadataClient(columns))
+        metadata_cache.invalidate()
+    yield use
+    metadata_cache.set_client(None)
+    metadata_cache.invalidate()
+
+
+def test_date_partition_gets_recent_predicate(use_columns):
+    use_columns([("event_date", "DATE", True), ("name", "STRING", False)])
+
+    sql, notes = budget_guard.suggest_rewrite("SELECT name FROM `p.ds.events` WHERE name = 'a'", days=7)
+
+    assert sql == "SELECT name FROM `p.ds.events` WHERE event_date >= DATE_SUB(CURRENT_DATE(), INTERVAL 7 DAY) AND (name = 'a')"
+    assert any("直近7日" in note for note in notes)
+
+
+def test_int64_range_partition_is_not_rewritten(use_columns):
+    use_columns([("customer_id", "INT64", True), ("name", "STRING", False)])
+
+    sql, notes = budget_guard.suggest_rewrite("SELECT name FROM `p.ds.events`")
+
+    assert sql is None
+    assert any("customer_id" in note and "INT64" in note for note in notes)
+    assert not any("DATE_SUB" in note for note in notes)
+
+
+class FakeDryRunClient:
+    """SQLごとの見積もりを返し、同時に実行中のドライラン数の最大を記録する DryRunClient"""
+
+    def __init__(self, estimates):
+        self.estimates = estimates
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def dry_run(self, sql):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self._lock:
+            self.running -= 1
+        if sql not in self.estimates:
+            raise ValueError("Syntax error")
+        return self.estimates[sql], "SELECT"
+
+    def estimate_bytes(self, sql):
+        return self.dry_run(sql)[0]
+
+
+class Ctx:
+    def __init__(self):
+        self.state = {}
+
+
+def test_export_queries_dry_run_concurrently_and_apply_budget_in_order(monkeypatch, use_columns):
+    use_columns([("name", "STRING", False)])
+    client = FakeDryRunClient({
+        "SELECT a FROM `p.ds.events`": 60,
+        "SELECT b FROM `p.ds.events`": 200,
+        "SELECT c FROM `p.ds.events`": 60,
+        "SELECT d FROM `p.ds.events`": 60,
+    })
+    guard = budget_guard.BudgetGuard(client=client, query_max_bytes=100, budget_bytes=150)
+    monkeypatch.setattr(budget_guard, "budget_guard", guard)
+    ctx = Ctx()
+    sqls = [*client.estimates, "SELEC broken"]
+
+    checked = asyncio.run(
+        budget_guard.check_export_queries(sqls, ctx, "export_report", asyncio.Semaphore(3))
+    )
+
+    assert client.max_running == 3
+    # 1件目は実行、2件目は1クエリの上限超過、3件目は累計120で実行、4件目は累計180で超過
+    assert checked[0] is None
+    assert "1クエリあたりの上限" in checked[1]["error"]
+    assert checked[2] is None
+    assert "累計上限" in checked[3]["error"] and checked[3]["used_bytes"] == 120
+    assert "ドライランに失敗しました" in checked[4]["error"]
+    assert ctx.state[guard.state_key] == 120
@@ -0,0 +1,71 @@
+"""direct_export の SQL → ファイル直接出力"""
+import asyncio
+
+import pyarrow as pa
+import pytest
+
+from bq_agent import artifact_store, budget_guard, direct_export
+from bq_agent.export_executor import ExportExecutor
+
+SQL = "SELECT id FROM `p.ds.t`"
+
+
+class FakeDryRunClient:
+    def dry_run(self, sql):
+        return 10, "SELECT"
+
+    def estimate_bytes(self, sql):
+        return 10
+
+
+class Ctx:
+    def __init__(self):
+        self.state = {}
+        self.artifacts = {}
+
+    async def save_artifact(self, filename, artifact):
+        self.artifacts[filename] = artifact
+        return len(self.artifacts) - 1
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    executor = ExportExecutor(max_workers=1, queue_limit=0, kind="thread")
+    monkeypatch.setattr(artifact_store, "export_executor", executor)
+    monkeypatch.setattr(budget_guard, "budget_guard", budget_guard.BudgetGuard(client=FakeDryRunClient()))
+    direct_export.set_export_client(direct_export.InMemoryExportClient({SQL: pa.table({"id": [1, 2, 3]})}))
+    yield executor
+    direct_export.set_export_client(None)
+
+
+def test_export_runs_on_export_executor(offline):
+    ctx = Ctx()
+
+    result = asyncio.run(direct_export.export_sql_to_file(SQL, "csv", "out", ctx))
+
+    assert result["success"] is True
+    assert result["rows"] == 3
+    assert offline.metrics()["completed"] == 1
+    assert ctx.artifacts["out.csv"].inline_data.data.decode("utf-8").splitlines() == ['"id"', "1", "2", "3"]
+
+
+def test_export_is_rejected_when_executor_queue_is_full(offline):
+    async def export_while_busy():
+        release = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        def block():
+            asyncio.run_coroutine_threadsafe(release.wait(), loop).result()
+
+        busy = asyncio.create_task(offline.run(block))
+        await asyncio.sleep(0.05)
+        try:
+            return await direct_export.export_sql_to_file(SQL, "csv", "out", Ctx())
+        finally:
+            release.set()
+            await busy
+
+    result = asyncio.run(export_while_busy())
+
+    assert result["success"] is False
+    assert "混み合っています" in result["error"]
@@ -0,0 +1,62 @@
+"""excel_tool の結果JSONからのExcel出力"""
+import asyncio
+import io
+import json
+
+import pytest
+from openpyxl import load_workbook
+
+from bq_agent import excel_tool
+
+
+def _read_sheet(fileobj) -> list[tuple]:
+    fileobj.seek(0)
+    wb = load_workbook(fileobj, read_only=True)
+    return list(wb.worksheets[0].iter_rows(values_only=True))
+
+
+def test_schemaless_key_first_appearing_after_first_batch_is_kept(monkeypatch):
+    monkeypatch.setattr(excel_tool, "JSON_ROW_BATCH_SIZE", 2)
+    rows = [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}, {"id": 3, "name": "c", "extra": "x"}]
+
+    fileobj = io.BytesIO()
+    built = excel_tool.build_excel_file_from_json(json.dumps(rows), "Sheet1", fileobj)
+
+    assert built["rows"] == 3
+    assert built["columns"] == 3
+    assert _read_sheet(fileobj) == [
+        ("id", "name", "extra"),
+        (1, "a", None),
+        (2, "b", None),
+        (3, "c", "x"),
+    ]
+
+
+def test_schema_result_is_written_in_schema_order(monkeypatch):
+    monkeypatch.setattr(excel_tool, "JSON_ROW_BATCH_SIZE", 1)
+    result = {
+        "schema": {"fields": [{"name": "id", "type": "INTEGER"}, {"name": "name", "type": "STRING"}]},
+        "rows": [{"f": [{"v": "1"}, {"v": "a"}]}, {"f": [{"v": "2"}, {"v": None}]}],
+    }
+
+    fileobj = io.BytesIO()
+    built = excel_tool.build_excel_file_from_json(json.dumps(result), "Sheet1", fileobj)
+
+    assert built["rows"] == 2
+    assert _read_sheet(fileobj) == [("id", "name"), (1, "a"), (2, None)]
+
+
+def test_invalid_json_returns_parse_error():
+    result = asyncio.run(excel_tool.export_json_to_excel('{"rows": [{"id": 1}, ', "out"))
+
+    assert result == {"success": False, "error": "query_resultのJSON解析に失敗しました。"}
+
+
+def test_other_value_errors_are_not_reported_as_parse_errors(monkeypatch):
+    def build(text, sheet_name, fileobj):
+        raise ValueError("unsupported value")
+
+    monkeypatch.setattr(excel_tool, "build_excel_file_from_json", build)
+
+    with pytest.raises(ValueError, match="unsupported value"):
+        asyncio.run(excel_tool.export_json_to_excel('[{"id": 1}]', "out"))
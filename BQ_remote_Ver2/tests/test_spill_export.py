@@ -0,0 +1,63 @@
+"""spill_export のパート並列生成"""
+import asyncio
+
+import pyarrow as pa
+import pytest
+
+from bq_agent import artifact_store, spill_export
+from bq_agent.export_executor import ExportExecutor
+
+
+@pytest.fixture
+def small_executor(monkeypatch):
+    """同時実行数2・待ち行列1の実行プール（パートはプロセスではなくスレッドで生成する）"""
+    executor = ExportExecutor(max_workers=2, queue_limit=1, kind="thread")
+    monkeypatch.setattr(artifact_store, "export_executor", executor)
+    monkeypatch.setattr(spill_export, "export_executor", executor)
+    real_run_to_file = artifact_store.run_to_file
+
+    async def run_to_file(func, *args, process=False):
+        return await real_run_to_file(func, *args)
+
+    monkeypatch.setattr(spill_export, "run_to_file", run_to_file)
+    return executor
+
+
+def _parts(count: int, rows: int = 10) -> list[pa.Table]:
+    table = pa.table({"id": list(range(count * rows)), "name": [f"n{i}" for i in range(count * rows)]})
+    return [table.slice(offset, rows) for offset in range(0, table.num_rows, rows)]
+
+
+def test_parts_beyond_queue_limit_are_rendered(small_executor):
+    parts = _parts(small_executor.max_workers + small_executor.queue_limit + 5)
+
+    files = asyncio.run(spill_export._render_parts_parallel("csv", parts, "Sheet"))
+
+    assert len(files) == len(parts)
+    for i, fileobj in enumerate(files):
+        fileobj.seek(0)
+        lines = fileobj.read().decode("utf-8").splitlines()
+        assert len(lines) == 11
+        assert lines[1].startswith(str(i * 10))
+        fileobj.close()
+    assert small_executor.metrics()["rejected"] == 0
+
+
+def test_failed_part_stops_remaining_parts_and_closes_files(small_executor, monkeypatch):
+    rendered = []
+    real_render_part = spill_export.render_part
+
+    def render_part(fmt, table, sheet_name, rows_per_sheet, fileobj):
+        if table["id"][0].as_py() == 30:
+            raise RuntimeError("render failed")
+        real_render_part(fmt, table, sheet_name, rows_per_sheet, fileobj)
+        rendered.append(fileobj)
+
+    monkeypatch.setattr(spill_export, "render_part", render_part)
+    parts = _parts(20)
+
+    with pytest.raises(RuntimeError, match="render failed"):
+        asyncio.run(spill_export._render_parts_parallel("csv", parts, "Sheet"))
+
+    assert len(rendered) < len(parts) - 1
+    assert all(fileobj.closed for fileobj in rendered)
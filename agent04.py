@@ -7,9 +7,21 @@ from google.adk.agents import LlmAgent
 from google.adk.tools import FunctionTool
 from google.cloud import discoveryengine_v1 as discoveryengine
 from google.cloud import storage
-from typing import Any
+from typing import Any, Callable
+import asyncio
+import base64
+import bisect
+import codecs
+import contextlib
+import hashlib
+import json
 import logging
 import io
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
 
 # ログ設定
 logging.basicConfig(level=logging.INFO)
@@ -20,6 +32,76 @@ PROJECT_ID = "agent-vi-473112"
 DATASTORE_ID = "adk-test_1769691409159"
 DATASTORE_REGION = "global"
 
+# Discovery Engine API 呼び出し1回あたりのタイムアウト（秒）
+SEARCH_TIMEOUT_SECONDS = float(os.getenv("VERTEX_SEARCH_TIMEOUT_SECONDS", "30"))
+
+# ファイルのプレビューで読む範囲
+TEXT_PREVIEW_CHARS = 5000
+EXCEL_PREVIEW_ROWS = 50
+
+# GCSからExcelを読むときの1回あたりの取得サイズ
+GCS_READ_CHUNK_BYTES = 1024 * 1024
+
+# ファイルのプレビューのディスクキャッシュ
+DOC_CACHE_DIR = os.getenv(
+    "VERTEX_DOC_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "agent04_document_cache")
+)
+DOC_CACHE_MAX_BYTES = int(os.getenv("VERTEX_DOC_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# 元のバイト列もキャッシュするExcelファイルのサイズ上限（既定 0 = プレビューだけをキャッシュする）
+# 有効にすると、初回のプレビューで必要な範囲だけでなくワークブック全体をダウンロードする
+DOC_CACHE_RAW_MAX_BYTES = int(os.getenv("VERTEX_DOC_CACHE_RAW_MAX_BYTES", "0"))
+
+# キャッシュするプレビューの形式が変わったら上げる
+PREVIEW_VERSION = 1
+
+# ドキュメント一覧のスナップショット
+CATALOG_PATH = os.getenv(
+    "VERTEX_DOC_CATALOG_PATH",
+    os.path.join(tempfile.gettempdir(), "agent04_document_catalog.json")
+)
+CATALOG_REFRESH_SECONDS = float(os.getenv("VERTEX_DOC_CATALOG_REFRESH_SECONDS", "300"))
+# スナップショットの形式が変わったら上げる
+CATALOG_VERSION = 1
+# 一覧取得1回あたりの件数（API の上限は1000）
+CATALOG_PAGE_SIZE = 1000
+# list_all_documents が1回に返す件数の上限
+LIST_MAX_PAGE_SIZE = 200
+
+
+class _SharedClient:
+    """
+    プロセス内で共有するクライアント（初回使用時に作成する）
+
+    非同期のgRPCチャネルは作成時のイベントループに紐づくため、
+    別のイベントループから呼ばれた場合だけ作り直す
+    """
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._client = None
+        self._loop = None
+
+    def get(self) -> Any:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = self._factory()
+            self._loop = loop
+        return self._client
+
+
+# チャネルとTLSハンドシェイクをツール呼び出しごとに作り直さないよう、クライアントを使い回す
+_search_client = _SharedClient(discoveryengine.SearchServiceAsyncClient)
+_document_client = _SharedClient(discoveryengine.DocumentServiceAsyncClient)
+_storage_client: storage.Client | None = None
+
+
+def _get_storage_client() -> storage.Client:
+    global _storage_client
+    if _storage_client is None:
+        _storage_client = storage.Client()
+    return _storage_client
+
 
 async def search_datastore(query: str) -> dict[str, Any]:
     """
@@ -34,7 +116,7 @@ async def search_datastore(query: str) -> dict[str, Any]:
     logger.info(f"=== search_datastore called with query: {query} ===")
     
     try:
-        client = discoveryengine.SearchServiceClient()
+        client = _search_client.get()
         serving_config = f"projects/{PROJECT_ID}/locations/{DATASTORE_REGION}/dataStores/{DATASTORE_ID}/servingConfigs/default_search"
         
         request = discoveryengine.SearchRequest(
@@ -48,7 +130,7 @@ async def search_datastore(query: str) -> dict[str, Any]:
             ),
         )
         
-        response = client.search(request)
+        response = await client.search(request, timeout=SEARCH_TIMEOUT_SECONDS)
         
         results = []
         for result in response.results:
@@ -106,10 +188,10 @@ async def get_document_content(document_id: str) -> dict[str, Any]:
     
     try:
         # ドキュメント情報を取得
-        doc_client = discoveryengine.DocumentServiceClient()
+        doc_client = _document_client.get()
         doc_name = f"projects/{PROJECT_ID}/locations/{DATASTORE_REGION}/dataStores/{DATASTORE_ID}/branches/default_branch/documents/{document_id}"
         
-        doc = doc_client.get_document(name=doc_name)
+        doc = await doc_client.get_document(name=doc_name, timeout=SEARCH_TIMEOUT_SECONDS)
         logger.info(f"Document retrieved: {doc.name}")
         
         result = {
@@ -138,7 +220,192 @@ async def get_document_content(document_id: str) -> dict[str, Any]:
 
 
 async def _read_gcs_file(gcs_uri: str) -> dict[str, Any] | None:
-    """GCSからファイルを読み込む"""
+    """GCSからファイルを読み込む（ダウンロードと解析はイベントループを止めないようスレッドで行う）"""
+    return await asyncio.to_thread(_read_gcs_file_sync, gcs_uri)
+
+
+class DocumentCache:
+    """
+    GCSファイルのプレビューのディスクキャッシュ（gs:// URI + 世代ごと）
+
+    - プレビュー（_read_gcs_file の戻り値）をJSONで保存する
+    - DOC_CACHE_RAW_MAX_BYTES を設定した場合、それ以下のExcelは元のバイト列も保存し、プレビューの作り直しにも使う
+    - 合計が max_bytes を超えたら最後に使った時刻（mtime）の古い順に削除する（LRU）
+
+    オブジェクトが更新されると世代が変わってキーが変わるため、古いエントリは使われずに押し出される
+    """
+
+    def __init__(self, cache_dir: str = DOC_CACHE_DIR, max_bytes: int = DOC_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, gcs_uri: str, generation: Any, suffix: str) -> str:
+        digest = hashlib.sha256(f"{gcs_uri}#{generation}".encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.cache_dir, f"{digest}{suffix}")
+
+    @staticmethod
+    def _touch(path: str) -> None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def load_preview(self, gcs_uri: str, generation: Any) -> dict[str, Any] | None:
+        path = self._path(gcs_uri, generation, ".json")
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Document cache read failed for {gcs_uri}: {e}")
+            return None
+        if entry.get("version") != PREVIEW_VERSION or entry.get("uri") != gcs_uri:
+            return None
+        self._touch(path)
+        return entry["preview"]
+
+    def raw_path(self, gcs_uri: str, generation: Any) -> str | None:
+        """保存済みの元のバイト列のパス（ない場合は None）"""
+        path = self._path(gcs_uri, generation, ".bin")
+        if not os.path.exists(path):
+            return None
+        self._touch(path)
+        return path
+
+    def _write(self, path: str, write: Callable[[Any], None], mode: str) -> None:
+        """一時ファイルに書き込んでから置き換える"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, mode, **({"encoding": "utf-8"} if "b" not in mode else {})) as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+
+    def store_raw(self, gcs_uri: str, generation: Any, blob: Any) -> str:
+        """オブジェクトをダウンロードして保存し、パスを返す"""
+        path = self._path(gcs_uri, generation, ".bin")
+        self._write(path, blob.download_to_file, "wb")
+        self._evict()
+        return path
+
+    def store_preview(self, gcs_uri: str, generation: Any, preview: dict[str, Any]) -> None:
+        entry = {"version": PREVIEW_VERSION, "uri": gcs_uri, "generation": generation, "preview": preview}
+        try:
+            self._write(
+                self._path(gcs_uri, generation, ".json"),
+                lambda f: json.dump(entry, f, ensure_ascii=False, default=str),
+                "w"
+            )
+            self._evict()
+        except OSError as e:
+            logger.warning(f"Document cache write failed for {gcs_uri}: {e}")
+
+    def _evict(self) -> None:
+        """合計サイズが上限を超えていれば、最後に使った時刻の古いファイルから削除する"""
+        with self._lock:
+            try:
+                entries = [e for e in os.scandir(self.cache_dir) if e.is_file() and not e.name.endswith(".tmp")]
+            except OSError:
+                return
+            stats = sorted(((e.stat().st_mtime, e.stat().st_size, e.path) for e in entries))
+            total = sum(size for _, size, _ in stats)
+            for _, size, path in stats:
+                if total <= self.max_bytes:
+                    break
+                with contextlib.suppress(OSError):
+                    os.unlink(path)
+                total -= size
+
+
+# プロセス全体で共有するキャッシュ
+document_cache = DocumentCache()
+
+
+def _excel_preview(stream: Any) -> dict[str, list[list[str]]]:
+    """ワークブックを読み取り専用モードで開き、各シート先頭 EXCEL_PREVIEW_ROWS 行を返す"""
+    import openpyxl
+    workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    try:
+        sheets_data = {}
+        for sheet_name in workbook.sheetnames:
+            sheet = workbook[sheet_name]
+            rows = []
+            for row in sheet.iter_rows(max_row=EXCEL_PREVIEW_ROWS):
+                row_data = [str(cell.value) if cell.value is not None else "" for cell in row]
+                if any(row_data):  # 空行はスキップ
+                    rows.append(row_data)
+            sheets_data[sheet_name] = rows
+        return sheets_data
+    finally:
+        workbook.close()
+
+
+def _build_preview(gcs_uri: str, blob: Any, blob_name: str, size: int) -> dict[str, Any]:
+    """プレビューに必要な分だけを読んでプレビューを作る"""
+    # Excelファイルの場合
+    if blob_name.endswith('.xlsx') or blob_name.endswith('.xls'):
+        # 既定では必要な範囲だけを読む。元のバイト列のキャッシュを有効にした場合だけ、上限以下のファイルを丸ごと保存する
+        raw_path = document_cache.raw_path(gcs_uri, blob.generation)
+        if raw_path is None and 0 < size <= DOC_CACHE_RAW_MAX_BYTES:
+            try:
+                raw_path = document_cache.store_raw(gcs_uri, blob.generation, blob)
+            except OSError as e:
+                logger.warning(f"Document cache write failed for {gcs_uri}: {e}")
+        if raw_path is not None:
+            with open(raw_path, "rb") as stream:
+                sheets_data = _excel_preview(stream)
+        else:
+            with blob.open("rb", chunk_size=GCS_READ_CHUNK_BYTES) as stream:
+                sheets_data = _excel_preview(stream)
+        
+        return {
+            "type": "excel",
+            "filename": blob_name,
+            "size_bytes": size,
+            "sheets": sheets_data
+        }
+    
+    # テキストファイルの場合
+    elif blob_name.endswith('.txt') or blob_name.endswith('.csv'):
+        # UTF-8は1文字最大4バイトのため、その範囲だけを取得する
+        read_bytes = min(size, TEXT_PREVIEW_CHARS * 4)
+        content = blob.download_as_bytes(start=0, end=read_bytes - 1, checksum=None) if read_bytes else b""
+        # 範囲の末尾で切れたマルチバイト文字は捨てる
+        text = codecs.getincrementaldecoder("utf-8")().decode(content, final=read_bytes == size)
+        return {
+            "type": "text",
+            "filename": blob_name,
+            "size_bytes": size,
+            "content": text[:TEXT_PREVIEW_CHARS],
+            "truncated": read_bytes < size or len(text) > TEXT_PREVIEW_CHARS
+        }
+    
+    # その他のファイル
+    else:
+        return {
+            "type": "binary",
+            "filename": blob_name,
+            "size_bytes": size
+        }
+
+
+def _read_gcs_file_sync(gcs_uri: str) -> dict[str, Any] | None:
+    """
+    GCSからファイルのプレビューを読み込む（同期処理）
+
+    プレビューに必要な分だけを読み、オブジェクト全体はダウンロードしない
+    - テキスト/CSV: 先頭 TEXT_PREVIEW_CHARS 文字分のバイト範囲だけを取得する
+    - Excel: 読み取り専用モードで開き、各シート EXCEL_PREVIEW_ROWS 行で打ち切る
+    - その他: メタデータのサイズのみ返す（本体は読まない）
+
+    メタデータで世代を確認し、同じ世代のプレビューがキャッシュにあればダウンロードも解析もしない
+    """
     try:
         # gs://bucket/path 形式をパース
         parts = gcs_uri.replace("gs://", "").split("/", 1)
@@ -147,87 +414,256 @@ async def _read_gcs_file(gcs_uri: str) -> dict[str, Any] | None:
         
         logger.info(f"Reading from GCS: bucket={bucket_name}, blob={blob_name}")
         
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_name)
-        
-        # ファイルをダウンロード
-        content = blob.download_as_bytes()
-        
-        # Excelファイルの場合
-        if blob_name.endswith('.xlsx') or blob_name.endswith('.xls'):
-            import openpyxl
-            workbook = openpyxl.load_workbook(io.BytesIO(content), data_only=True)
-            
-            sheets_data = {}
-            for sheet_name in workbook.sheetnames:
-                sheet = workbook[sheet_name]
-                rows = []
-                for row in sheet.iter_rows(max_row=50):  # 最大50行
-                    row_data = [str(cell.value) if cell.value is not None else "" for cell in row]
-                    if any(row_data):  # 空行はスキップ
-                        rows.append(row_data)
-                sheets_data[sheet_name] = rows
-            
-            return {
-                "type": "excel",
-                "filename": blob_name,
-                "sheets": sheets_data
-            }
+        # メタデータ（サイズ・世代）を取得。以降の読み込みはこの世代に固定される
+        blob = _get_storage_client().bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
+            logger.error(f"GCS object not found: {gcs_uri}")
+            return None
+        size = blob.size or 0
         
-        # テキストファイルの場合
-        elif blob_name.endswith('.txt') or blob_name.endswith('.csv'):
-            text = content.decode('utf-8')
-            return {
-                "type": "text",
-                "filename": blob_name,
-                "content": text[:5000]  # 最大5000文字
-            }
+        preview = document_cache.load_preview(gcs_uri, blob.generation)
+        if preview is not None:
+            logger.info(f"Document cache hit: {gcs_uri} (generation {blob.generation})")
+            return {**preview, "cached": True}
         
-        # その他のファイル
-        else:
-            return {
-                "type": "binary",
-                "filename": blob_name,
-                "size_bytes": len(content)
-            }
+        preview = _build_preview(gcs_uri, blob, blob_name, size)
+        document_cache.store_preview(gcs_uri, blob.generation, preview)
+        return preview
             
     except Exception as e:
         logger.error(f"GCS read error: {e}")
         return None
 
 
-async def list_all_documents() -> dict[str, Any]:
+def _catalog_entry(doc: Any) -> dict[str, Any]:
+    """ドキュメントをカタログの1エントリ（ID・URI・タイトル・更新時刻）にする"""
+    gcs_uri = doc.content.uri if doc.content and doc.content.uri else None
+    title = None
+    for data in (doc.struct_data, doc.derived_struct_data):
+        if data and "title" in data:
+            title = str(data["title"])
+            break
+    if title is None and gcs_uri:
+        title = gcs_uri.rsplit("/", 1)[-1]
+    return {
+        "id": doc.id,
+        "name": doc.name,
+        "gcs_uri": gcs_uri,
+        "title": title,
+        "update_time": doc.index_time.isoformat() if doc.index_time else None,
+    }
+
+
+def _documents_parent() -> str:
+    return f"projects/{PROJECT_ID}/locations/{DATASTORE_REGION}/dataStores/{DATASTORE_ID}/branches/default_branch"
+
+
+class DocumentCatalog:
     """
-    データストア内の全ドキュメントを一覧表示します。
+    データストアのドキュメント一覧のスナップショット
+
+    - 一覧はローカルディスク（CATALOG_PATH）にも保存し、プロセス再起動後もそのまま使う
+    - CATALOG_REFRESH_SECONDS を過ぎたら、手元のスナップショットを返しつつバックグラウンドで取り直す
+      （同時に1回だけ）。取り直した一覧との差分（追加・更新・削除）をログに出す
+    - ページは CATALOG_PAGE_SIZE 件ずつ取得し、受け取ったページの処理中に次のページを先読みする
+    """
+
+    def __init__(self, path: str = CATALOG_PATH, refresh_seconds: float = CATALOG_REFRESH_SECONDS):
+        self.path = path
+        self.refresh_seconds = refresh_seconds
+        self.documents: dict[str, dict[str, Any]] = {}
+        self.refreshed_at: float | None = None
+        self._refresh_task: asyncio.Task | None = None
+        self._loaded = False
+
+    def _load(self) -> None:
+        self._loaded = True
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Document catalog read failed: {e}")
+            return
+        if snapshot.get("version") != CATALOG_VERSION or snapshot.get("parent") != _documents_parent():
+            return
+        self.documents = {doc["id"]: doc for doc in snapshot["documents"]}
+        self.refreshed_at = snapshot["refreshed_at"]
+
+    def _save(self) -> None:
+        snapshot = {
+            "version": CATALOG_VERSION,
+            "parent": _documents_parent(),
+            "refreshed_at": self.refreshed_at,
+            "documents": list(self.documents.values()),
+        }
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Document catalog write failed: {e}")
+
+    @property
+    def refreshing(self) -> bool:
+        return self._refresh_task is not None and not self._refresh_task.done()
+
+    async def _fetch_all(self) -> dict[str, dict[str, Any]]:
+        """全ページを取得する（次のページの取得を先に始めてから、受け取ったページを処理する）"""
+        client = _document_client.get()
+
+        def fetch(page_token: str) -> asyncio.Task:
+            request = discoveryengine.ListDocumentsRequest(
+                parent=_documents_parent(), page_size=CATALOG_PAGE_SIZE, page_token=page_token
+            )
+            return asyncio.ensure_future(client.list_documents(request, timeout=SEARCH_TIMEOUT_SECONDS))
+
+        documents: dict[str, dict[str, Any]] = {}
+        pending = fetch("")
+        while pending is not None:
+            page = await pending
+            pending = fetch(page.next_page_token) if page.next_page_token else None
+            for doc in page.documents:
+                documents[doc.id] = _catalog_entry(doc)
+        return documents
+
+    async def refresh(self) -> None:
+        """一覧を取り直してスナップショットを置き換える"""
+        started = time.time()
+        documents = await self._fetch_all()
+        previous = self.documents
+        added = len(documents.keys() - previous.keys())
+        removed = len(previous.keys() - documents.keys())
+        updated = sum(1 for key, doc in documents.items() if key in previous and previous[key] != doc)
+        self.documents = documents
+        self.refreshed_at = started
+        await asyncio.to_thread(self._save)
+        logger.info(
+            f"Document catalog refreshed: {len(documents)} documents "
+            f"(+{added} / ~{updated} / -{removed}) in {time.time() - started:.1f}s"
+        )
+
+    def _start_refresh(self) -> asyncio.Task:
+        if not self.refreshing:
+            self._refresh_task = asyncio.create_task(self.refresh())
+            self._refresh_task.add_done_callback(self._log_refresh_error)
+        return self._refresh_task
+
+    @staticmethod
+    def _log_refresh_error(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Document catalog refresh error: {task.exception()}")
+
+    async def snapshot(self, force_refresh: bool = False) -> dict[str, dict[str, Any]]:
+        """
+        スナップショットを返す
+
+        スナップショットがない場合（または force_refresh）は取得を待ち、古い場合はバックグラウンドで取り直す
+        """
+        if not self._loaded:
+            await asyncio.to_thread(self._load)
+        if self.refreshed_at is None or force_refresh:
+            # shield: ツール呼び出しがキャンセルされても取得は続ける
+            await asyncio.shield(self._start_refresh())
+        elif time.time() - self.refreshed_at > self.refresh_seconds:
+            self._start_refresh()
+        return self.documents
+
+
+# プロセス全体で共有するカタログ
+document_catalog = DocumentCatalog()
+
+
+def _matches(doc: dict[str, Any], prefix: str, extension: str) -> bool:
+    path = (doc.get("gcs_uri") or "").removeprefix("gs://")
+    if prefix and not any(
+        value.startswith(prefix)
+        for value in (path, path.split("/", 1)[-1], doc.get("title") or "", doc["id"])
+    ):
+        return False
+    if extension and not path.lower().endswith(f".{extension.lower().lstrip('.')}"):
+        return False
+    return True
+
+
+def _page_key(doc: dict[str, Any]) -> tuple[str, str]:
+    """一覧の並び順のキー（GCSパス, ドキュメントID）"""
+    return (doc.get("gcs_uri") or "", doc["id"])
+
+
+def _encode_page_token(key: tuple[str, str]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(key), ensure_ascii=False).encode("utf-8")).decode("ascii")
+
+
+def _decode_page_token(token: str) -> tuple[str, str]:
+    """page_token を直前のページの最後のキーに戻す（不正な場合は ValueError）"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except (ValueError, UnicodeError) as e:
+        raise ValueError(token) from e
+    if not (isinstance(key, list) and len(key) == 2 and all(isinstance(part, str) for part in key)):
+        raise ValueError(token)
+    return key[0], key[1]
+
+
+async def list_all_documents(
+    prefix: str = "",
+    extension: str = "",
+    page_token: str = "",
+    page_size: int = 50,
+    refresh: bool = False
+) -> dict[str, Any]:
+    """
+    データストア内のドキュメントを一覧表示します（ページ単位）。
     
+    ローカルに保持した一覧（バックグラウンドで定期的に更新）から返すため、
+    データストアへの問い合わせは一覧が古くなったときだけ行います。
+    
+    Args:
+        prefix: ファイルパス・タイトル・ドキュメントIDの先頭一致で絞り込む（例: "reports/2024"）
+        extension: 拡張子で絞り込む（例: "xlsx"）
+        page_token: 前回の応答の next_page_token（続きを取得する場合）
+        page_size: 1ページの件数（最大 LIST_MAX_PAGE_SIZE）
+        refresh: true の場合は一覧を取り直してから返す
+        
     Returns:
-        ドキュメント一覧
+        ドキュメント一覧（1ページ分）
     """
-    logger.info("=== list_all_documents called ===")
+    logger.info(f"=== list_all_documents called (prefix={prefix!r}, extension={extension!r}, page_token={page_token!r}) ===")
     
+    # page_token は直前のページの最後のドキュメントのキー。件数の位置ではなくキーの続きから返すため、
+    # ページの間に一覧が更新されても、残っているドキュメントを飛ばしたり重複して返したりしない
     try:
-        client = discoveryengine.DocumentServiceClient()
-        parent = f"projects/{PROJECT_ID}/locations/{DATASTORE_REGION}/dataStores/{DATASTORE_ID}/branches/default_branch"
-        
-        docs = client.list_documents(parent=parent)
-        
-        results = []
-        for doc in docs:
-            doc_info = {
-                "id": doc.id,
-                "name": doc.name,
-            }
-            if doc.content and doc.content.uri:
-                doc_info["gcs_uri"] = doc.content.uri
-            results.append(doc_info)
+        after = _decode_page_token(page_token) if page_token else None
+    except ValueError:
+        return {"success": False, "error": f"page_token が不正です（最初のページから取得し直してください）: {page_token}"}
+    page_size = max(1, min(page_size, LIST_MAX_PAGE_SIZE))
+    
+    try:
+        documents = await document_catalog.snapshot(force_refresh=refresh)
         
-        logger.info(f"Total documents: {len(results)}")
+        matched = sorted(
+            (doc for doc in documents.values() if _matches(doc, prefix, extension)),
+            key=_page_key
+        )
+        start = bisect.bisect_right(matched, after, key=_page_key) if after else 0
+        selected = matched[start:start + page_size]
+        page = [{k: v for k, v in doc.items() if k != "name"} for doc in selected]
+        has_more = start + page_size < len(matched)
         
         return {
             "success": True,
-            "total": len(results),
-            "documents": results
+            "total": len(matched),
+            "documents": page,
+            "next_page_token": _encode_page_token(_page_key(selected[-1])) if has_more else None,
+            "catalog": {
+                "documents": len(documents),
+                "refreshed_at": datetime.fromtimestamp(document_catalog.refreshed_at, timezone.utc).isoformat(timespec="seconds"),
+                "refreshing": document_catalog.refreshing,
+            }
         }
         
     except Exception as e:
@@ -250,10 +686,10 @@ root_agent = LlmAgent(
 ## 使用するツール
 1. **search_datastore**: キーワードでデータストアを検索します
 2. **get_document_content**: ドキュメントIDを指定してファイルの中身を取得します
-3. **list_all_documents**: データストア内の全ドキュメントを一覧表示します
+3. **list_all_documents**: データストア内のドキュメントを一覧表示します（ページ単位。prefix / extension で絞り込み、続きは next_page_token を page_token に渡す）
 
 ## 基本的なワークフロー
-1. まず「何が入っているか」を聞かれたら `list_all_documents` を使って一覧を表示
+1. まず「何が入っているか」を聞かれたら `list_all_documents` を使って一覧を表示（全件をたどらず、必要なら prefix や extension で絞り込む）
 2. キーワードで検索する場合は `search_datastore` を使用（シンプルな1〜3語のキーワードで）
 3. ファイルの中身を見たい場合は `get_document_content` でドキュメントIDを指定して取得
 